@@ -1,11 +1,12 @@
 import numpy as np
-from fastapi import FastAPI, HTTPException, Body, Depends, Query
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Body, Depends, Query, Header, BackgroundTasks
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, validator
 import sqlite3
 import uvicorn
 import secrets
+import base64
 import os
 from dotenv import load_dotenv
 import aiohttp
@@ -26,8 +27,7 @@ from database import (
     update_gsc_credentials_in_db,
     get_gsc_credentials_from_db,
     create_gsc_data_table,
-    add_gsc_data_by_keyword_id,
-    update_search_volume_if_needed,
+    upsert_gsc_data,
     update_project_in_db,
     get_project_by_id,
     add_project,
@@ -35,13 +35,56 @@ from database import (
     set_ctr_cache,
     get_gsc_data_by_project,
     get_gsc_data_by_domain,
+    get_rank_data_rows,
+    iter_rank_data_rows,
+    get_cached_ctr_entry,
+    get_ctr_curve_array,
+    invalidate_ctr_curve,
+    decode_full_data,
+    get_share_of_voice_daily,
+    update_sov_daily,
+    invalidate_sov_daily,
+    get_competitor_domains,
+    get_ranking_urls,
+    estimate_business_impact,
+    refresh_keyword_rank_latest,
+    get_keyword_rank_latest,
+    iter_gsc_data_by_project,
+    iter_gsc_data_by_domain,
+    iter_query_rows,
+    create_pull_job,
+    claim_pull_tasks,
+    complete_pull_task,
+    retry_pull_task,
+    finish_pull_job_if_done,
+    get_pull_job,
+    cancel_pull_job,
+    release_pull_task_leases,
+    get_cached_serp,
+    put_cached_serp,
+    clear_serp_cache,
+    record_pull_job_depth_stats,
+    set_search_volumes,
+    get_search_volume,
+    get_search_volumes,
+    get_cached_volumes,
+    get_volume_refresh_candidates,
+    VOLUME_CACHE_TTL_DAYS,
+    standard_ctr_curve,
+    calculate_and_cache_avg_ctr_per_position,
+    normalize_keyword,
+    add_dead_letter,
+    resolve_dead_letter,
+    redrive_dead_letters,
+    get_dead_letters,
+    extract_domain,
+    find_serp_rank,
     get_db_connection
 )
 import json
 from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Optional, Union, Tuple, Any
 import asyncio
-from asyncio import Semaphore
 import logging
 from collections import defaultdict
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -55,9 +98,17 @@ from gsc_auth import create_auth_flow, get_gsc_service
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from gsc_auth import create_auth_flow
-import random
-from services import fetch_search_volume
+import math
+import socket
+import time
+from http_client import get_http_session, start_http_session, close_http_session
+from serp_writer import get_serp_writer, close_serp_writer
+from single_flight import get_single_flight, get_single_flight_stats
+from serp_providers import get_serp_provider_pool, SerpProviderError
+from circuit_breaker import CircuitOpenError
+from rate_limiter import get_rate_limiter, get_rate_limiter_stats, parse_retry_after
 
 gsc_credentials = None
 
@@ -96,6 +147,7 @@ class ProjectBase(BaseModel):
     branded_terms: Optional[str] = None
     conversion_rate: Optional[float] = None
     conversion_value: Optional[float] = None
+    serp_cache_max_age_hours: Optional[float] = None
 
 class Project(ProjectBase):
     id: int
@@ -117,6 +169,8 @@ class TagCreate(BaseModel):
 
 class SerpDataRequest(BaseModel):
     tag_id: Optional[int] = None
+    max_cache_age_hours: Optional[float] = None
+    bypass_cache: bool = False
 
 class DateRangeRequest(BaseModel):
     start: str
@@ -203,117 +257,13 @@ GREPWORDS_API_KEY = os.getenv("GREPWORDS_API_KEY")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 
-standard_ctr_curve = {
-    1: 0.2688,  # 26.88%
-    2: 0.1173,  # 11.73%
-    3: 0.0708,  # 7.08%
-    4: 0.0466,  # 4.66%
-    5: 0.0329,  # 3.29%
-    6: 0.0235,  # 2.35%
-    7: 0.0177,  # 1.77%
-    8: 0.0135,  # 1.35%
-    9: 0.0109,  # 1.09%
-    10: 0.0088,  # 0.88%
-    11: 0.0072,  # 0.72%
-    12: 0.007,  # 0.7%
-    13: 0.0066,  # 0.66%
-    14: 0.0063,  # 0.63%
-    15: 0.0066,  # 0.66%
-    16: 0.0068,  # 0.68%
-    17: 0.0075,  # 0.75%
-    18: 0.008,  # 0.8%
-    19: 0.0067,  # 0.67%
-    20: 0.0069,  # 0.69%
-    21: 0.0069,  # 0.69%
-    22: 0.0069,  # 0.69%
-    23: 0.0069,  # 0.69%
-    24: 0.0069,  # 0.69%
-    25: 0.0069,  # 0.69%
-    26: 0.0069,  # 0.69%
-    27: 0.0069,  # 0.69%
-    28: 0.0069,  # 0.69%
-    29: 0.0069,  # 0.69%
-    30: 0.0039,  # 0.39%
-    31: 0.0039,  # 0.39%
-    32: 0.0039,  # 0.39%
-    33: 0.0039,  # 0.39%
-    34: 0.0039,  # 0.39%
-    35: 0.0039,  # 0.39%
-    36: 0.0039,  # 0.39%
-    37: 0.0039,  # 0.39%
-    38: 0.0039,  # 0.39%
-    39: 0.0039,  # 0.39%
-    40: 0.0019,  # 0.19%
-    41: 0.0019,  # 0.19%
-    42: 0.0019,  # 0.19%
-    43: 0.0019,  # 0.19%
-    44: 0.0019,  # 0.19%
-    45: 0.0019,  # 0.19%
-    46: 0.0019,  # 0.19%
-    47: 0.0019,  # 0.19%
-    48: 0.0019,  # 0.19%
-    49: 0.0019,  # 0.19%
-    50: 0.00095,  # 0.095%
-    51: 0.00095,  # 0.095%
-    52: 0.00095,  # 0.095%
-    53: 0.00095,  # 0.095%
-    54: 0.00095,  # 0.095%
-    55: 0.00095,  # 0.095%
-    56: 0.00095,  # 0.095%
-    57: 0.00095,  # 0.095%
-    58: 0.00095,  # 0.095%
-    59: 0.00095,  # 0.095%
-    60: 0.000475,  # 0.0475%
-    61: 0.000475,  # 0.0475%
-    62: 0.000475,  # 0.0475%
-    63: 0.000475,  # 0.0475%
-    64: 0.000475,  # 0.0475%
-    65: 0.000475,  # 0.0475%
-    66: 0.000475,  # 0.0475%
-    67: 0.000475,  # 0.0475%
-    68: 0.000475,  # 0.0475%
-    69: 0.000475,  # 0.0475%
-    70: 0.0002375,  # 0.02375%
-    71: 0.0002375,  # 0.02375%
-    72: 0.0002375,  # 0.02375%
-    73: 0.0002375,  # 0.02375%
-    74: 0.0002375,  # 0.02375%
-    75: 0.0002375,  # 0.02375%
-    76: 0.0002375,  # 0.02375%
-    77: 0.0002375,  # 0.02375%
-    78: 0.0002375,  # 0.02375%
-    79: 0.0002375,  # 0.02375%
-    80: 0.00011875,  # 0.011875%
-    81: 0.00011875,  # 0.011875%
-    82: 0.00011875,  # 0.011875%
-    83: 0.00011875,  # 0.011875%
-    84: 0.00011875,  # 0.011875%
-    85: 0.00011875,  # 0.011875%
-    86: 0.00011875,  # 0.011875%
-    87: 0.00011875,  # 0.011875%
-    88: 0.00011875,  # 0.011875%
-    89: 0.00011875,  # 0.011875%
-    90: 0.000059375,  # 0.0059375%
-    91: 0.000059375,  # 0.0059375%
-    92: 0.000059375,  # 0.0059375%
-    93: 0.000059375,  # 0.0059375%
-    94: 0.000059375,  # 0.0059375%
-    95: 0.000059375,  # 0.0059375%
-    96: 0.000059375,  # 0.0059375%
-    97: 0.000059375,  # 0.0059375%
-    98: 0.000059375,  # 0.0059375%
-    99: 0.000059375,  # 0.0059375%
-    100: 0.000059375,  # 0.0059375%
-}
-# From https://www.advancedwebranking.com/free-seo-tools/google-organic-ctr
-# Non-branded CTR curve August 2024 (only from 1-20)
-
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
 def get_avg_ctr_for_project_rank(project_id: int, rank: int) -> float:
     """
-    Retrieves the average CTR for a given project and rank position from the ctr_cache.
+    Retrieves the average CTR for a given project and rank position from the
+    in-process CTR curve cache.
 
     Args:
         project_id (int): The ID of the project.
@@ -323,24 +273,13 @@ def get_avg_ctr_for_project_rank(project_id: int, rank: int) -> float:
         float: The average CTR for the specified rank. Returns 0.0 if not found.
     """
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("""
-            SELECT avg_ctr_per_position
-            FROM ctr_cache
-            WHERE project_id = ?
-        """, (project_id,))
-        result = c.fetchone()
-        conn.close()
-        
-        if result:
-            avg_ctr_per_position = json.loads(result['avg_ctr_per_position'])
-            ctr = avg_ctr_per_position.get(str(rank), 0.0)
-            logging.info(f"Retrieved CTR for project_id={project_id}, rank={rank}: {ctr}")
-            return float(ctr)
-        else:
+        ctr_by_rank = get_ctr_curve_array(project_id)
+        if ctr_by_rank is None:
             logging.warning(f"No CTR cache found for project_id={project_id}. Returning 0.0 CTR.")
             return 0.0
+        if rank is None or not 1 <= rank <= 100:
+            return 0.0
+        return float(ctr_by_rank[rank])
     except sqlite3.Error as e:
         logging.error(f"SQLite error in get_avg_ctr_for_project_rank: {e}")
         raise HTTPException(status_code=500, detail="Database error occurred while retrieving CTR data.")
@@ -377,12 +316,20 @@ def get_previous_estimated_business_impact(c, keyword_id, current_date, avg_ctr_
     else:
         return None
 
-def extract_domain(url):
-    from urllib.parse import urlparse
-    parsed_url = urlparse(url)
-    domain = parsed_url.netloc or parsed_url.path
-    domain = domain.split(':')[0]  # Remove port if present
-    return domain.lower().replace('www.', '')
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    """
+    Returns True when the client opted into streaming via `Accept: application/x-ndjson`.
+    """
+    return bool(accept) and NDJSON_MEDIA_TYPE in accept
+
+def ndjson_response(items) -> StreamingResponse:
+    """
+    Streams an iterable of JSON-serializable items as newline-delimited JSON,
+    encoding each item only when the client is ready to receive it.
+    """
+    return StreamingResponse((json.dumps(item) + "\n" for item in items), media_type=NDJSON_MEDIA_TYPE)
 
 async def perform_pull(pull_id: int):
     try:
@@ -518,12 +465,11 @@ async def update_project_rankings(project_id: int, tag_id: Optional[int]):
             
             logging.info(f"Found {len(keywords)} keywords for project")
             
-            # Fetch and update rankings for each keyword
-            for keyword in keywords:
-                logging.info(f"Updating rankings for keyword: {keyword['keyword']}")
-                await fetch_and_update_rankings(conn, project, keyword, tag_id)
+            # Queue one task per keyword; the pull workers fetch them in the background
+            create_pull_job('scheduled', [keyword['id'] for keyword in keywords], project_id=project_id, tag_id=tag_id)
+            notify_pull_workers()
             
-            logging.info(f"Completed update_project_rankings for project_id: {project_id}, tag_id: {tag_id}")
+            logging.info(f"Queued update_project_rankings for project_id: {project_id}, tag_id: {tag_id}")
         else:
             logging.warning(f"Project with ID {project_id} not found")
         
@@ -531,14 +477,355 @@ async def update_project_rankings(project_id: int, tag_id: Optional[int]):
     except Exception as e:
         logging.error(f"Error in update_project_rankings for project_id: {project_id}, tag_id: {tag_id}: {e}")
 
-async def fetch_and_update_rankings(conn, project, keyword, tag_id):
+PULL_WORKERS = int(os.getenv("PULL_WORKERS", 4))
+PULL_BATCH_SIZE = int(os.getenv("PULL_BATCH_SIZE", 10))  # Tasks claimed by a worker at a time
+PULL_TASK_LEASE_SECONDS = float(os.getenv("PULL_TASK_LEASE_SECONDS", 600))
+PULL_TASK_MAX_ATTEMPTS = int(os.getenv("PULL_TASK_MAX_ATTEMPTS", 3))
+PULL_RETRY_DELAY_SECONDS = 30
+PULL_POLL_SECONDS = 5
+PULL_MAX_REDRIVES = int(os.getenv("PULL_MAX_REDRIVES", 3))  # Times a dead-lettered keyword is retried
+# Owner of this process's task leases. Set PULL_WORKER_ID to a value that is
+# stable across restarts to resume interrupted tasks without waiting for
+# their leases to expire; it must differ between processes.
+PULL_WORKER_ID = os.getenv("PULL_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+CIRCUIT_PROBE_SECONDS = 30
+
+pull_workers: List[asyncio.Task] = []
+pull_queue_event: Optional[asyncio.Event] = None
+
+def notify_pull_workers():
+    """Wakes idle pull workers after tasks were queued."""
+    if pull_queue_event is not None:
+        pull_queue_event.set()
+
+def start_pull_workers():
+    global pull_queue_event
+    # Tasks leased by a previous run of this process can be resumed right away
+    released = release_pull_task_leases(PULL_WORKER_ID)
+    if released:
+        logging.info(f"Resuming {released} interrupted pull tasks")
+    pull_queue_event = asyncio.Event()
+    for worker_number in range(PULL_WORKERS):
+        pull_workers.append(asyncio.create_task(pull_worker(worker_number)))
+    pull_workers.append(asyncio.create_task(probe_open_circuits()))
+    logging.info(f"Started {PULL_WORKERS} pull workers")
+    # Dead letters are re-driven as soon as a provider recovers
+    for provider in get_serp_provider_pool().providers:
+        provider.breaker.on_close.append(redrive_pull_dead_letters)
+    redrive_pull_dead_letters()
+
+def redrive_pull_dead_letters() -> Optional[int]:
+    """Queues the waiting dead-lettered keywords in a new pull job."""
+    job_id = redrive_dead_letters(PULL_MAX_REDRIVES)
+    if job_id is not None:
+        notify_pull_workers()
+    return job_id
+
+async def probe_open_circuits():
+    """
+    Sends the half-open trial call when every SERP provider circuit is open
+    and dead letters are waiting, as no pull may be running to do so. The
+    SERP of a dead-lettered keyword is used, and cached for its re-drive.
+    """
+    while True:
+        await asyncio.sleep(CIRCUIT_PROBE_SECONDS)
+        breakers = [provider.breaker for provider in get_serp_provider_pool().providers]
+        if any(breaker.state == 'closed' for breaker in breakers) or not any(breaker.available() for breaker in breakers):
+            continue
+        waiting = get_dead_letters('waiting', limit=1)['items']
+        if not waiting or waiting[0]['keyword'] is None:
+            continue
+        keyword = waiting[0]['keyword']
+        try:
+            await get_serp_data_for_request(serp_request_key(keyword), keyword, resolve_serp_cache_max_age())
+        except Exception as e:
+            logging.info(f"SERP provider probe for '{keyword}' failed: {getattr(e, 'detail', None) or e}")
+
+async def stop_pull_workers():
+    for worker in pull_workers:
+        worker.cancel()
+    await asyncio.gather(*pull_workers, return_exceptions=True)
+    pull_workers.clear()
+    release_pull_task_leases(PULL_WORKER_ID)
+
+async def pull_worker(worker_number: int):
+    while True:
+        try:
+            tasks = claim_pull_tasks(PULL_BATCH_SIZE, PULL_TASK_LEASE_SECONDS, PULL_WORKER_ID)
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Pull worker {worker_number} could not claim tasks: {e}")
+            tasks = []
+        if not tasks:
+            pull_queue_event.clear()
+            try:
+                await asyncio.wait_for(pull_queue_event.wait(), PULL_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        # Keywords tracked by several projects are claimed together and share one SERP request
+        groups = defaultdict(list)
+        for task in tasks:
+            if task['keyword'] is None:
+                complete_pull_task(task['id'], PULL_WORKER_ID, 'skipped')
+                if finish_pull_job_if_done(task['job_id']):
+                    on_pull_job_completed(task['job_id'])
+            else:
+                groups[serp_request_key(task['keyword'])].append(task)
+        await asyncio.gather(*[process_pull_group(request_key, group) for request_key, group in groups.items()])
+
+async def process_pull_group(request_key: str, tasks: List[Dict]):
+    max_age_hours = min(
+        resolve_serp_cache_max_age(task['cache_max_age_hours'], task['project_cache_max_age_hours'])
+        for task in tasks
+    )
+    bypass_cache = any(task['bypass_cache'] for task in tasks)
+    # The page must be deep enough for every project tracking the keyword
+    depth = max(serp_depth_for_rank(task['last_rank']) for task in tasks)
+    serp_fetch = asyncio.ensure_future(get_serp_data_for_request(
+        request_key, tasks[0]['keyword'], max_age_hours, bypass_cache, depth=depth,
+        project_domains={task['project_domain'] for task in tasks},
+        job_ids={task['job_id'] for task in tasks}
+    ))
+    if len(tasks) > 1:
+        logging.info(f"Fetching SERP for '{tasks[0]['keyword']}' once for {len(tasks)} tracked keywords")
     try:
-        serp_data = await fetch_serp_data(keyword['keyword'])
-        search_volume = await fetch_search_volume(keyword['keyword'])
-        add_serp_data(keyword['id'], serp_data, search_volume)
-        logging.info(f"Updated rankings for keyword: {keyword['keyword']}")
+        await asyncio.gather(*[process_pull_task(task, serp_fetch) for task in tasks])
+    finally:
+        if not serp_fetch.done():
+            serp_fetch.cancel()
+        elif not serp_fetch.cancelled():
+            serp_fetch.exception()  # Retrieved even if no task got to await it
+
+SERP_CACHE_MAX_AGE_HOURS = float(os.getenv("SERP_CACHE_MAX_AGE_HOURS", 12))
+SERP_CACHE_MAX_BYTES = int(float(os.getenv("SERP_CACHE_MAX_MB", 256)) * 1024 * 1024)
+
+serp_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0}
+
+def resolve_serp_cache_max_age(*max_age_hours: Optional[float]) -> float:
+    """
+    Returns the first max age that is set, from the most to the least
+    specific (e.g. request, then project), or SERP_CACHE_MAX_AGE_HOURS.
+    """
+    return next((hours for hours in max_age_hours if hours is not None), SERP_CACHE_MAX_AGE_HOURS)
+
+SERP_FULL_DEPTH = 100
+SERP_SHALLOW_DEPTHS = (10, 20, 50)
+SERP_DEPTH_MARGIN = int(os.getenv("SERP_DEPTH_MARGIN", 3))  # Positions a keyword may drop before we go deeper
+
+serp_depth_stats = {"shallow_fetches": 0, "escalations": 0, "full_fetches": 0, "latency_saved_ms": 0.0}
+serp_fetch_latency: Dict[int, float] = {}  # Moving average of SpaceSERP latency per depth, in seconds
+
+def serp_depth_for_rank(last_rank: Optional[int]) -> int:
+    """
+    Returns the number of results to request for a keyword last seen at
+    ``last_rank``: the smallest shallow page that still has SERP_DEPTH_MARGIN
+    positions to spare, or the full 100 if it did not rank or was never pulled.
+    """
+    if last_rank is None or last_rank < 1:
+        return SERP_FULL_DEPTH
+    return next((depth for depth in SERP_SHALLOW_DEPTHS if last_rank + SERP_DEPTH_MARGIN <= depth), SERP_FULL_DEPTH)
+
+async def get_serp_data_for_request(request_key: str, keyword: str, max_age_hours: float,
+                                    bypass_cache: bool = False, depth: int = SERP_FULL_DEPTH,
+                                    project_domains=(), job_ids=()) -> Tuple[Dict, int]:
+    """
+    Returns the SERP for a request key, fetched with ``depth`` results. If a
+    shallow page has no result for one of ``project_domains``, the full 100
+    results are fetched instead, so ranks outside the page are never lost.
+    The depth actually fetched is returned along with the SERP, to be
+    stored with the snapshot.
+
+    Args:
+        request_key (str): Normalized keyword plus search settings.
+        keyword (str): Keyword to search for on a cache miss.
+        max_age_hours (float): Oldest cached response that may be reused.
+        bypass_cache (bool): Always fetch from SpaceSERP.
+        depth (int): Results to request, see serp_depth_for_rank().
+        project_domains (Iterable[str]): Domains of the projects tracking the keyword.
+        job_ids (Iterable[int]): Pull jobs to credit with the depth stats.
+    """
+    serp_data, fetched_depth, fetch_seconds = await get_serp_page(request_key, keyword, max_age_hours, bypass_cache, depth)
+    if fetched_depth >= SERP_FULL_DEPTH:
+        return serp_data, fetched_depth
+
+    domains = [extract_domain('http://' + (domain or '')) for domain in project_domains]
+    escalated = 'organic_results' in serp_data and any(find_serp_rank(serp_data, domain) == -1 for domain in domains)
+    if escalated:
+        logging.info(f"Tracked domain not in the top {depth} for '{keyword}', fetching the top {SERP_FULL_DEPTH}")
+        serp_data, fetched_depth, _ = await get_serp_page(request_key, keyword, max_age_hours, bypass_cache, SERP_FULL_DEPTH)
+
+    if fetch_seconds is not None:
+        # A shallow page that had to be escalated is pure overhead; one that
+        # was enough saved the difference with an average full fetch.
+        full_seconds = serp_fetch_latency.get(SERP_FULL_DEPTH)
+        if escalated:
+            saved_ms = -fetch_seconds * 1000
+        elif full_seconds is not None:
+            saved_ms = (full_seconds - fetch_seconds) * 1000
+        else:
+            saved_ms = 0.0
+        serp_depth_stats["shallow_fetches"] += 1
+        serp_depth_stats["escalations"] += int(escalated)
+        serp_depth_stats["latency_saved_ms"] += saved_ms
+        if job_ids:
+            record_pull_job_depth_stats(list(job_ids), 1, int(escalated), saved_ms)
+    return serp_data, fetched_depth
+
+async def get_serp_page(request_key: str, keyword: str, max_age_hours: float, bypass_cache: bool,
+                        depth: int) -> Tuple[Dict, int, Optional[float]]:
+    """
+    Returns the SERP for a request key from the SERP cache if a response
+    younger than ``max_age_hours`` and at least ``depth`` results deep
+    exists, otherwise fetches and caches it.
+
+    Returns:
+        Tuple[Dict, int, Optional[float]]: The SERP, the depth it was fetched
+        with, which may exceed ``depth`` for a cached response, and how long
+        SpaceSERP took to answer in seconds, or None if it came from the cache.
+    """
+    if bypass_cache or max_age_hours <= 0:
+        serp_cache_stats["bypassed"] += 1
+    else:
+        cached = await asyncio.get_running_loop().run_in_executor(
+            None, get_cached_serp, request_key, max_age_hours * 3600, depth
+        )
+        if cached is not None:
+            serp_cache_stats["hits"] += 1
+            logging.info(f"Using cached SERP for '{keyword}'")
+            return cached[0], cached[1], None
+        serp_cache_stats["misses"] += 1
+    started = time.monotonic()
+    serp_data = await fetch_serp_data(keyword, depth)
+    fetch_seconds = time.monotonic() - started
+    if depth >= SERP_FULL_DEPTH:
+        serp_depth_stats["full_fetches"] += 1
+    # Error payloads have no organic_results and are not worth keeping
+    if 'organic_results' in serp_data:
+        previous = serp_fetch_latency.get(depth)
+        serp_fetch_latency[depth] = fetch_seconds if previous is None else previous * 0.9 + fetch_seconds * 0.1
+        await asyncio.get_running_loop().run_in_executor(
+            None, put_cached_serp, request_key, serp_data, SERP_CACHE_MAX_BYTES, depth, SERP_CACHE_MAX_AGE_HOURS * 3600
+        )
+    return serp_data, depth, fetch_seconds
+
+async def process_pull_task(task: Dict, serp_fetch: asyncio.Future):
+    try:
+        status = await run_pull_task(task, serp_fetch)
+        if complete_pull_task(task['id'], PULL_WORKER_ID, status) and status == 'done':
+            resolve_dead_letter(task['keyword_id'])
     except Exception as e:
-        logging.error(f"Error updating rankings for keyword {keyword['keyword']}: {e}")
+        error = getattr(e, 'detail', None) or str(e) or type(e).__name__
+        # With every provider's circuit open, retrying only waits out the
+        # outage; the keyword is dead-lettered and re-driven once it is over.
+        circuit_open = isinstance(e, HTTPException) and e.status_code == 503
+        if not circuit_open and task['attempts'] < PULL_TASK_MAX_ATTEMPTS:
+            if retry_pull_task(task['id'], PULL_WORKER_ID, error, PULL_RETRY_DELAY_SECONDS * 2 ** (task['attempts'] - 1)):
+                logging.warning(f"Pull task {task['id']} for keyword_id {task['keyword_id']} failed, will retry: {error}")
+        elif complete_pull_task(task['id'], PULL_WORKER_ID, 'failed', error):
+            add_dead_letter(task['keyword_id'], task['job_id'], task['id'], error)
+            logging.error(f"Pull task {task['id']} for keyword_id {task['keyword_id']} dead-lettered: {error}")
+    if finish_pull_job_if_done(task['job_id']):
+        on_pull_job_completed(task['job_id'])
+
+async def run_pull_task(task: Dict, serp_fetch: asyncio.Future) -> str:
+    """
+    Stores the rankings of one keyword of a pull job from the SERP fetched
+    for its request key, along with its stored search volume.
+
+    Returns:
+        str: The final task status, 'done' or 'skipped' if the keyword is gone.
+    """
+    conn = get_db_connection()
+    keyword = conn.execute("SELECT * FROM keywords WHERE id = ?", (task['keyword_id'],)).fetchone()
+    conn.close()
+    if not keyword:
+        return 'skipped'
+    keyword = dict(keyword)
+
+    logging.info(f"Updating rankings for keyword: {keyword['keyword']}")
+    # Shielded as the other keywords of the group await the same fetch
+    serp_data, depth = await asyncio.shield(serp_fetch)
+    # Volumes are kept fresh by refresh_search_volumes(), off the pull's critical path
+    search_volume = keyword['search_volume']
+    if search_volume is None:
+        search_volume = get_cached_volumes([keyword['keyword']]).get(keyword['keyword'])
+    await add_serp_data(keyword['id'], serp_data, search_volume, depth)
+    logging.info(f"Updated rankings for keyword: {keyword['keyword']}")
+    return 'done'
+
+def on_pull_job_completed(job_id: int):
+    conn = get_db_connection()
+    project_ids = [row[0] for row in conn.execute('''
+        SELECT DISTINCT k.project_id FROM pull_tasks t
+        JOIN keywords k ON k.id = t.keyword_id
+        WHERE t.job_id = ?
+    ''', (job_id,))]
+    conn.close()
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    for project_id in project_ids:
+        update_sov_daily(project_id, today)
+    logging.info(f"Pull job {job_id} finished")
+
+def build_pull_job_status(job: Dict) -> Dict:
+    """
+    Turns a pull job and its task counts into the progress report of /api/jobs.
+    Throughput is measured since the first task was claimed.
+    """
+    tasks = job['tasks']
+    finished = tasks.get('done', 0) + tasks.get('failed', 0) + tasks.get('skipped', 0)
+    remaining = tasks.get('pending', 0) + tasks.get('running', 0)
+
+    keywords_per_minute = None
+    eta_seconds = None
+    if job['started_at'] and finished:
+        end = datetime.fromisoformat(job['finished_at']) if job['finished_at'] else datetime.now(timezone.utc)
+        elapsed = (end - datetime.fromisoformat(job['started_at'])).total_seconds()
+        if elapsed > 0:
+            keywords_per_minute = round(finished / elapsed * 60, 2)
+            if job['status'] in ('pending', 'running'):
+                eta_seconds = round(remaining / (finished / elapsed))
+
+    return {
+        "id": job['id'],
+        "project_id": job['project_id'],
+        "tag_id": job['tag_id'],
+        "kind": job['kind'],
+        "status": job['status'],
+        "created_at": job['created_at'],
+        "started_at": job['started_at'],
+        "finished_at": job['finished_at'],
+        "total": job['total_tasks'],
+        "done": tasks.get('done', 0),
+        "failed": tasks.get('failed', 0),
+        "skipped": tasks.get('skipped', 0),
+        "cancelled": tasks.get('cancelled', 0),
+        "pending": remaining,
+        "keywords_per_minute": keywords_per_minute,
+        "eta_seconds": eta_seconds,
+        "serp_depth": {
+            "shallow_fetches": job['shallow_fetches'],
+            "escalations": job['depth_escalations'],
+            "latency_saved_ms": round(job['depth_latency_saved_ms'])
+        }
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: int):
+    job = get_pull_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return build_pull_job_status(job)
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: int):
+    if not get_pull_job(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    if not cancel_pull_job(job_id):
+        raise HTTPException(status_code=409, detail="Job has already finished")
+    logging.info(f"Pull job {job_id} cancelled")
+    # Keywords pulled before the cancellation count towards today's share of voice
+    on_pull_job_completed(job_id)
+    return build_pull_job_status(get_pull_job(job_id))
 
 def initialize_scheduled_pulls():
     conn = get_db_connection()
@@ -591,116 +878,21 @@ async def fetch_serp_data_for_project(project_id: int, request: SerpDataRequest)
     serp_data = []
     for keyword in keywords:
         keyword_serp_data = await fetch_serp_data(keyword['keyword'])
-        search_volume = await fetch_search_volume(keyword['keyword'])
-        add_serp_data(keyword['id'], keyword_serp_data, search_volume)
+        search_volume = await get_search_volume(keyword['keyword'])
+        if search_volume is None:
+            search_volume = keyword['search_volume']
+        await add_serp_data(keyword['id'], keyword_serp_data, search_volume)
         serp_data.append({
             "keyword": keyword['keyword'],
             "serp_data": keyword_serp_data,
             "search_volume": search_volume
         })
+    update_sov_daily(project_id, datetime.now(timezone.utc).strftime('%Y-%m-%d'))
     
     return serp_data
 
-def extrapolate_ctr(avg_ctr_per_position):
-    import numpy as np
-    positions = np.array([pos for pos, ctr in avg_ctr_per_position.items() if ctr > 0])
-    ctr_values = np.array([ctr for ctr in avg_ctr_per_position.values() if ctr > 0])
-
-    if len(positions) < 2:
-        logging.warning("Not enough data points for extrapolation. Skipping extrapolation.")
-        return
-
-    # Fit a logarithmic model: CTR = a * ln(Position) + b
-    try:
-        params = np.polyfit(np.log(positions), ctr_values, 1)
-        a, b = params
-        # Extrapolate for positions 1 to 100
-        for position in range(1, 101):
-            if position not in avg_ctr_per_position:
-                avg_ctr = a * np.log(position) + b
-                # Ensure CTR is not negative
-                avg_ctr_per_position[position] = max(avg_ctr, 0.0)
-    except Exception as e:
-        logging.error(f"Error in CTR extrapolation: {e}")
-        # Fallback to standard CTR curve or default value
-        pass
-
-def fetch_gsc_data_for_domain(project_id, start_date, end_date):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.row_factory = sqlite3.Row  # Return rows as dictionaries
-
-    # Fetch the project to get branded terms
-    c.execute('SELECT * FROM projects WHERE id = ?', (project_id,))
-    project_row = c.fetchone()
-    if not project_row:
-        conn.close()
-        raise Exception("Project not found")
-
-    project = dict(project_row)
-
-    # Ensure branded_terms is a list of non-empty strings
-    branded_terms_raw = project.get('branded_terms') or ''
-    branded_terms = [term.strip() for term in branded_terms_raw.split(',') if term.strip()]
-    logging.info(f"Branded Terms: {branded_terms}")
-
-    # Fetch GSC data for the project's keywords
-    c.execute('''
-        SELECT * FROM gsc_data
-        WHERE date BETWEEN ? AND ?
-        AND keyword_id IN (SELECT id FROM keywords WHERE project_id = ?)
-    ''', (start_date, end_date, project_id))
-
-    gsc_data_rows = c.fetchall()
-    conn.close()
-
-    # Exclude queries containing branded terms
-    non_branded_gsc_data = []
-    for row in gsc_data_rows:
-        data = dict(row)
-        query = data.get('query') or ''
-        query_lower = query.lower()
-        logging.info(f"Processing query: {query_lower}")
-        if not any(branded_term.lower() in query_lower for branded_term in branded_terms):
-            non_branded_gsc_data.append(data)
-
-    return non_branded_gsc_data
-
-def compute_avg_ctr_per_position(gsc_data):
-    position_data = {}
-    for data in gsc_data:
-        position = int(float(data['position']))
-        if position > 100 or position < 1:
-            continue
-        position_str = str(position)
-        if position_str not in position_data:
-            position_data[position_str] = {'clicks': 0, 'impressions': 0}
-        position_data[position_str]['clicks'] += data.get('clicks', 0)
-        position_data[position_str]['impressions'] += data.get('impressions', 0)
-
-    avg_ctr_per_position = {}
-    for position_str in position_data:
-        clicks = position_data[position_str]['clicks']
-        impressions = position_data[position_str]['impressions']
-        if impressions > 0:
-            avg_ctr = clicks / impressions
-            avg_ctr_per_position[position_str] = avg_ctr
-        else:
-            pass  # Do not assign zero CTR here
-
-    # Extrapolate missing CTRs
-    extrapolate_ctr(avg_ctr_per_position)
-
-    # Incorporate standard CTR values
-    for position in range(1, 101):
-        position_str = str(position)
-        if position_str not in avg_ctr_per_position or avg_ctr_per_position[position_str] == 0.0:
-            avg_ctr_per_position[position_str] = standard_ctr_curve.get(position, 0.01)
-
-    return avg_ctr_per_position
-
 def get_cached_avg_ctr_per_position(project_id: int) -> Optional[Dict]:
-    cache_entry = get_ctr_cache(project_id)
+    cache_entry = get_cached_ctr_entry(project_id)
     now = datetime.now(timezone.utc)
     
     if cache_entry:
@@ -720,26 +912,25 @@ def get_cached_avg_ctr_per_position(project_id: int) -> Optional[Dict]:
     logging.info(f"Recalculated and cached avg_ctr_per_position for project {project_id}")
     return avg_ctr_per_position
 
-def calculate_and_cache_avg_ctr_per_position(project_id: int) -> Tuple[Dict, str, str]:
-    # Define fixed date range: last 90 days from yesterday
-    end_date = datetime.now(timezone.utc).date() - timedelta(days=1)  # Exclude today
-    start_date = end_date - timedelta(days=89)  # Total of 90 days
-
-    # Fetch GSC data for the domain
-    gsc_data = fetch_gsc_data_for_domain(project_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
-    avg_ctr_per_position = compute_avg_ctr_per_position(gsc_data)
-
-    return avg_ctr_per_position, start_date.isoformat(), end_date.isoformat()
-
 @app.on_event("startup")
 async def startup_event():
     try:
         init_db()  # Initialize the database using database.py's init_db()
         logging.info("Database initialized successfully.")
+        await start_http_session()
+        start_pull_workers()
+        scheduler.add_job(refresh_search_volumes, 'interval', seconds=VOLUME_REFRESH_INTERVAL_SECONDS,
+                          id='volume_refresh', replace_existing=True, coalesce=True, max_instances=1)
     except Exception as e:
         logging.error(f"Failed to initialize database: {e}")
         raise e
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_pull_workers()
+    await close_serp_writer()
+    await close_http_session()
+
 @app.get("/api/gsc/oauth2callback")
 async def gsc_oauth2callback(state: str, code: str):
     try:
@@ -913,32 +1104,6 @@ async def delete_scheduled_pull(pull_id: int):
         logging.error(f"Error deleting scheduled pull {pull_id}: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
-async def update_search_volume(keyword_id, keyword):
-    conn = sqlite3.connect('seo_rank_tracker.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT search_volume, last_volume_update FROM keywords WHERE id = ?", (keyword_id,))
-    result = c.fetchone()
-    search_volume, last_update = result if result else (None, None)
-    
-    current_time = datetime.now(timezone.utc)
-    should_update = (
-        search_volume is None or 
-        last_update is None or 
-        (current_time - datetime.fromisoformat(last_update).replace(tzinfo=timezone.utc)).days > 30
-    )
-    
-    if should_update:
-        volume = await fetch_search_volume(keyword)
-        c.execute("UPDATE keywords SET search_volume = ?, last_volume_update = ? WHERE id = ?", 
-                    (volume, current_time.isoformat(), keyword_id))
-        conn.commit()
-        logging.info(f"Updated search volume for keyword '{keyword}' (ID: {keyword_id}): {volume}")
-    else:
-        logging.info(f"Skipped updating search volume for keyword '{keyword}' (ID: {keyword_id}): last update was less than 30 days ago")
-    
-    conn.close()
-
 csrf_tokens = {}
 
 @app.get("/api/gsc/auth")
@@ -982,7 +1147,7 @@ async def get_gsc_domains(project_id: int):
         
         service = build('webmasters', 'v3', credentials=credentials)
         
-        sites = service.sites().list().execute()
+        sites = await execute_gsc_request(service.sites().list())
         domains = [site['siteUrl'] for site in sites.get('siteEntry', [])]
         
         return {"domains": domains}
@@ -1007,44 +1172,25 @@ async def create_gsc_domain(domain: GSCDomain):
         logging.error(f"Unexpected error in create_gsc_domain: {e}")
         raise HTTPException(status_code=500, detail="Internal server error.")
         
-async def fetch_gsc_data_for_project(project_id, request: Optional[SerpDataRequest] = None):
-    logging.info(f"Fetching GSC data for project_id: {project_id}")
+GSC_ROW_LIMIT = 25000  # Most rows Search Analytics returns per request
+GSC_SYNC_DAYS = 7  # Window synced along with a project's rank pull
 
-    # Get the GSC domain for this project
+def get_gsc_service_for_project(project_id: int):
+    """
+    Returns the Search Console service and property URL of a project, or
+    (None, None) if it has no GSC domain or credentials.
+    """
     conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT domain FROM gsc_domains WHERE project_id = ?", (project_id,))
-    domain_result = c.fetchone()
-
-    if not domain_result:
-        logging.warning(f"No GSC domain found for project_id: {project_id}")
-        return
-
-    domain = domain_result[0]
-
-    # Use the date range from the request, or default to last 7 days
-    end_date = datetime.now(timezone.utc).date()
-    start_date = end_date - timedelta(days=90)
-    if request and hasattr(request, 'start_date') and hasattr(request, 'end_date'):
-        start_date = datetime.strptime(request.start_date, "%Y-%m-%d").date()
-        end_date = datetime.strptime(request.end_date, "%Y-%m-%d").date()
-
-    logging.info(f"Fetching GSC data for domain: {domain}, start_date: {start_date}, end_date: {end_date}")
-
-    # Get the keywords being tracked
-    c.execute("SELECT id, keyword FROM keywords WHERE project_id = ?", (project_id,))
-    keywords = c.fetchall()
+    result = conn.execute("SELECT domain FROM gsc_domains WHERE project_id = ?", (project_id,)).fetchone()
     conn.close()
+    if not result:
+        logging.warning(f"No GSC domain found for project_id: {project_id}")
+        return None, None
 
-    if not keywords:
-        logging.info(f"No keywords found for project_id: {project_id}")
-        return
-
-    # Prepare the credentials and GSC service
     credentials_json = get_gsc_credentials_from_db(project_id)
     if not credentials_json:
         logging.error(f"No GSC credentials found for project_id: {project_id}")
-        return
+        return None, None
 
     credentials = Credentials.from_authorized_user_info(json.loads(credentials_json), SCOPES)
     if credentials.expired and credentials.refresh_token:
@@ -1052,50 +1198,104 @@ async def fetch_gsc_data_for_project(project_id, request: Optional[SerpDataReque
         # Save the refreshed credentials back to the database
         update_gsc_credentials_in_db(project_id, credentials.to_json())
 
-    service = build('webmasters', 'v3', credentials=credentials)
-    site_url = domain
+    return build('webmasters', 'v3', credentials=credentials), result[0]
 
-    # Fetch GSC data for each keyword
-    for keyword_row in keywords:
-        keyword_id = keyword_row['id']
-        keyword = keyword_row['keyword']
+async def sync_gsc_data_for_project(project_id: int, start_date, end_date) -> int:
+    """
+    Pulls every date/query/page row of the project's Search Console property
+    in pages of GSC_ROW_LIMIT rows, and stores the rows whose query matches
+    one of the project's keywords. One call per page replaces one call per
+    keyword.
+
+    Args:
+        project_id (int): The project to sync.
+        start_date (date): First day to sync.
+        end_date (date): Last day to sync.
 
-        # Fetch data for the keyword
+    Returns:
+        int: The number of rows stored.
+    """
+    conn = get_db_connection()
+    keywords = conn.execute("SELECT id, keyword FROM keywords WHERE project_id = ?", (project_id,)).fetchall()
+    conn.close()
+    if not keywords:
+        logging.info(f"No keywords found for project_id: {project_id}")
+        return 0
+
+    # GSC reports queries lowercased; match them on the normalized keyword
+    keyword_index = defaultdict(list)
+    for keyword in keywords:
+        keyword_index[normalize_keyword(keyword['keyword'])].append(keyword['id'])
+
+    service, site_url = get_gsc_service_for_project(project_id)
+    if service is None:
+        return 0
+
+    logging.info(f"Syncing GSC data for {site_url} from {start_date} to {end_date}")
+    start_row = 0
+    pages = 0
+    stored = 0
+    while True:
         body = {
             'startDate': start_date.strftime("%Y-%m-%d"),
             'endDate': end_date.strftime("%Y-%m-%d"),
             'dimensions': ['date', 'query', 'page'],
-            'dimensionFilterGroups': [{
-                'filters': [{
-                    'dimension': 'query',
-                    'operator': 'equals',
-                    'expression': keyword
-                }]
-            }],
-            'rowLimit': 25000
+            'rowLimit': GSC_ROW_LIMIT,
+            'startRow': start_row
         }
+        response = await execute_gsc_query(service, site_url, body)
+        rows = response.get('rows', [])
+        pages += 1
+        matched = []
+        for row in rows:
+            keys = row.get('keys', [])
+            date = keys[0] if len(keys) > 0 else ''
+            query_value = keys[1] if len(keys) > 1 else ''
+            page = keys[2] if len(keys) > 2 else ''
+            for keyword_id in keyword_index.get(normalize_keyword(query_value), ()):
+                matched.append((keyword_id, date, row.get('clicks', 0), row.get('impressions', 0),
+                                row.get('ctr', 0), row.get('position', 0), query_value, page))
+        # One upsert transaction per page, off the event loop
+        stored += await asyncio.get_running_loop().run_in_executor(None, upsert_gsc_data, matched)
+        if len(rows) < GSC_ROW_LIMIT:
+            break
+        start_row += GSC_ROW_LIMIT
 
-        try:
-            response = service.searchanalytics().query(siteUrl=site_url, body=body).execute()
-            if 'rows' in response:
-                for row in response['rows']:
-                    keys = row.get('keys', [])
-                    date = keys[0] if len(keys) > 0 else ''
-                    query_value = keys[1] if len(keys) > 1 else ''
-                    page = keys[2] if len(keys) > 2 else ''
-                    clicks = row.get('clicks', 0)
-                    impressions = row.get('impressions', 0)
-                    ctr = row.get('ctr', 0)
-                    position = row.get('position', 0)
-                    # Store the data in the database
-                    add_gsc_data_by_keyword_id(keyword_id, date, clicks, impressions, ctr, position, query_value, page)
-            else:
-                logging.info(f"No GSC data for keyword: {keyword}")
-        except Exception as e:
-            logging.error(f"Error fetching GSC data for keyword '{keyword}': {str(e)}")
-            continue
+    invalidate_ctr_curve(project_id)
+    logging.info(f"Stored {stored} GSC rows for project_id {project_id} from {pages} pages")
+    return stored
 
-    logging.info(f"GSC data fetched and stored successfully for project_id: {project_id}")
+async def sync_recent_gsc_data(project_id: int):
+    """Syncs the last GSC_SYNC_DAYS of GSC data; run in the background of a rank pull."""
+    end_date = datetime.now(timezone.utc).date()
+    try:
+        await sync_gsc_data_for_project(project_id, end_date - timedelta(days=GSC_SYNC_DAYS), end_date)
+    except Exception as e:
+        logging.error(f"Error syncing GSC data for project_id {project_id}: {e}")
+
+@app.post("/api/gsc/sync/{project_id}", status_code=202)
+async def sync_gsc_data_endpoint(project_id: int, background_tasks: BackgroundTasks,
+                                 start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD"),
+                                 end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD")):
+    try:
+        end = datetime.strptime(end_date, "%Y-%m-%d").date() if end_date else datetime.now(timezone.utc).date()
+        start = datetime.strptime(start_date, "%Y-%m-%d").date() if start_date else end - timedelta(days=90)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD.")
+    if start > end:
+        raise HTTPException(status_code=400, detail="start_date must not be after end_date")
+
+    # Checked up front, as the background sync can only log these
+    conn = get_db_connection()
+    gsc_domain = conn.execute("SELECT 1 FROM gsc_domains WHERE project_id = ?", (project_id,)).fetchone()
+    conn.close()
+    if not gsc_domain:
+        raise HTTPException(status_code=404, detail="No GSC domain found for this project")
+    if not get_gsc_credentials_from_db(project_id):
+        raise HTTPException(status_code=404, detail="No GSC credentials found for this project")
+
+    background_tasks.add_task(sync_gsc_data_for_project, project_id, start, end)
+    return {"message": f"Syncing GSC data for project {project_id} from {start} to {end}"}
 
 @app.get("/api/gsc/data")
 async def get_gsc_data_endpoint(domain_id: int, start_date: str, end_date: str):
@@ -1116,7 +1316,8 @@ async def get_projects():
 async def create_project(project: ProjectBase):
     user_id = 1  # Use a placeholder user ID for now
     project_id = add_project(project.name, project.domain, project.branded_terms, 
-                             project.conversion_rate, project.conversion_value, user_id)
+                             project.conversion_rate, project.conversion_value, user_id,
+                             project.serp_cache_max_age_hours)
     return {"id": project_id, "user_id": user_id, **project.dict()}
 
 @app.get("/api/projects/{project_id}/keywords")
@@ -1138,41 +1339,30 @@ async def create_keyword(project_id: int, keyword: KeywordBase):
     conn.close()
     return {"id": keyword_id, "project_id": project_id, **keyword.dict()}
 
-CONCURRENT_REQUESTS = 3  # Adjust this number based on API limits and your server capacity
-
-@app.post("/api/fetch-serp-data/{project_id}")
-async def fetch_serp_data_endpoint(project_id: int, request: SerpDataRequest = Body(None)):
+@app.post("/api/fetch-serp-data/{project_id}", status_code=202)
+async def fetch_serp_data_endpoint(project_id: int, background_tasks: BackgroundTasks, request: SerpDataRequest = Body(None)):
     tag_id = request.tag_id if request else None
     keywords = await get_keywords(project_id, tag_id)
     active_keywords = [kw for kw in keywords if kw['active']]
 
-    semaphore = Semaphore(CONCURRENT_REQUESTS)
-
-    async def fetch_and_store(keyword):
-        async with semaphore:
-            serp_data = await fetch_serp_data(keyword['keyword'])
-            # Fetch GSC data for the keyword and store it
-            try:
-                logging.info(f"Fetching GSC data for keyword: {keyword['keyword']}")
-                await fetch_gsc_data_for_keyword(project_id, keyword)
-                logging.info(f"GSC data fetched for keyword: {keyword['keyword']}")
-            except Exception as e:
-                logging.error(f"Error fetching GSC data for keyword {keyword['keyword']}: {e}")
-            # Update search volume if needed
-            await update_search_volume_if_needed(keyword)
-            add_serp_data(keyword['id'], serp_data, keyword['search_volume'])
-
-    tasks = [fetch_and_store(keyword) for keyword in active_keywords]
-    await asyncio.gather(*tasks)
+    job_id = create_pull_job(
+        'project', [keyword['id'] for keyword in active_keywords], project_id=project_id, tag_id=tag_id,
+        cache_max_age_hours=request.max_cache_age_hours if request else None,
+        bypass_cache=request.bypass_cache if request else False
+    )
+    notify_pull_workers()
+    # GSC data is synced for the whole property at once rather than per keyword
+    background_tasks.add_task(sync_recent_gsc_data, project_id)
 
-    return {"message": f"SERP and GSC data fetched and stored successfully for {len(active_keywords)} keywords"}
+    return {"message": f"Queued SERP and GSC fetch for {len(active_keywords)} keywords", "job_id": job_id}
 
 @app.get("/api/gsc-data")
 async def get_gsc_data(
     project_id: Optional[int] = Query(None, description="Filter by Project ID"),
     domain_id: Optional[int] = Query(None, description="Filter by Domain ID"),
     start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD"),
-    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD")
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD"),
+    accept: Optional[str] = Header(None)
 ):
     if not project_id and not domain_id:
         raise HTTPException(status_code=400, detail="Either project_id or domain_id must be provided.")
@@ -1183,6 +1373,11 @@ async def get_gsc_data(
     if not end_date:
         end_date = datetime.now().strftime('%Y-%m-%d')
     
+    if wants_ndjson(accept):
+        if project_id:
+            return ndjson_response(iter_gsc_data_by_project(project_id, start_date, end_date))
+        return ndjson_response(iter_gsc_data_by_domain(domain_id, start_date, end_date))
+
     try:
         if project_id:
             data = get_gsc_data_by_project(project_id, start_date, end_date)
@@ -1194,16 +1389,17 @@ async def get_gsc_data(
         logging.error(f"Error fetching GSC data: {e}")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
-@app.post("/api/fetch-serp-data-by-tag/{tag_id}")
-async def fetch_and_store_serp_data_by_tag(tag_id: int):
+@app.post("/api/fetch-serp-data-by-tag/{tag_id}", status_code=202)
+async def fetch_and_store_serp_data_by_tag(tag_id: int, request: SerpDataRequest = Body(None)):
     keywords = await get_keywords_by_tag(tag_id)
-    for keyword in keywords:
-        if keyword['active']:
-            serp_data = await fetch_serp_data(keyword['keyword'])
-            # Fetch the search volume for the keyword
-            search_volume = await fetch_search_volume(keyword['keyword'])
-            add_serp_data(keyword['id'], serp_data, search_volume)
-    return {"message": "SERP data fetched and stored successfully for active keywords with the specified tag"}
+    keyword_ids = [keyword['id'] for keyword in keywords if keyword['active']]
+    job_id = create_pull_job(
+        'tag', keyword_ids, tag_id=tag_id,
+        cache_max_age_hours=request.max_cache_age_hours if request else None,
+        bypass_cache=request.bypass_cache if request else False
+    )
+    notify_pull_workers()
+    return {"message": f"Queued SERP fetch for {len(keyword_ids)} active keywords with the specified tag", "job_id": job_id}
 
 async def get_keywords(project_id: int, tag_id: Optional[int] = None):
     conn = get_db_connection()
@@ -1232,68 +1428,111 @@ async def get_keywords_by_tag(tag_id: int):
     conn.close()
     return [dict(zip(['id', 'project_id', 'keyword', 'active', 'search_volume', 'last_volume_update'], keyword)) for keyword in keywords]
 
-@app.get("/api/rankData")
-def get_rank_data():
+def build_rank_data_entry(item) -> Dict:
+    """
+    Builds one /api/rankData entry from a row of get_rank_data_rows().
+
+    Args:
+        item (sqlite3.Row): Rank row including the joined gsc_* columns.
+
+    Returns:
+        Dict: The rank data entry.
+    """
+    estimated_business_impact = estimate_business_impact(
+        item['rank'], item['search_volume'], get_ctr_curve_array(item['project_id']),
+        item['conversion_rate'], item['conversion_value'])
+
+    if item['gsc_date'] is None:
+        gsc_data_for_date = {}
+        data_source_date = None
+    else:
+        gsc_data_for_date = {
+            'position': item['gsc_position'],
+            'clicks': item['gsc_clicks'],
+            'impressions': item['gsc_impressions'],
+            'ctr': item['gsc_ctr']
+        }
+        data_source_date = item['gsc_date']
+        if item['gsc_date'] == item['date']:
+            # Query and page are only reported for same-day GSC data
+            gsc_data_for_date['query'] = item['gsc_query']
+            gsc_data_for_date['page'] = item['gsc_page']
+
+    return {
+        'id': item['id'],
+        'date': item['date'],
+        'keyword': item['keyword'],
+        'domain': item['domain'],
+        'rank': item['rank'],
+        'keyword_id': item['keyword_id'],
+        'project_id': item['project_id'],
+        'search_volume': item['search_volume'],
+        'estimated_business_impact': estimated_business_impact,
+        'gscDataForDate': gsc_data_for_date,
+        'dataSourceDate': data_source_date
+    }
+
+def encode_rank_data_cursor(date: str, serp_data_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([date, serp_data_id]).encode()).decode()
+
+def decode_rank_data_cursor(cursor: str) -> Tuple[str, int]:
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''
-            SELECT s.id, s.date, k.keyword, p.domain, s.rank, k.id as keyword_id, 
-                   p.id as project_id, s.search_volume, p.conversion_rate, p.conversion_value
-            FROM serp_data s
-            JOIN keywords k ON s.keyword_id = k.id
-            JOIN projects p ON k.project_id = p.id
-        ''')
-        rank_data_rows = c.fetchall()
-        conn.close()
+        date, serp_data_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(date), int(serp_data_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-        processed_data = []
-        for item in rank_data_rows:
-            # Calculate estimated_business_impact
-            conversion_rate = item['conversion_rate'] or 0.0
-            conversion_value = item['conversion_value'] or 0.0
-            avg_ctr = get_avg_ctr_for_project_rank(item['project_id'], item['rank'])  # Ensure this returns a float
+@app.get("/api/rankData")
+def get_rank_data(
+    project_id: Optional[int] = Query(None, description="Filter by Project ID"),
+    tag_id: Optional[int] = Query(None, description="Filter by Tag ID"),
+    start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD"),
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD"),
+    keyword_prefix: Optional[str] = Query(None, description="Only keywords starting with this prefix"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=5000, description="Page size; omit to return all rows"),
+    accept: Optional[str] = Header(None)
+):
+    try:
+        after = decode_rank_data_cursor(cursor) if cursor else None
+
+
+        if wants_ndjson(accept):
+            # One entry per line; filters, cursor and limit apply but no next_cursor is emitted
+            rows = iter_rank_data_rows(
+                project_id=project_id,
+                tag_id=tag_id,
+                start_date=start_date,
+                end_date=end_date,
+                keyword_prefix=keyword_prefix,
+                after=after,
+                limit=limit
+            )
+            return ndjson_response(build_rank_data_entry(item) for item in rows)
+
+        # Fetch one extra row to know whether another page follows
+        rank_data_rows = get_rank_data_rows(
+            project_id=project_id,
+            tag_id=tag_id,
+            start_date=start_date,
+            end_date=end_date,
+            keyword_prefix=keyword_prefix,
+            after=after,
+            limit=limit + 1 if limit else None
+        )
 
-            if item['search_volume'] is not None and avg_ctr is not None:
-                estimated_traffic = avg_ctr * item['search_volume']
-                estimated_business_impact = estimated_traffic * conversion_rate * conversion_value
-            else:
-                estimated_business_impact = 0.0  # Default value
+        next_cursor = None
+        if limit and len(rank_data_rows) > limit:
+            rank_data_rows = rank_data_rows[:limit]
+            last_row = rank_data_rows[-1]
+            next_cursor = encode_rank_data_cursor(last_row['date'], last_row['id'])
 
-            # Fetch GSC data for the keyword and date
-            gsc_data = get_gsc_data_for_keyword_and_date(item['keyword_id'], item['date'])
+        processed_data = [build_rank_data_entry(item) for item in rank_data_rows]
 
-            if gsc_data:
-                # Use current GSC data
-                gsc_data_for_date = gsc_data['gscDataForDate']
-                data_source_date = item['date']
-            else:
-                # Fetch the last available GSC data
-                last_gsc_data = get_last_available_gsc_data(item['keyword_id'], item['date'])
-                if last_gsc_data and 'gscDataForDate' in last_gsc_data:
-                    gsc_data_for_date = last_gsc_data['gscDataForDate']
-                    data_source_date = last_gsc_data['date']
-                else:
-                    gsc_data_for_date = {}
-                    data_source_date = None
-                    logging.warning(f"'gscDataForDate' is missing for keyword_id={item['keyword_id']}, date={item['date']}")
-
-            processed_data.append({
-                'id': item['id'],
-                'date': item['date'],
-                'keyword': item['keyword'],
-                'domain': item['domain'],
-                'rank': item['rank'],
-                'keyword_id': item['keyword_id'],
-                'project_id': item['project_id'],
-                'search_volume': item['search_volume'],
-                'estimated_business_impact': estimated_business_impact,
-                'gscDataForDate': gsc_data_for_date,
-                'dataSourceDate': data_source_date
-            })
-
-        return {"data": processed_data}
+        return {"data": processed_data, "next_cursor": next_cursor}
 
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logging.error(f"Error in get_rank_data: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -1363,6 +1602,17 @@ def get_last_available_gsc_data(keyword_id: int, current_date: str) -> Optional[
         logging.error(f"Error in get_last_available_gsc_data: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred while retrieving last available GSC data.")
 
+@app.get("/api/rankData/latest")
+def get_latest_rank_data(
+    project_id: Optional[int] = Query(None, description="Filter by Project ID"),
+    tag_id: Optional[int] = Query(None, description="Filter by Tag ID")
+):
+    try:
+        return {"data": get_keyword_rank_latest(project_id, tag_id)}
+    except Exception as e:
+        logging.error(f"Error in get_latest_rank_data: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.get("/api/serp-data/{serp_data_id}")
 async def get_full_serp_data(serp_data_id: int):
     if serp_data_id is None:
@@ -1376,16 +1626,25 @@ async def get_full_serp_data(serp_data_id: int):
             "keyword_id": serp_data['keyword_id'],
             "date": serp_data['date'],
             "rank": serp_data['rank'],
-            "full_data": json.loads(serp_data['full_data'])
+            # Results the snapshot was fetched with; ranks below it are unknown
+            "depth": serp_data['depth'] or SERP_FULL_DEPTH,
+            "full_data": decode_full_data(serp_data['full_data'])
         }
         print("Returning SERP data:", result)
         return result
     raise HTTPException(status_code=404, detail="SERP data not found")
 
 @app.post("/api/fetch-serp-data-single/{keyword_id}")
-async def fetch_and_store_single_serp_data(keyword_id: int):
+async def fetch_and_store_single_serp_data(keyword_id: int, bypass_cache: bool = Query(False, description="Fetch from SpaceSERP even if a cached SERP is fresh")):
     conn = get_db_connection()
-    keyword = conn.execute('SELECT keyword, search_volume, last_volume_update FROM keywords WHERE id = ?', (keyword_id,)).fetchone()
+    keyword = conn.execute('''
+        SELECT k.keyword, k.project_id, k.search_volume, k.last_volume_update,
+               p.domain, p.serp_cache_max_age_hours, r.rank AS last_rank
+        FROM keywords k
+        LEFT JOIN projects p ON p.id = k.project_id
+        LEFT JOIN keyword_rank_latest r ON r.keyword_id = k.id
+        WHERE k.id = ?
+    ''', (keyword_id,)).fetchone()
     conn.close()
     
     if keyword:
@@ -1396,10 +1655,14 @@ async def fetch_and_store_single_serp_data(keyword_id: int):
             (current_time - datetime.fromisoformat(keyword['last_volume_update']).replace(tzinfo=timezone.utc)).days > 30
         )
 
-        serp_data = await fetch_serp_data(keyword['keyword'])
+        serp_data, depth = await get_serp_data_for_request(
+            serp_request_key(keyword['keyword']), keyword['keyword'],
+            resolve_serp_cache_max_age(keyword['serp_cache_max_age_hours']), bypass_cache,
+            depth=serp_depth_for_rank(keyword['last_rank']), project_domains=[keyword['domain']]
+        )
         
-        if should_update_volume:
-            search_volume = await fetch_search_volume(keyword['keyword'])
+        search_volume = await get_search_volume(keyword['keyword']) if should_update_volume else None
+        if search_volume is not None:
             # Update the keywords table with the new search volume
             conn = get_db_connection()
             conn.execute('UPDATE keywords SET search_volume = ?, last_volume_update = ? WHERE id = ?',
@@ -1409,81 +1672,118 @@ async def fetch_and_store_single_serp_data(keyword_id: int):
         else:
             search_volume = keyword['search_volume']
 
-        add_serp_data(keyword_id, serp_data, search_volume)
+        await add_serp_data(keyword_id, serp_data, search_volume, depth)
+        resolve_dead_letter(keyword_id)
+        update_sov_daily(keyword['project_id'], datetime.now(timezone.utc).strftime('%Y-%m-%d'))
         
         return {"message": f"SERP data fetched and stored successfully for keyword ID {keyword_id}"}
     raise HTTPException(status_code=404, detail="Keyword not found")
 
-async def fetch_with_retry(session, url, params, max_retries=3, base_delay=1):
-    for attempt in range(max_retries):
-        try:
-            async with session.get(url, params=params) as response:
-                if response.status == 403:
-                    raise HTTPException(status_code=403, detail="SpaceSERP API concurrency limit reached")
-                return await response.json()
-        except HTTPException as e:
-            if e.status_code == 403 and attempt < max_retries - 1:
-                delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                await asyncio.sleep(delay)
-            else:
-                raise
-        except Exception as e:
-            if attempt < max_retries - 1:
-                delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
-                await asyncio.sleep(delay)
-            else:
-                raise
-
-async def fetch_serp_data(keyword):
-    url = "https://api.spaceserp.com/google/search"
-    params = {
-        "apiKey": SPACESERP_API_KEY,
-        "q": keyword,
-        # "location": "Midtown Manhattan,New York,United States",
-        "domain": "google.com",
-        "gl": "us",
-        "hl": "en",
-        "resultFormat": "json",
-        "device": "desktop",
-        "pageSize": 100,
-        "pageNumber": 1
-    }
-    async with aiohttp.ClientSession() as session:
-        return await fetch_with_retry(session, url, params)
+# Search settings of every SERP request. They do not depend on the project,
+# so the same keyword tracked in several projects gets the same SERP.
+SERP_SEARCH_PARAMS = {
+    # "location": "Midtown Manhattan,New York,United States",
+    "domain": "google.com",
+    "gl": "us",
+    "hl": "en",
+    "device": "desktop"
+}
 
-def add_serp_data(keyword_id, serp_data, search_volume):
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Fetch and normalize project_domain
-    project_domain = c.execute("""
-        SELECT domain FROM projects WHERE id = (SELECT project_id FROM keywords WHERE id = ?)
-    """, (keyword_id,)).fetchone()[0]
-    project_domain = extract_domain('http://' + project_domain)
-
-    rank = -1
-    for item in serp_data.get('organic_results', []):
-        link = item.get('link', '')
-        result_domain = extract_domain(link)
-        if project_domain == result_domain:
-            rank = item.get('position')
-            break
+def serp_request_key(keyword: str) -> str:
+    """
+    Identifies the SERP request for a keyword: the normalized keyword
+    plus the search engine domain, country, language and device.
+    """
+    return '|'.join([
+        normalize_keyword(keyword),
+        SERP_SEARCH_PARAMS['domain'],
+        SERP_SEARCH_PARAMS['gl'],
+        SERP_SEARCH_PARAMS['hl'],
+        SERP_SEARCH_PARAMS['device']
+    ])
+
+async def fetch_serp_data(keyword, page_size=100):
+    """
+    Fetches the SERP for a keyword from the configured SERP providers, with
+    failover and optional hedging, normalized to the SpaceSERP shape.
+
+    Raises:
+        HTTPException: 503 if every provider's circuit is open, 502 if every provider failed.
+    """
+    # Concurrent fetches of the same SERP, e.g. a scheduled pull and a manual
+    # refresh, share one provider call
+    key = (keyword, page_size, tuple(sorted(SERP_SEARCH_PARAMS.items())))
+    try:
+        return await get_single_flight('serp').do(key, lambda: get_serp_provider_pool().fetch(
+            get_http_session(), keyword, SERP_SEARCH_PARAMS, page_size))
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except SerpProviderError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+async def add_serp_data(keyword_id, serp_data, search_volume, depth=SERP_FULL_DEPTH):
+    """
+    Stores a SERP fetched with ``depth`` results through the shared batched
+    writer and returns once the batch holding it has been committed.
+    """
+    # Concurrent stores for the same keyword write a single snapshot
+    await get_single_flight('serp_store').do(
+        keyword_id, lambda: get_serp_writer().submit(keyword_id, serp_data, search_volume, depth))
 
-    # Log domains for debugging
-    logging.info(f"Project domain: {project_domain}")
-    logging.info(f"Matched rank: {rank}")
-    logging.info(f"Inserted SERP data for keyword_id: {keyword_id}, rank: {rank}")
+async def update_search_volumes(keywords: List[Dict]):
+    """
+    Looks up the search volume of many keywords, from volume_cache or
+    concurrently from Grepwords, and stores the results in one write.
 
-    full_data = json.dumps(serp_data)
-    current_time = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    Args:
+        keywords (List[Dict]): Keywords with their ``id`` and ``keyword``.
+    """
+    volumes = await get_search_volumes([keyword['keyword'] for keyword in keywords])
+    set_search_volumes([
+        (keyword['id'], volumes[keyword['keyword']]) for keyword in keywords if keyword['keyword'] in volumes
+    ])
+    logging.info(f"Updated search volume of {len(volumes)} keywords")
 
-    c.execute('INSERT INTO serp_data (keyword_id, date, rank, full_data, search_volume) VALUES (?, ?, ?, ?, ?)',
-              (keyword_id, current_time, rank, full_data, search_volume))
+VOLUME_REFRESH_INTERVAL_SECONDS = 300
+VOLUME_REFRESH_MIN_AGE_DAYS = VOLUME_CACHE_TTL_DAYS / 2  # Earliest a volume is refreshed ahead of its TTL
+volume_refresh_budget = 0.0
 
-    conn.commit()
-    conn.close()
+async def refresh_search_volumes():
+    """
+    Scheduled every VOLUME_REFRESH_INTERVAL_SECONDS. Refreshes a slice of the
+    keyword volumes so lookups are spread evenly over time instead of every
+    keyword imported together expiring on the same day. The pace is
+    VOLUME_REFRESH_PER_HOUR, or by default what refreshes every active
+    keyword once per VOLUME_CACHE_TTL_DAYS.
+    """
+    global volume_refresh_budget
+    per_hour = os.getenv("VOLUME_REFRESH_PER_HOUR")
+    if per_hour is not None:
+        per_hour = float(per_hour)
+    else:
+        conn = get_db_connection()
+        active = conn.execute("SELECT COUNT(*) FROM keywords WHERE active = 1").fetchone()[0]
+        conn.close()
+        per_hour = math.ceil(active / (VOLUME_CACHE_TTL_DAYS * 24))
+    volume_refresh_budget += per_hour * VOLUME_REFRESH_INTERVAL_SECONDS / 3600
+    limit = int(volume_refresh_budget)
+    if limit < 1:
+        return
+    # Unused budget is dropped so an idle period does not cause a burst later
+    volume_refresh_budget -= limit
+
+    keywords = get_volume_refresh_candidates(limit, VOLUME_REFRESH_MIN_AGE_DAYS)
+    if not keywords:
+        return
+    # A term refreshed recently for another project is reused as is
+    volumes = await get_search_volumes([keyword['keyword'] for keyword in keywords], VOLUME_REFRESH_MIN_AGE_DAYS)
+    set_search_volumes([
+        (keyword['id'], volumes[keyword['keyword']]) for keyword in keywords if keyword['keyword'] in volumes
+    ])
+    logging.info(f"Refreshed search volume of {len(volumes)} of {len(keywords)} keywords due for a refresh")
 
 @app.post("/api/keywords")
-async def add_keywords(data: dict):
+async def add_keywords(data: dict, background_tasks: BackgroundTasks):
     project_id = data.get('project_id')
     keywords = data.get('keywords')
     if not project_id or not keywords:
@@ -1501,14 +1801,15 @@ async def add_keywords(data: dict):
     conn.commit()
     conn.close()
     
-    # Update search volumes asynchronously
-    for keyword in added_keywords:
-        await update_search_volume(keyword['id'], keyword['keyword'])
+    # Volumes are looked up after the response is sent
+    background_tasks.add_task(update_search_volumes, added_keywords)
     
     return added_keywords
 
 @app.get("/api/keywords")
-async def get_all_keywords():
+async def get_all_keywords(accept: Optional[str] = Header(None)):
+    if wants_ndjson(accept):
+        return ndjson_response(dict(kw) for kw in iter_query_rows("SELECT * FROM keywords"))
     try:
         conn = get_db_connection()
         c = conn.cursor()
@@ -1525,8 +1826,13 @@ async def delete_keyword(keyword_id: int):
     try:
         conn = get_db_connection()
         c = conn.cursor()
+        project = c.execute("SELECT project_id FROM keywords WHERE id = ?", (keyword_id,)).fetchone()
         # Delete associated SERP data
         c.execute("DELETE FROM serp_data WHERE keyword_id = ?", (keyword_id,))
+        c.execute("DELETE FROM serp_results WHERE keyword_id = ?", (keyword_id,))
+        c.execute("DELETE FROM keyword_rank_latest WHERE keyword_id = ?", (keyword_id,))
+        if project:
+            invalidate_sov_daily(c, project['project_id'])
         # Delete the keyword
         c.execute("DELETE FROM keywords WHERE id = ?", (keyword_id,))
         if c.rowcount == 0:
@@ -1580,7 +1886,17 @@ async def activate_keyword(keyword_id: int):
 async def delete_serp_data(serp_data_id: int):
     conn = get_db_connection()
     c = conn.cursor()
+    row = c.execute('''
+        SELECT s.keyword_id, s.date, k.project_id
+        FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        WHERE s.id = ?
+    ''', (serp_data_id,)).fetchone()
     c.execute('DELETE FROM serp_data WHERE id = ?', (serp_data_id,))
+    c.execute('DELETE FROM serp_results WHERE serp_data_id = ?', (serp_data_id,))
+    if row:
+        refresh_keyword_rank_latest(c, row['keyword_id'])
+        invalidate_sov_daily(c, row['project_id'], row['date'])
     conn.commit()
     conn.close()
     return {"message": f"SERP data ID {serp_data_id} deleted successfully"}
@@ -1616,12 +1932,25 @@ async def delete_project(project_id: int):
     conn = get_db_connection()
     c = conn.cursor()
     c.execute('DELETE FROM serp_data WHERE keyword_id IN (SELECT id FROM keywords WHERE project_id = ?)', (project_id,))
+    c.execute('DELETE FROM serp_results WHERE keyword_id IN (SELECT id FROM keywords WHERE project_id = ?)', (project_id,))
+    c.execute('DELETE FROM keyword_rank_latest WHERE project_id = ?', (project_id,))
+    invalidate_sov_daily(c, project_id)
     c.execute('DELETE FROM keywords WHERE project_id = ?', (project_id,))
     c.execute('DELETE FROM projects WHERE id = ?', (project_id,))
     conn.commit()
     conn.close()
     return {"message": f"Project ID {project_id} deleted successfully"}
 
+def invalidate_tag_sov_daily(c, tag_id: int, keyword_ids: List[int]):
+    """
+    Drops the stored share of voice of a tag in the projects of keywords
+    that were just tagged or untagged, as it was aggregated over the old set.
+    """
+    project_ids = {row[0] for row in c.execute(
+        f"SELECT DISTINCT project_id FROM keywords WHERE id IN ({','.join('?' * len(keyword_ids))})", keyword_ids)}
+    for project_id in project_ids:
+        invalidate_sov_daily(c, project_id, tag_id=tag_id)
+
 @app.post("/api/tags", response_model=Tag)
 async def create_tag(tag: TagCreate):
     conn = get_db_connection()
@@ -1649,6 +1978,7 @@ async def add_tag_to_keyword(keyword_id: int, tag_id: int):
     cursor = conn.cursor()
     try:
         cursor.execute('INSERT INTO keyword_tags (keyword_id, tag_id) VALUES (?, ?)', (keyword_id, tag_id))
+        invalidate_tag_sov_daily(cursor, tag_id, [keyword_id])
         conn.commit()
         return {"message": "Tag added to keyword successfully"}
     except sqlite3.IntegrityError:
@@ -1661,6 +1991,7 @@ async def remove_tag_from_keyword(keyword_id: int, tag_id: int):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM keyword_tags WHERE keyword_id = ? AND tag_id = ?', (keyword_id, tag_id))
+    invalidate_tag_sov_daily(cursor, tag_id, [keyword_id])
     conn.commit()
     conn.close()
     return {"message": "Tag removed from keyword successfully"}
@@ -1671,6 +2002,7 @@ async def delete_tag(tag_id: int):
     cursor = conn.cursor()
     cursor.execute('DELETE FROM keyword_tags WHERE tag_id = ?', (tag_id,))
     cursor.execute('DELETE FROM tags WHERE id = ?', (tag_id,))
+    invalidate_sov_daily(cursor, tag_id=tag_id)
     conn.commit()
     conn.close()
     return {"message": "Tag deleted successfully"}
@@ -1687,6 +2019,7 @@ async def bulk_tag_keywords(data: dict):
     try:
         for keyword_id in keyword_ids:
             cursor.execute('INSERT OR IGNORE INTO keyword_tags (keyword_id, tag_id) VALUES (?, ?)', (keyword_id, tag_id))
+        invalidate_tag_sov_daily(cursor, tag_id, keyword_ids)
         conn.commit()
         return {"message": "Tags added to keywords successfully"}
     finally:
@@ -1725,32 +2058,37 @@ async def get_keyword_history(keyword_id: int):
     
     return [KeywordHistoryEntry(date=entry['date'], rank=entry['rank'], search_volume=entry['search_volume']) for entry in history]
 
-async def fetch_search_volume(keyword):
-    url = "https://data.grepwords.com/v1/keywords/lookup"
-    headers = {
-        "accept": "application/json",
-        "api_key": GREPWORDS_API_KEY,
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "term": keyword,
-        "country": "us",
-        "language": "en"
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=payload) as response:
-            logging.info(f"Grepwords API request for '{keyword}': URL: {url}, Headers: {headers}, Payload: {payload}")
-            data = await response.json()
-            logging.info(f"Grepwords API response for '{keyword}': {json.dumps(data, indent=2)}")
-            
-            if response.status == 200 and data and 'data' in data:
-                volume = data['data'].get('volume', 0)
-                logging.info(f"Search volume for '{keyword}': {volume}")
-                return volume
-            else:
-                logging.warning(f"No search volume data found for '{keyword}'. Status: {response.status}, Response: {data}")
-                return 0
+def compute_share_of_voice(weighted: List[Tuple[str, str, float]], totals: Dict[str, float]) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    Turns position-weighted search volume into a (date x domain) matrix of
+    share of voice percentages.
+
+    Args:
+        weighted (List[Tuple[str, str, float]]): (date, domain, weighted_volume) rows.
+        totals (Dict[str, float]): Total search volume per date.
+
+    Returns:
+        Tuple[List[str], List[str], np.ndarray]: Sorted dates, sorted domains and
+        the matrix with one row per date and one column per domain. Dates with
+        a total search volume of 0 are left unnormalized.
+    """
+    if not weighted:
+        return [], [], np.zeros((0, 0))
+
+    row_dates, row_domains, row_volumes = zip(*weighted)
+    dates, date_index = np.unique(np.array(row_dates), return_inverse=True)
+    domains, domain_index = np.unique(np.array(row_domains), return_inverse=True)
+
+    sov_matrix = np.zeros((len(dates), len(domains)))
+    np.add.at(sov_matrix, (date_index, domain_index), np.array(row_volumes, dtype=float))
+
+    date_totals = np.array([totals.get(date, 0) or 0 for date in dates], dtype=float)
+    has_volume = date_totals > 0
+    sov_matrix[has_volume] = sov_matrix[has_volume] / date_totals[has_volume, None] * 100
+    if not has_volume.all():
+        logging.warning(f"Total search volume is 0 for dates {dates[~has_volume].tolist()}, skipping normalization")
+
+    return dates.tolist(), domains.tolist(), sov_matrix
 
 @app.post("/api/share-of-voice/{project_id}", response_model=ShareOfVoiceResponse)
 async def get_share_of_voice(
@@ -1764,71 +2102,30 @@ async def get_share_of_voice(
 
         logging.info(f"Fetching Share of Voice for Project ID {project_id} from {start_date} to {end_date} with Tag ID {tag_id}")
 
-        serp_data = get_serp_data_within_date_range(project_id, start_date, end_date, tag_id)
-        logging.info(f"Fetched SERP data: {serp_data}")
+        # Past days come pre-aggregated from sov_daily, only today is computed live
+        today = datetime.now(timezone.utc).date().isoformat()
+        aggregates = get_share_of_voice_daily(project_id, start_date, end_date, tag_id, live_from=today)
 
-        if not serp_data:
+        if not aggregates['serp_rows']:
             raise HTTPException(status_code=404, detail="No SERP data found for the given criteria.")
 
-        # Calculate Share of Voice (SOV)
-        daily_sov = defaultdict(lambda: defaultdict(float))
-        total_search_volume = defaultdict(float)
-        all_domains = set()
-
-        for entry in serp_data:
-            date = parser.parse(entry['date']).date().isoformat()
-            rank = entry['rank']
-            search_volume = entry['search_volume'] or 0
-
-            # Only consider ranks 1-10 for SOV calculation
-            if rank and 1 <= rank <= 10:
-                # Parse the full_data to get all domains in top 10
-                full_data = json.loads(entry['full_data'])
-                for result in full_data.get('organic_results', [])[:10]:
-                    domain = result.get('domain')
-                    if domain:
-                        all_domains.add(domain)
-                        position = result.get('position')
-                        if position and 1 <= position <= 10:
-                            sov_score = (11 - position) / 55  # Example SOV calculation
-                            daily_sov[date][domain] += sov_score * search_volume
-                total_search_volume[date] += search_volume
-
-        if not daily_sov:
-            raise HTTPException(status_code=404, detail="No Share of Voice data available for the given criteria.")
+        dates, domains, sov_matrix = compute_share_of_voice(aggregates['weighted'], aggregates['totals'])
 
-        # Normalize SOV scores
-        for date in daily_sov:
-            if total_search_volume[date] > 0:
-                for domain in daily_sov[date]:
-                    daily_sov[date][domain] = (daily_sov[date][domain] / total_search_volume[date]) * 100
-            else:
-                logging.warning(f"Total search volume for date {date} is 0, skipping normalization")
+        if not dates:
+            raise HTTPException(status_code=404, detail="No Share of Voice data available for the given criteria.")
 
-        # Log the daily_sov for debugging
-        logging.info(f"Daily SOV: {dict(daily_sov)}")
+        logging.info(f"Share of Voice matrix: {len(dates)} dates x {len(domains)} domains")
 
         # Prepare data for line chart
         line_chart_data = [
-            LineChartData(
-                name=domain,
-                dates=sorted(daily_sov.keys()),
-                shares=[daily_sov[date].get(domain, 0) for date in sorted(daily_sov.keys())]
-            )
-            for domain in all_domains
+            LineChartData(name=domain, dates=dates, shares=shares)
+            for domain, shares in zip(domains, sov_matrix.T.tolist())
         ]
 
         # Prepare data for donut chart (most recent date)
-        most_recent_date = max(daily_sov.keys())
-        logging.info(f"Most recent date: {most_recent_date}")
-        logging.info(f"SOV for most recent date: {daily_sov[most_recent_date]}")
-        
         donut_chart_data = [
-            DonutChartData(
-                name=domain, 
-                share=daily_sov[most_recent_date].get(domain, 0)
-            )
-            for domain in all_domains
+            DonutChartData(name=domain, share=share)
+            for domain, share in zip(domains, sov_matrix[-1].tolist())
         ]
 
         logging.info(f"Returning Share of Voice data with {len(line_chart_data)} domains for line chart and {len(donut_chart_data)} domains for donut chart.")
@@ -1844,6 +2141,33 @@ async def get_share_of_voice(
         logging.exception("An error occurred while processing Share of Voice request")
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.get("/api/competitors/{project_id}")
+async def get_competitors(
+    project_id: int,
+    start_date: str = Query(..., description="Start date in YYYY-MM-DD"),
+    end_date: str = Query(..., description="End date in YYYY-MM-DD"),
+    max_position: int = Query(10, ge=1, le=100),
+    limit: int = Query(50, ge=1, le=500)
+):
+    try:
+        return get_competitor_domains(project_id, start_date, end_date, max_position, limit)
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error in get_competitors: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get("/api/keywords/{keyword_id}/ranking-urls")
+async def get_keyword_ranking_urls(
+    keyword_id: int,
+    domain: Optional[str] = Query(None, description="Only URLs of this domain"),
+    start_date: Optional[str] = Query(None, description="Start date in YYYY-MM-DD"),
+    end_date: Optional[str] = Query(None, description="End date in YYYY-MM-DD")
+):
+    try:
+        return {"data": get_ranking_urls(keyword_id, domain, start_date, end_date)}
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error in get_keyword_ranking_urls: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.put("/api/gsc/domains/{domain_id}")
 async def set_gsc_domain(domain_id: int, update: GSCDomainUpdate):
     logging.info(f"Received update request for domain {domain_id}: {update}")
@@ -1933,80 +2257,80 @@ async def get_gsc_domain(domain_id: int):
         logging.error(f"Error retrieving GSC domain: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving GSC domain")
     
-async def fetch_gsc_data_for_keyword(project_id, keyword):
-    try:
-        # Retrieve GSC credentials from the database
-        credentials_json = get_gsc_credentials_from_db(project_id)
-        if not credentials_json:
-            logging.warning(f"No GSC credentials found for project_id: {project_id}")
-            return
+@app.get("/api/rate-limits")
+async def get_rate_limits():
+    return {"providers": get_rate_limiter_stats()}
+
+@app.get("/api/serp-cache")
+async def get_serp_cache_stats():
+    return {
+        **serp_cache_stats,
+        "max_age_hours": SERP_CACHE_MAX_AGE_HOURS,
+        "max_bytes": SERP_CACHE_MAX_BYTES
+    }
 
-        # Load credentials and refresh if necessary
-        credentials = Credentials.from_authorized_user_info(json.loads(credentials_json), SCOPES)
-        if credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-            # Save the refreshed credentials back to the database
-            update_gsc_credentials_in_db(project_id, credentials.to_json())
+@app.get("/api/serp-providers")
+async def get_serp_provider_stats():
+    pool = get_serp_provider_pool()
+    return {"providers": pool.get_stats(), "hedging": pool.hedge}
+
+@app.get("/api/dead-letters")
+async def list_dead_letters(status: Optional[str] = Query(None, description="waiting or redriven"),
+                            limit: int = Query(100, ge=1, le=1000)):
+    return get_dead_letters(status, limit)
+
+@app.post("/api/dead-letters/redrive")
+async def redrive_dead_letters_endpoint():
+    return {"job_id": redrive_pull_dead_letters()}
+
+@app.get("/api/serp-depth")
+async def get_serp_depth_stats():
+    return {
+        **serp_depth_stats,
+        "latency_saved_ms": round(serp_depth_stats["latency_saved_ms"]),
+        "average_latency_ms": {depth: round(seconds * 1000) for depth, seconds in sorted(serp_fetch_latency.items())},
+        "margin": SERP_DEPTH_MARGIN
+    }
 
-        # Build the GSC service
-        service = build('webmasters', 'v3', credentials=credentials)
+@app.delete("/api/serp-cache")
+async def delete_serp_cache():
+    return {"deleted": clear_serp_cache()}
 
-        # Get the domain associated with the project
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT domain FROM gsc_domains WHERE project_id = ?", (project_id,))
-        result = c.fetchone()
-        if not result:
-            logging.warning(f"No GSC domain associated with project_id: {project_id}")
-            conn.close()
-            return
-        site_url = result[0]
-        conn.close()
+@app.get("/api/single-flight")
+async def get_single_flight_counters():
+    return {"groups": get_single_flight_stats()}
 
-        # Use the date range, e.g., last 7 days
-        end_date = datetime.now(timezone.utc).date()
-        start_date = end_date - timedelta(days=7)
+async def execute_gsc_query(service, site_url, body):
+    """
+    Runs a Search Analytics query through the shared GSC rate limiter. The
+    blocking client call runs in the default executor so it does not stall
+    the event loop, and identical concurrent queries share one call.
+    """
+    key = (site_url, json.dumps(body, sort_keys=True))
+    return await get_single_flight('gsc').do(key, lambda: request_gsc_query(service, site_url, body))
 
-        # Adjust the dimensions to include 'query' and 'page'
-        body = {
-            'startDate': start_date.strftime("%Y-%m-%d"),
-            'endDate': end_date.strftime("%Y-%m-%d"),
-            'dimensions': ['date', 'query', 'page'],
-            'dimensionFilterGroups': [{
-                'filters': [{
-                    'dimension': 'query',
-                    'operator': 'equals',
-                    'expression': keyword['keyword']
-                }]
-            }],
-            'rowLimit': 25000
-        }
+async def request_gsc_query(service, site_url, body):
+    return await execute_gsc_request(service.searchanalytics().query(siteUrl=site_url, body=body))
+
+async def execute_gsc_request(request):
+    """
+    Executes a prepared GSC API request through the shared GSC rate limiter,
+    in the default executor so the blocking client call does not stall the
+    event loop. Throttled answers slow the limiter down before re-raising.
+    """
+    async with get_rate_limiter('gsc').limit() as call:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, request.execute)
+        except HttpError as e:
+            # GSC also answers 403 for missing permissions, which is not a throttle
+            reason = e.content.decode('utf-8', 'ignore') if isinstance(e.content, bytes) else str(e.content)
+            if e.resp.status == 429 or (e.resp.status == 403 and ('rateLimitExceeded' in reason or 'quotaExceeded' in reason)):
+                call.throttled(e.resp.status, parse_retry_after(e.resp.get('retry-after')))
+            raise
 
-        logging.info(f"Fetching GSC data for keyword '{keyword['keyword']}' from {start_date} to {end_date}")
-        response = service.searchanalytics().query(siteUrl=site_url, body=body).execute()
-        logging.info(f"GSC API response for '{keyword['keyword']}': {json.dumps(response, indent=2)}")
-
-        if 'rows' in response:
-            for row in response['rows']:
-                keys = row.get('keys', [])
-                date = keys[0] if len(keys) > 0 else ''
-                query_value = keys[1] if len(keys) > 1 else ''
-                page = keys[2] if len(keys) > 2 else ''
-                clicks = row.get('clicks', 0)
-                impressions = row.get('impressions', 0)
-                ctr = row.get('ctr', 0)
-                position = row.get('position', 0)
-                # Store the data in the database
-                add_gsc_data_by_keyword_id(keyword['id'], date, clicks, impressions, ctr, position, query_value, page)
-            logging.info(f"Stored GSC data for keyword '{keyword['keyword']}'")
-        else:
-            logging.info(f"No GSC data for keyword: {keyword['keyword']}")
-    except Exception as e:
-        logging.error(f"Error fetching GSC data for keyword '{keyword['keyword']}': {str(e)}")
-    
 @app.put("/api/projects/{project_id}", response_model=Project)
 async def update_project(project_id: int, project: ProjectBase):
-    updated_project = update_project_in_db(project_id, project.dict())
+    updated_project = update_project_in_db(project_id, project.dict(exclude_unset=True))
     if updated_project:
         return updated_project
     raise HTTPException(status_code=404, detail="Project not found")
@@ -0,0 +1,111 @@
+import logging
+import os
+import time
+from typing import Callable, Dict, List
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit is open."""
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker. After ``failure_threshold`` failures in a
+    row the circuit opens and calls fail fast for ``reset_timeout`` seconds.
+    It then goes half-open and lets ``half_open_max_calls`` trial calls
+    through: a success closes it again, a failure reopens it.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60,
+                 half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_calls = 0
+        self.on_close: List[Callable[[], None]] = []
+
+        self.opened = 0
+        self.rejected = 0
+
+    def available(self) -> bool:
+        """True if a call would be let through right now."""
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        if self.state == 'half_open':
+            return self.trial_calls < self.half_open_max_calls
+        return True
+
+    def allow(self) -> bool:
+        """
+        Reserves a call. Every allowed call must end with record_success(),
+        record_failure() or record_cancelled().
+        """
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            self.trial_calls = 0
+            logging.info(f"Circuit for {self.name} is half-open, sending a trial call")
+        if self.state == 'half_open':
+            if self.trial_calls >= self.half_open_max_calls:
+                self.rejected += 1
+                return False
+            self.trial_calls += 1
+            return True
+        if self.state == 'open':
+            self.rejected += 1
+            return False
+        return True
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        if self.state == 'half_open':
+            self.state = 'closed'
+            logging.info(f"Circuit for {self.name} closed")
+            for callback in self.on_close:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Circuit close callback for {self.name} failed: {e}")
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+            if self.state != 'open':
+                self.opened += 1
+                logging.warning(f"Circuit for {self.name} opened after {self.consecutive_failures} failures, "
+                                f"failing fast for {self.reset_timeout:.0f}s")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self):
+        """Gives back the trial slot of a half-open call that was cancelled."""
+        if self.state == 'half_open':
+            self.trial_calls = max(0, self.trial_calls - 1)
+
+    def get_stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_in": (max(0.0, round(self.opened_at + self.reset_timeout - time.monotonic(), 2))
+                         if self.state == 'open' else None)
+        }
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    """
+    Returns the process-wide breaker for a provider. Thresholds come from
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS and CIRCUIT_HALF_OPEN_CALLS.
+    """
+    if provider not in circuit_breakers:
+        circuit_breakers[provider] = CircuitBreaker(
+            provider,
+            failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+            reset_timeout=float(os.getenv("CIRCUIT_RESET_SECONDS", 60)),
+            half_open_max_calls=int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", 1))
+        )
+    return circuit_breakers[provider]
@@ -1,5 +1,10 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import sqlite3
+import threading
+import time
+import zlib
+from collections import defaultdict
+import numpy as np
 from datetime import datetime
 import logging
 import json
@@ -7,11 +12,32 @@ from dateutil import parser
 import os
 from fastapi import HTTPException
 from datetime import datetime, timedelta, timezone
-from services import fetch_search_volume
+from services import fetch_search_volume, fetch_search_volumes, VOLUME_COUNTRY, VOLUME_LANGUAGE
 # Determine the absolute path to the directory containing this file
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'seo_rank_tracker.db')
 
+# serp_data.full_data is stored as this marker followed by zlib-compressed JSON.
+# Rows written before compression was introduced are plain JSON text.
+SERP_FULL_DATA_ZLIB_MARKER = b'ZLB1'
+SERP_FULL_DATA_COMPRESSION_LEVEL = 6
+
+# One gsc_data row per keyword, day, query and page, so re-syncing a window updates rows in place
+GSC_DATA_UNIQUE_INDEX_SQL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_gsc_data_keyword_id_date_query_page "
+    "ON gsc_data (keyword_id, date, query, page)"
+)
+
+# Search volumes in volume_cache are reused across projects for this long
+VOLUME_CACHE_TTL_DAYS = float(os.getenv("VOLUME_CACHE_TTL_DAYS", 30))
+# Keywords scored per free slot when ranking volume refreshes by business impact
+VOLUME_REFRESH_SCORED_SLICE = 5
+
+# In-process CTR curves: project_id -> (version, cache entry)
+ctr_curve_entries: Dict[int, Tuple[int, Optional[Dict]]] = {}
+ctr_curve_versions: Dict[int, int] = defaultdict(int)
+ctr_curve_lock = threading.Lock()
+
 def get_db_connection():
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)  # Allow connections across threads
     conn.row_factory = sqlite3.Row
@@ -69,8 +95,16 @@ def init_db():
                   rank INTEGER,
                   full_data TEXT,
                   search_volume INTEGER,
+                  depth INTEGER,
                   FOREIGN KEY (keyword_id) REFERENCES keywords (id))''')
 
+    try:
+        # Results the snapshot was fetched with; NULL for snapshots stored
+        # before shallow pages, which were always fetched 100 deep
+        c.execute("ALTER TABLE serp_data ADD COLUMN depth INTEGER")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
     c.execute('''
         CREATE TABLE IF NOT EXISTS ctr_cache (
             project_id INTEGER PRIMARY KEY,
@@ -82,22 +116,226 @@ def init_db():
         )
     ''')
 
+    # Current and previous rank of every keyword, maintained by add_serp_data.
+    # Business impact depends on the project's CTR curve and conversion
+    # settings, so it is computed when read rather than stored here.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS keyword_rank_latest (
+            keyword_id INTEGER PRIMARY KEY,
+            project_id INTEGER NOT NULL,
+            serp_data_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            rank INTEGER,
+            search_volume INTEGER,
+            previous_date TEXT,
+            previous_rank INTEGER,
+            previous_search_volume INTEGER,
+            FOREIGN KEY (keyword_id) REFERENCES keywords (id),
+            FOREIGN KEY (project_id) REFERENCES projects (id),
+            FOREIGN KEY (serp_data_id) REFERENCES serp_data (id)
+        )
+    ''')
+
+    try:
+        c.execute("ALTER TABLE keyword_rank_latest ADD COLUMN previous_search_volume INTEGER")
+        c.execute('''
+            UPDATE keyword_rank_latest SET previous_search_volume = (
+                SELECT s.search_volume FROM serp_data s
+                WHERE s.keyword_id = keyword_rank_latest.keyword_id AND s.date = keyword_rank_latest.previous_date
+                ORDER BY s.id DESC
+                LIMIT 1
+            )
+            WHERE previous_date IS NOT NULL
+        ''')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    for column in ("estimated_business_impact", "previous_estimated_business_impact"):
+        try:
+            c.execute(f"ALTER TABLE keyword_rank_latest DROP COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # Column already dropped
+
+    # One row per organic result of a SERP snapshot, so analytics never parse full_data
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS serp_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            serp_data_id INTEGER NOT NULL,
+            keyword_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            position INTEGER,
+            domain TEXT,
+            url TEXT,
+            FOREIGN KEY (serp_data_id) REFERENCES serp_data (id),
+            FOREIGN KEY (keyword_id) REFERENCES keywords (id)
+        )
+    ''')
+
+    # Per-day share of voice aggregates; tag_id 0 stands for all keywords of the project
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sov_daily (
+            project_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL DEFAULT 0,
+            date TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            weighted_volume REAL NOT NULL,
+            total_volume REAL NOT NULL,
+            PRIMARY KEY (project_id, tag_id, date, domain),
+            FOREIGN KEY (project_id) REFERENCES projects (id)
+        )
+    ''')
+    # Dates already aggregated into sov_daily, including ones without any top-10 result
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sov_daily_dates (
+            project_id INTEGER NOT NULL,
+            tag_id INTEGER NOT NULL DEFAULT 0,
+            date TEXT NOT NULL,
+            computed_at TEXT NOT NULL,
+            PRIMARY KEY (project_id, tag_id, date),
+            FOREIGN KEY (project_id) REFERENCES projects (id)
+        )
+    ''')
+
+    # Compressed SpaceSERP responses by request key, reused while younger than the
+    # project's max age and evicted least recently used first
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS serp_cache (
+            request_key TEXT PRIMARY KEY,
+            response BLOB NOT NULL,
+            depth INTEGER NOT NULL DEFAULT 100,
+            size INTEGER NOT NULL,
+            fetched_at TEXT NOT NULL,
+            last_used_at TEXT NOT NULL
+        )
+    ''')
+    # Superseded by serp_cache
+    c.execute("DROP TABLE IF EXISTS serp_fetches")
+    try:
+        c.execute("ALTER TABLE serp_cache ADD COLUMN depth INTEGER NOT NULL DEFAULT 100")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    try:
+        c.execute("ALTER TABLE projects ADD COLUMN serp_cache_max_age_hours REAL")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+    # Durable queue of rank pulls: one job per request or scheduled run, one task per keyword
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pull_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER,
+            tag_id INTEGER,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            total_tasks INTEGER NOT NULL DEFAULT 0,
+            cache_max_age_hours REAL,
+            bypass_cache INTEGER NOT NULL DEFAULT 0,
+            shallow_fetches INTEGER NOT NULL DEFAULT 0,
+            depth_escalations INTEGER NOT NULL DEFAULT 0,
+            depth_latency_saved_ms REAL NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            FOREIGN KEY (project_id) REFERENCES projects (id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pull_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            keyword_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at TEXT NOT NULL,
+            lease_expires_at TEXT,
+            lease_owner TEXT,
+            last_error TEXT,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY (job_id) REFERENCES pull_jobs (id),
+            FOREIGN KEY (keyword_id) REFERENCES keywords (id)
+        )
+    ''')
+
+    # Search volume per market, shared by every keyword with the same term
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS volume_cache (
+            term_normalized TEXT NOT NULL,
+            country TEXT NOT NULL,
+            language TEXT NOT NULL,
+            volume INTEGER,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (term_normalized, country, language)
+        )
+    ''')
+
+    # Keywords whose pull failed for good, waiting to be re-driven
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pull_dead_letters (
+            keyword_id INTEGER PRIMARY KEY,
+            job_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            error TEXT,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            redrives INTEGER NOT NULL DEFAULT 0,
+            failed_at TEXT NOT NULL,
+            redriven_at TEXT,
+            redrive_job_id INTEGER,
+            FOREIGN KEY (keyword_id) REFERENCES keywords (id)
+        )
+    ''')
+
     # Create Indexes for Performance Optimization
     c.execute("CREATE INDEX IF NOT EXISTS idx_gsc_data_keyword_id_date ON gsc_data (keyword_id, date)")
+    for column in ("query TEXT", "page TEXT"):
+        try:
+            c.execute(f"ALTER TABLE gsc_data ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+    try:
+        c.execute(GSC_DATA_UNIQUE_INDEX_SQL)
+        gsc_data_has_duplicates = False
+    except sqlite3.IntegrityError:
+        gsc_data_has_duplicates = True
     c.execute("CREATE INDEX IF NOT EXISTS idx_serp_data_keyword_id_date ON serp_data (keyword_id, date)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_keywords_project_id ON keywords (project_id)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_projects_user_id ON projects (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_serp_data_date_id ON serp_data (date, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keywords_project_id_keyword ON keywords (project_id, keyword)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_keyword_rank_latest_project_id ON keyword_rank_latest (project_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_serp_results_serp_data_id ON serp_results (serp_data_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_serp_results_keyword_id_date ON serp_results (keyword_id, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_serp_results_domain_date ON serp_results (domain, date)")
+    for column in ("cache_max_age_hours REAL", "bypass_cache INTEGER NOT NULL DEFAULT 0",
+                   "shallow_fetches INTEGER NOT NULL DEFAULT 0", "depth_escalations INTEGER NOT NULL DEFAULT 0",
+                   "depth_latency_saved_ms REAL NOT NULL DEFAULT 0"):
+        try:
+            c.execute(f"ALTER TABLE pull_jobs ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+    try:
+        c.execute("ALTER TABLE pull_tasks ADD COLUMN lease_owner TEXT")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    c.execute("CREATE INDEX IF NOT EXISTS idx_serp_cache_last_used_at ON serp_cache (last_used_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pull_tasks_status_available_at ON pull_tasks (status, available_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pull_tasks_job_id_status ON pull_tasks (job_id, status)")
+    try:
+        c.execute("CREATE INDEX IF NOT EXISTS idx_keyword_tags_tag_id ON keyword_tags (tag_id, keyword_id)")
+    except sqlite3.OperationalError:
+        pass  # keyword_tags has not been created yet
 
     conn.commit()
     conn.close()
+    if gsc_data_has_duplicates:
+        logging.warning("gsc_data holds duplicate rows, removing them before adding its unique index")
+        dedup_gsc_data()
 
-def add_project(name, domain, branded_terms, conversion_rate, conversion_value, user_id):
+def add_project(name, domain, branded_terms, conversion_rate, conversion_value, user_id, serp_cache_max_age_hours=None):
     logging.info(f"Adding project to database: {name}, {domain}, user_id: {user_id}")
     try:
         conn = sqlite3.connect('seo_rank_tracker.db')
         c = conn.cursor()
-        c.execute("INSERT INTO projects (name, domain, branded_terms, conversion_rate, conversion_value, user_id) VALUES (?, ?, ?, ?, ?, ?)", 
-                  (name, domain, branded_terms, conversion_rate, conversion_value, user_id))
+        c.execute("INSERT INTO projects (name, domain, branded_terms, conversion_rate, conversion_value, user_id, serp_cache_max_age_hours) VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                  (name, domain, branded_terms, conversion_rate, conversion_value, user_id, serp_cache_max_age_hours))
         project_id = c.lastrowid
         conn.commit()
         logging.info(f"Project added successfully with ID: {project_id}")
@@ -182,8 +420,13 @@ def get_all_keywords():
 def delete_keyword_by_id(keyword_id):
     conn = sqlite3.connect('seo_rank_tracker.db')
     c = conn.cursor()
+    project = c.execute("SELECT project_id FROM keywords WHERE id = ?", (keyword_id,)).fetchone()
     c.execute("DELETE FROM keywords WHERE id = ?", (keyword_id,))
     c.execute("DELETE FROM serp_data WHERE keyword_id = ?", (keyword_id,))
+    c.execute("DELETE FROM serp_results WHERE keyword_id = ?", (keyword_id,))
+    c.execute("DELETE FROM keyword_rank_latest WHERE keyword_id = ?", (keyword_id,))
+    if project:
+        invalidate_sov_daily(c, project[0])
     conn.commit()
     conn.close()
 
@@ -191,6 +434,9 @@ def delete_keywords_by_project(project_id):
     conn = sqlite3.connect('seo_rank_tracker.db')
     c = conn.cursor()
     c.execute("DELETE FROM serp_data WHERE keyword_id IN (SELECT id FROM keywords WHERE project_id = ?)", (project_id,))
+    c.execute("DELETE FROM serp_results WHERE keyword_id IN (SELECT id FROM keywords WHERE project_id = ?)", (project_id,))
+    c.execute("DELETE FROM keyword_rank_latest WHERE project_id = ?", (project_id,))
+    invalidate_sov_daily(c, project_id)
     c.execute("DELETE FROM keywords WHERE project_id = ?", (project_id,))
     conn.commit()
     conn.close()
@@ -212,18 +458,14 @@ def add_gsc_data(project_id, keyword, date, clicks, impressions, ctr, position,
     result = c.fetchone()
     if result:
         keyword_id = result[0]
-        # Insert the GSC data
-        c.execute('''
-            INSERT INTO gsc_data 
-            (keyword_id, date, clicks, impressions, ctr, position, query, page)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (keyword_id, date, clicks, impressions, ctr, position, query, page))
-        conn.commit()
+        conn.close()
+        upsert_gsc_data([(keyword_id, date, clicks, impressions, ctr, position, query, page)])
+        invalidate_ctr_curve(project_id)
         logging.info(f"Added GSC data for keyword_id: {keyword_id}, date: {date}")
     else:
         # Keyword not being tracked; ignore
         logging.info(f"Keyword '{keyword}' not found in project_id {project_id}. Skipping GSC data.")
-    conn.close()
+        conn.close()
 
 def get_gsc_domains(user_id):
     conn = get_db_connection()
@@ -233,216 +475,1310 @@ def get_gsc_domains(user_id):
     conn.close()
     return [{"id": d[0], "domain": d[1]} for d in domains]
 
-def get_serp_data_within_date_range(project_id, start_date, end_date, tag_id=None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def encode_full_data(serp_data: Dict) -> bytes:
+    """
+    Serializes a SERP API response for storage in serp_data.full_data.
+    """
+    return SERP_FULL_DATA_ZLIB_MARKER + zlib.compress(
+        json.dumps(serp_data).encode('utf-8'), SERP_FULL_DATA_COMPRESSION_LEVEL)
 
-    query = '''
-        SELECT s.date, s.rank, s.search_volume, p.domain, s.full_data
-        FROM serp_data s
-        JOIN keywords k ON s.keyword_id = k.id
-        JOIN projects p ON k.project_id = p.id
-        WHERE k.project_id = ? AND s.date BETWEEN ? AND ?
-    '''
-    params = (project_id, start_date, end_date)
+def decode_full_data(full_data) -> Dict:
+    """
+    Deserializes serp_data.full_data, compressed or legacy plain JSON.
+    """
+    if full_data is None:
+        return {}
+    if isinstance(full_data, bytes):
+        if full_data.startswith(SERP_FULL_DATA_ZLIB_MARKER):
+            full_data = zlib.decompress(full_data[len(SERP_FULL_DATA_ZLIB_MARKER):])
+        return json.loads(full_data.decode('utf-8'))
+    return json.loads(full_data)
 
-    if tag_id:
-        query += ' AND k.id IN (SELECT keyword_id FROM keyword_tags WHERE tag_id = ?)'
-        params += (tag_id,)
+def compress_serp_full_data(batch_size: int = 500, pause: float = 0.0) -> int:
+    """
+    Compresses legacy plain-text serp_data.full_data rows in place.
 
-    cursor.execute(query, params)
-    data = cursor.fetchall()
-    conn.close()
+    Rows are processed in id order, one short transaction per batch, so the
+    migration can run while the application keeps writing. It is safe to
+    interrupt and re-run: rows already stored as blobs are skipped.
 
-    return [
-        {
-            'date': parser.parse(row['date']).date().isoformat(),
-            'rank': row['rank'],
-            'search_volume': row['search_volume'],
-            'domain': row['domain'],
-            'full_data': row['full_data']
-        }
-        for row in data
-    ]
+    Args:
+        batch_size (int): Number of rows compressed per transaction.
+        pause (float): Seconds to sleep between batches to leave room for other writers.
 
-def create_gsc_data_table():
+    Returns:
+        int: The number of rows compressed.
+    """
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS gsc_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                keyword_id INTEGER,
-                date TEXT NOT NULL,
-                clicks INTEGER,
-                impressions INTEGER,
-                ctr REAL,
-                position REAL,
-                query TEXT,
-                page TEXT,
-                FOREIGN KEY (keyword_id) REFERENCES keywords (id)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS gsc_credentials
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  project_id INTEGER UNIQUE,
-                  credentials TEXT,
-                  FOREIGN KEY (project_id) REFERENCES projects (id))''')
-    conn.commit()
-    conn.close()
-
-def get_gsc_credentials_from_db(project_id):
+    last_id = 0
+    compressed = 0
     try:
-        conn = sqlite3.connect('seo_rank_tracker.db')
-        c = conn.cursor()
-        c.execute("SELECT credentials FROM gsc_credentials WHERE project_id = ?", (project_id,))
-        result = c.fetchone()
+        while True:
+            rows = c.execute('''
+                SELECT id, full_data FROM serp_data
+                WHERE id > ? AND typeof(full_data) = 'text'
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                try:
+                    updates.append((encode_full_data(json.loads(row['full_data'])), row['id']))
+                except ValueError:
+                    logging.warning(f"Skipping serp_data id {row['id']}: full_data is not valid JSON")
+            c.executemany("UPDATE serp_data SET full_data = ? WHERE id = ?", updates)
+            conn.commit()
+            last_id = rows[-1]['id']
+            compressed += len(updates)
+            logging.info(f"Compressed {compressed} serp_data rows (last id {last_id})")
+            if pause:
+                time.sleep(pause)
+        return compressed
+    finally:
         conn.close()
-        return result[0] if result else None
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in get_gsc_credentials_from_db: {e}")
-        raise HTTPException(status_code=500, detail="Database error occurred")
 
-def update_gsc_credentials_in_db(project_id, credentials_json):
-    try:
-        conn = sqlite3.connect('seo_rank_tracker.db')
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO gsc_credentials (project_id, credentials)
-            VALUES (?, ?)
-            ON CONFLICT(project_id) DO UPDATE SET credentials=excluded.credentials
-        """, (project_id, credentials_json))
-        conn.commit()
-        conn.close()
-        logging.info(f"GSC credentials updated for project_id={project_id}")
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in update_gsc_credentials_in_db: {e}")
-        raise HTTPException(status_code=500, detail="Database error occurred")
+def benchmark_serp_full_data_compression(sample_size: int = 200) -> Dict:
+    """
+    Measures size and throughput of the full_data compression on a sample of
+    the stored SERP snapshots.
 
-def add_gsc_data(project_id, keyword, date, clicks, impressions, ctr, position):
+    Returns:
+        Dict: Raw and compressed byte counts, the ratio and MB/s for encoding and decoding.
+    """
     conn = get_db_connection()
-    c = conn.cursor()
-    
-    # First, get the keyword_id
-    c.execute("SELECT id FROM keywords WHERE project_id = ? AND keyword = ?", (project_id, keyword))
-    result = c.fetchone()
-    if result:
-        keyword_id = result[0]
-    else:
-        # If the keyword doesn't exist, create it
-        c.execute("INSERT INTO keywords (project_id, keyword) VALUES (?, ?)", (project_id, keyword))
-        keyword_id = c.lastrowid
-    
-    c.execute('''INSERT OR REPLACE INTO gsc_data 
-                 (keyword_id, date, clicks, impressions, ctr, position)
-                 VALUES (?, ?, ?, ?, ?, ?)''',
-              (keyword_id, date, clicks, impressions, ctr, position))
-    conn.commit()
+    rows = conn.execute(
+        "SELECT full_data FROM serp_data ORDER BY id DESC LIMIT ?", (sample_size,)).fetchall()
     conn.close()
-    logging.info(f"Added GSC data for keyword_id: {keyword_id}, date: {date}")
 
-# async def backfill_gsc_data(project_id, keyword_id, keyword):
-#     # Get the earliest date we have data for
-#     conn = get_db_connection()
-#     c = conn.cursor()
-#     c.execute("SELECT MIN(date) FROM gsc_data WHERE keyword_id = ?", (keyword_id,))
-#     earliest_date = c.fetchone()[0]
-#     conn.close()
+    snapshots = [decode_full_data(row['full_data']) for row in rows]
+    raw = [json.dumps(snapshot).encode('utf-8') for snapshot in snapshots]
+    raw_bytes = sum(len(r) for r in raw)
 
-#     if earliest_date:
-#         earliest_date = datetime.strptime(earliest_date, "%Y-%m-%d").date()
-#         end_date = earliest_date - timedelta(days=1)
-#         start_date = end_date - timedelta(days=30)  # Backfill up to 30 days
+    start = time.perf_counter()
+    encoded = [encode_full_data(snapshot) for snapshot in snapshots]
+    encode_seconds = time.perf_counter() - start
+    compressed_bytes = sum(len(e) for e in encoded)
 
-#         gsc_data = await fetch_gsc_data(project_id, keyword, start_date, end_date)
-#         add_gsc_data(project_id, keyword_id, gsc_data)
-    
-def add_gsc_data_by_keyword_id(keyword_id, date, clicks, impressions, ctr, position, query, page):
+    start = time.perf_counter()
+    for e in encoded:
+        decode_full_data(e)
+    decode_seconds = time.perf_counter() - start
+
+    megabytes = raw_bytes / (1024 * 1024)
+    return {
+        "rows": len(snapshots),
+        "raw_bytes": raw_bytes,
+        "compressed_bytes": compressed_bytes,
+        "ratio": raw_bytes / compressed_bytes if compressed_bytes else 0.0,
+        "encode_mb_per_s": megabytes / encode_seconds if encode_seconds else 0.0,
+        "decode_mb_per_s": megabytes / decode_seconds if decode_seconds else 0.0
+    }
+
+def serp_result_rows(serp_data_id, keyword_id, date, serp_data: Dict) -> List[Tuple]:
+    return [
+        (serp_data_id, keyword_id, date, item.get('position'), item.get('domain'), item.get('link'))
+        for item in serp_data.get('organic_results', [])
+    ]
+
+def insert_serp_results(c, serp_data_id, keyword_id, date, serp_data: Dict):
+    """
+    Writes the organic results of one SERP snapshot to serp_results.
+
+    Runs on the caller's cursor and does not commit.
+    """
+    c.executemany('''
+        INSERT INTO serp_results (serp_data_id, keyword_id, date, position, domain, url)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', serp_result_rows(serp_data_id, keyword_id, date, serp_data))
+
+def extract_domain(url):
+    from urllib.parse import urlparse
+    parsed_url = urlparse(url)
+    domain = parsed_url.netloc or parsed_url.path
+    domain = domain.split(':')[0]  # Remove port if present
+    return domain.lower().replace('www.', '')
+
+def find_serp_rank(serp_data: Dict, project_domain: str) -> int:
+    """
+    Returns the position of the first organic result on the project's domain,
+    or -1 if the domain does not rank.
+    """
+    for item in serp_data.get('organic_results', []):
+        if extract_domain(item.get('link', '')) == project_domain:
+            return item.get('position')
+    return -1
+
+def get_cached_serp(request_key: str, max_age_seconds: float, min_depth: int = 100) -> Optional[Tuple[Dict, int]]:
+    """
+    Returns the cached SpaceSERP response for a request key if it is younger
+    than ``max_age_seconds`` and holds at least ``min_depth`` results, and
+    marks it as recently used.
+
+    Args:
+        request_key (str): Normalized keyword plus search settings.
+        max_age_seconds (float): Oldest response that may be reused.
+        min_depth (int): Fewest results (pageSize) the response must have been fetched with.
+
+    Returns:
+        Optional[Tuple[Dict, int]]: The response and the depth it was
+        fetched with, or None on a miss.
+    """
+    now = datetime.now(timezone.utc)
+    conn = get_db_connection()
+    try:
+        row = conn.execute(
+            "SELECT response, depth FROM serp_cache WHERE request_key = ? AND fetched_at >= ? AND depth >= ?",
+            (request_key, (now - timedelta(seconds=max_age_seconds)).isoformat(), min_depth)
+        ).fetchone()
+        if not row:
+            return None
+        conn.execute("UPDATE serp_cache SET last_used_at = ? WHERE request_key = ?", (now.isoformat(), request_key))
+        conn.commit()
+        return decode_full_data(row['response']), row['depth']
+    finally:
+        conn.close()
+
+def put_cached_serp(request_key: str, serp_data: Dict, max_bytes: int, depth: int = 100,
+                    keep_deeper_seconds: float = 0):
+    """
+    Caches a fresh SpaceSERP response fetched with ``depth`` results, then
+    evicts the least recently used responses until the cache fits in ``max_bytes``.
+
+    A cached response that is deeper and younger than ``keep_deeper_seconds``
+    is kept instead, so a shallow fetch does not cost the keywords that need
+    the full page a second fetch.
+    """
+    now = datetime.now(timezone.utc)
+    response = encode_full_data(serp_data)
     conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute('''
-            INSERT INTO gsc_data (keyword_id, date, clicks, impressions, ctr, position, query, page)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (keyword_id, date, clicks, impressions, ctr, position, query, page))
+            INSERT INTO serp_cache (request_key, response, depth, size, fetched_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (request_key) DO UPDATE SET
+                response = excluded.response, depth = excluded.depth, size = excluded.size,
+                fetched_at = excluded.fetched_at, last_used_at = excluded.last_used_at
+            WHERE excluded.depth >= serp_cache.depth OR serp_cache.fetched_at < ?
+        ''', (request_key, response, depth, len(response), now.isoformat(), now.isoformat(),
+              (now - timedelta(seconds=keep_deeper_seconds)).isoformat()))
+        total = c.execute("SELECT COALESCE(SUM(size), 0) FROM serp_cache").fetchone()[0]
+        if total > max_bytes:
+            evict = []
+            for row in c.execute("SELECT request_key, size FROM serp_cache ORDER BY last_used_at"):
+                if total <= max_bytes:
+                    break
+                evict.append((row['request_key'],))
+                total -= row['size']
+            c.executemany("DELETE FROM serp_cache WHERE request_key = ?", evict)
+            logging.info(f"Evicted {len(evict)} SERP cache entries")
         conn.commit()
-        logging.info(f"Added GSC data for keyword_id: {keyword_id}, date: {date}")
-    except Exception as e:
-        logging.error(f"Error adding GSC data for keyword_id {keyword_id}: {str(e)}")
     finally:
         conn.close()
 
-async def update_search_volume_if_needed(keyword):
+def clear_serp_cache() -> int:
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute("SELECT search_volume, last_volume_update FROM keywords WHERE id = ?", (keyword['id'],))
-    result = c.fetchone()
-    search_volume, last_update = result if result else (None, None)
-    
-    current_time = datetime.now()
-    should_update = (
-        search_volume is None or 
-        last_update is None or 
-        (current_time - datetime.fromisoformat(last_update)).days > 30
-    )
-    
-    if should_update:
-        search_volume = await fetch_search_volume(keyword['keyword'])
-        c.execute("UPDATE keywords SET search_volume = ?, last_volume_update = ? WHERE id = ?", 
-                  (search_volume, current_time.strftime("%Y-%m-%d %H:%M:%S"), keyword['id']))
+    try:
+        c.execute("DELETE FROM serp_cache")
         conn.commit()
-        keyword['search_volume'] = search_volume  # Update the keyword dictionary
-    else:
-        keyword['search_volume'] = search_volume
-    conn.close()
+        return c.rowcount
+    finally:
+        conn.close()
 
-def update_project_in_db(project_id, project_data):
+def write_serp_batch(records: List[Tuple[int, Dict, Optional[int], int]]) -> int:
+    """
+    Stores a batch of fetched SERPs in a single transaction: the serp_data
+    snapshots, their serp_results rows and the keyword_rank_latest entries.
+
+    Args:
+        records (List[Tuple[int, Dict, Optional[int], int]]): (keyword_id, serp_data,
+            search_volume, depth) for each fetched SERP, depth being the
+            number of results it was fetched with.
+
+    Returns:
+        int: The number of snapshots written. Records of keywords deleted in
+        the meantime are dropped.
+    """
+    current_date = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    keyword_ids = list({record[0] for record in records})
     conn = get_db_connection()
     c = conn.cursor()
     try:
-        c.execute("""
-            UPDATE projects
-            SET name = ?, domain = ?, branded_terms = ?, conversion_rate = ?, conversion_value = ?
-            WHERE id = ?
-        """, (project_data['name'], project_data['domain'], project_data['branded_terms'], 
-              project_data['conversion_rate'], project_data['conversion_value'], project_id))
+        c.execute("BEGIN IMMEDIATE")
+        # Project domain of every keyword in the batch, looked up once
+        project_domains = {
+            row[0]: extract_domain('http://' + (row[1] or '')) for row in c.execute(f'''
+                SELECT k.id, p.domain FROM keywords k
+                JOIN projects p ON p.id = k.project_id
+                WHERE k.id IN ({','.join('?' * len(keyword_ids))})
+            ''', keyword_ids)
+        }
+
+        result_rows = []
+        written_keyword_ids = []
+        for keyword_id, serp_data, search_volume, depth in records:
+            if keyword_id not in project_domains:
+                logging.warning(f"Dropping SERP data for deleted keyword_id: {keyword_id}")
+                continue
+            rank = find_serp_rank(serp_data, project_domains[keyword_id])
+            # One statement per snapshot as its id is needed for serp_results
+            c.execute('INSERT INTO serp_data (keyword_id, date, rank, full_data, search_volume, depth) VALUES (?, ?, ?, ?, ?, ?)',
+                      (keyword_id, current_date, rank, encode_full_data(serp_data), search_volume, depth))
+            result_rows.extend(serp_result_rows(c.lastrowid, keyword_id, current_date, serp_data))
+            written_keyword_ids.append(keyword_id)
+            logging.info(f"Inserted SERP data for keyword_id: {keyword_id}, rank: {rank}")
+
+        c.executemany('''
+            INSERT INTO serp_results (serp_data_id, keyword_id, date, position, domain, url)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', result_rows)
+        for keyword_id in set(written_keyword_ids):
+            refresh_keyword_rank_latest(c, keyword_id)
         conn.commit()
-        if c.rowcount > 0:
-            return get_project_by_id(project_id)
-        return None
+        return len(written_keyword_ids)
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         conn.close()
 
-def get_project_by_id(project_id):
+def backfill_serp_results(batch_size: int = 200) -> int:
+    """
+    Fills serp_results for SERP snapshots stored before the table existed.
+
+    Snapshots are processed in id order with one transaction per batch, and
+    ones that already have results are skipped, so the job can run alongside
+    ingestion and be re-run safely. Snapshots without organic results have
+    nothing to backfill and are passed over.
+
+    Returns:
+        int: The number of snapshots backfilled.
+    """
     conn = get_db_connection()
     c = conn.cursor()
-    
+    last_id = 0
+    backfilled = 0
     try:
-        # Get the list of columns in the projects table
-        c.execute("PRAGMA table_info(projects)")
-        columns = [column[1] for column in c.fetchall()]
-        
-        # Construct the SELECT statement based on existing columns
-        select_columns = ["id", "name", "domain"]
-        if "branded_terms" in columns:
-            select_columns.append("branded_terms")
-        if "conversion_rate" in columns:
-            select_columns.append("conversion_rate")
-        if "conversion_value" in columns:
-            select_columns.append("conversion_value")
-        if "user_id" in columns:
-            select_columns.append("user_id")
-        
-        select_statement = f"SELECT {', '.join(select_columns)} FROM projects WHERE id = ?"
-        
-        logging.info(f"Executing SQL: {select_statement} with project_id: {project_id}")
-        c.execute(select_statement, (project_id,))
-        project = c.fetchone()
-        
-        if project:
-            result = {
-                "id": project[0],
-                "name": project[1],
-                "domain": project[2],
-            }
-            column_index = 3  # Start after id, name, and domain
-            if "branded_terms" in columns and column_index < len(project):
+        while True:
+            rows = c.execute('''
+                SELECT s.id, s.keyword_id, s.date, s.full_data
+                FROM serp_data s
+                WHERE s.id > ?
+                AND NOT EXISTS (SELECT 1 FROM serp_results r WHERE r.serp_data_id = s.id)
+                ORDER BY s.id
+                LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    serp_data = decode_full_data(row['full_data'])
+                except (ValueError, zlib.error):
+                    logging.warning(f"Skipping serp_data id {row['id']}: full_data could not be decoded")
+                    continue
+                if serp_data.get('organic_results'):
+                    insert_serp_results(c, row['id'], row['keyword_id'], row['date'], serp_data)
+                    backfilled += 1
+            conn.commit()
+            last_id = rows[-1]['id']
+            logging.info(f"Backfilled serp_results for {backfilled} snapshots (last id {last_id})")
+        if backfilled:
+            # Aggregates computed while the backfill was running may be incomplete
+            invalidate_sov_daily(c)
+            conn.commit()
+        return backfilled
+    finally:
+        conn.close()
+
+def query_share_of_voice_aggregates(c, project_id, start_date, end_date, tag_id=None) -> Dict:
+    """
+    Aggregates position-weighted search volume per date and domain from serp_results.
+
+    Only snapshots where the project itself ranks in the top 10 count, and
+    each top-10 result contributes (11 - position) / 55 of the keyword's
+    search volume to its domain.
+
+    Returns:
+        Dict: "serp_rows" (number of snapshots in range), "weighted"
+        (list of (date, domain, weighted_volume)) and "totals"
+        (date -> total search volume of the counted snapshots).
+    """
+    tag_filter = ''
+    params = (project_id, start_date, end_date)
+    if tag_id:
+        tag_filter = ' AND k.id IN (SELECT keyword_id FROM keyword_tags WHERE tag_id = ?)'
+        params += (tag_id,)
+
+    serp_rows = c.execute('''
+        SELECT COUNT(*)
+        FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        WHERE k.project_id = ? AND s.date BETWEEN ? AND ?
+    ''' + tag_filter, params).fetchone()[0]
+
+    c.execute('''
+        SELECT s.date, SUM(COALESCE(s.search_volume, 0))
+        FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        WHERE k.project_id = ? AND s.date BETWEEN ? AND ?
+        AND s.rank BETWEEN 1 AND 10
+    ''' + tag_filter + ' GROUP BY s.date', params)
+    totals = {row[0]: row[1] for row in c.fetchall()}
+
+    c.execute('''
+        SELECT s.date, r.domain, SUM((11 - r.position) / 55.0 * COALESCE(s.search_volume, 0))
+        FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        JOIN serp_results r ON r.serp_data_id = s.id
+        WHERE k.project_id = ? AND s.date BETWEEN ? AND ?
+        AND s.rank BETWEEN 1 AND 10
+        AND r.position BETWEEN 1 AND 10
+        AND r.domain IS NOT NULL AND r.domain != ''
+    ''' + tag_filter + ' GROUP BY s.date, r.domain', params)
+    weighted = [(row[0], row[1], row[2]) for row in c.fetchall()]
+
+    return {"serp_rows": serp_rows, "weighted": weighted, "totals": totals}
+
+def get_share_of_voice_aggregates(project_id, start_date, end_date, tag_id=None) -> Dict:
+    """
+    Computes share of voice aggregates straight from serp_results, see
+    query_share_of_voice_aggregates().
+    """
+    conn = get_db_connection()
+    try:
+        return query_share_of_voice_aggregates(conn.cursor(), project_id, start_date, end_date, tag_id)
+    finally:
+        conn.close()
+
+def recompute_sov_daily_date(c, project_id, date, tag_id=0):
+    """
+    Replaces the sov_daily rows of one project, tag and date.
+
+    Runs on the caller's cursor and does not commit.
+    """
+    aggregates = query_share_of_voice_aggregates(c, project_id, date, date, tag_id)
+    total_volume = aggregates['totals'].get(date, 0) or 0
+    c.execute("DELETE FROM sov_daily WHERE project_id = ? AND tag_id = ? AND date = ?", (project_id, tag_id, date))
+    c.executemany('''
+        INSERT INTO sov_daily (project_id, tag_id, date, domain, weighted_volume, total_volume)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(project_id, tag_id, row_date, domain, weighted_volume, total_volume)
+          for row_date, domain, weighted_volume in aggregates['weighted']])
+    c.execute('''
+        INSERT OR REPLACE INTO sov_daily_dates (project_id, tag_id, date, computed_at)
+        VALUES (?, ?, ?, ?)
+    ''', (project_id, tag_id, date, datetime.now(timezone.utc).isoformat()))
+
+def update_sov_daily(project_id, date):
+    """
+    Re-aggregates one date of a project after a pull for that date completed.
+
+    Covers the whole project and every tag that already has aggregates;
+    other tags are filled lazily by get_share_of_voice_daily().
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        tag_ids = {0} | {
+            row[0] for row in c.execute(
+                "SELECT DISTINCT tag_id FROM sov_daily_dates WHERE project_id = ?", (project_id,))
+        }
+        for tag_id in tag_ids:
+            recompute_sov_daily_date(c, project_id, date, tag_id)
+        conn.commit()
+        logging.info(f"Updated sov_daily for project_id={project_id}, date={date}")
+    finally:
+        conn.close()
+
+def invalidate_sov_daily(c, project_id=None, date=None, tag_id=None):
+    """
+    Drops stored share of voice aggregates so they are recomputed on the next
+    request. Without arguments every aggregate is dropped; ``tag_id`` limits
+    it to the aggregates of one tag, e.g. after its keywords changed.
+
+    Runs on the caller's cursor and does not commit.
+    """
+    condition, params = '1 = 1', ()
+    if project_id is not None:
+        condition += ' AND project_id = ?'
+        params += (project_id,)
+    if tag_id is not None:
+        condition += ' AND tag_id = ?'
+        params += (tag_id,)
+    if date is not None:
+        condition += ' AND date = ?'
+        params += (date,)
+    c.execute('DELETE FROM sov_daily WHERE ' + condition, params)
+    c.execute('DELETE FROM sov_daily_dates WHERE ' + condition, params)
+
+def recompute_sov_daily(project_id=None, start_date=None, end_date=None) -> int:
+    """
+    Recomputes sov_daily for every date with SERP data, e.g. after a backfill.
+
+    Args:
+        project_id (int, optional): Only recompute this project.
+        start_date (str, optional): Inclusive lower date bound, 'YYYY-MM-DD'.
+        end_date (str, optional): Inclusive upper date bound, 'YYYY-MM-DD'.
+
+    Returns:
+        int: The number of (project, tag, date) aggregates written.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        query = '''
+            SELECT DISTINCT k.project_id, s.date
+            FROM serp_data s
+            JOIN keywords k ON s.keyword_id = k.id
+            WHERE 1 = 1
+        '''
+        params = ()
+        if project_id:
+            query += ' AND k.project_id = ?'
+            params += (project_id,)
+        if start_date:
+            query += ' AND s.date >= ?'
+            params += (start_date,)
+        if end_date:
+            query += ' AND s.date <= ?'
+            params += (end_date,)
+        project_dates = c.execute(query, params).fetchall()
+
+        tag_ids_by_project = defaultdict(lambda: {0})
+        for row in c.execute("SELECT DISTINCT project_id, tag_id FROM sov_daily_dates").fetchall():
+            tag_ids_by_project[row[0]].add(row[1])
+
+        count = 0
+        for row_project_id, date in project_dates:
+            for tag_id in tag_ids_by_project[row_project_id]:
+                recompute_sov_daily_date(c, row_project_id, date, tag_id)
+                count += 1
+            conn.commit()
+        logging.info(f"Recomputed {count} sov_daily aggregates")
+        return count
+    finally:
+        conn.close()
+
+def get_share_of_voice_daily(project_id, start_date, end_date, tag_id=None, live_from: Optional[str] = None) -> Dict:
+    """
+    Share of voice aggregates served from sov_daily.
+
+    Dates before `live_from` (usually today) come from sov_daily; the ones
+    that were never aggregated are computed once and stored. Dates from
+    `live_from` on may still receive pulls and are always computed live.
+
+    Returns:
+        Dict: Same shape as query_share_of_voice_aggregates(); "serp_rows" is
+        only meaningful as zero / non-zero.
+    """
+    tag_key = int(tag_id) if tag_id else 0
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        past_end = end_date
+        if live_from and live_from <= end_date:
+            past_end = (datetime.fromisoformat(live_from) - timedelta(days=1)).date().isoformat()
+
+        weighted, totals, serp_rows = [], {}, 0
+        if start_date <= past_end:
+            tag_filter = ''
+            params = (project_id, start_date, past_end)
+            if tag_key:
+                tag_filter = ' AND k.id IN (SELECT keyword_id FROM keyword_tags WHERE tag_id = ?)'
+                params += (tag_key,)
+            serp_dates = [row[0] for row in c.execute('''
+                SELECT DISTINCT s.date
+                FROM serp_data s
+                JOIN keywords k ON s.keyword_id = k.id
+                WHERE k.project_id = ? AND s.date BETWEEN ? AND ?
+            ''' + tag_filter, params).fetchall()]
+            serp_rows += len(serp_dates)
+
+            aggregated_dates = {row[0] for row in c.execute('''
+                SELECT date FROM sov_daily_dates
+                WHERE project_id = ? AND tag_id = ? AND date BETWEEN ? AND ?
+            ''', (project_id, tag_key, start_date, past_end)).fetchall()}
+            missing_dates = [date for date in serp_dates if date not in aggregated_dates]
+            for date in missing_dates:
+                recompute_sov_daily_date(c, project_id, date, tag_key)
+            if missing_dates:
+                conn.commit()
+                logging.info(f"Aggregated {len(missing_dates)} missing sov_daily dates for project_id={project_id}, tag_id={tag_key}")
+
+            for row in c.execute('''
+                SELECT date, domain, weighted_volume, total_volume FROM sov_daily
+                WHERE project_id = ? AND tag_id = ? AND date BETWEEN ? AND ?
+            ''', (project_id, tag_key, start_date, past_end)).fetchall():
+                weighted.append((row[0], row[1], row[2]))
+                totals[row[0]] = row[3]
+
+        if live_from and live_from <= end_date:
+            live = query_share_of_voice_aggregates(c, project_id, max(start_date, live_from), end_date, tag_id)
+            serp_rows += live['serp_rows']
+            weighted.extend(live['weighted'])
+            totals.update(live['totals'])
+
+        return {"serp_rows": serp_rows, "weighted": weighted, "totals": totals}
+    finally:
+        conn.close()
+
+def get_competitor_domains(project_id, start_date, end_date, max_position: int = 10, limit: int = 50) -> Dict:
+    """
+    Lists the domains most often found in the top `max_position` results of a
+    project's keywords over a date range.
+
+    Only snapshots fetched at least `max_position` deep are counted, as a
+    shallow page says nothing about the positions below it.
+
+    Returns:
+        Dict: ``data``, the domains, and ``shallow_snapshots``, the number of
+        snapshots in the range left out for being too shallow.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT r.domain, COUNT(*) AS appearances, COUNT(DISTINCT r.keyword_id) AS keywords,
+               AVG(r.position) AS avg_position, MIN(r.position) AS best_position
+        FROM serp_results r
+        JOIN keywords k ON r.keyword_id = k.id
+        JOIN serp_data s ON s.id = r.serp_data_id
+        WHERE k.project_id = ? AND r.date BETWEEN ? AND ? AND r.position BETWEEN 1 AND ?
+        AND COALESCE(s.depth, 100) >= ?
+        AND r.domain IS NOT NULL AND r.domain != ''
+        GROUP BY r.domain
+        ORDER BY appearances DESC, avg_position ASC
+        LIMIT ?
+    ''', (project_id, start_date, end_date, max_position, max_position, limit))
+    rows = c.fetchall()
+    shallow_snapshots = c.execute('''
+        SELECT COUNT(*) FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        WHERE k.project_id = ? AND s.date BETWEEN ? AND ? AND COALESCE(s.depth, 100) < ?
+    ''', (project_id, start_date, end_date, max_position)).fetchone()[0]
+    conn.close()
+    return {"data": [dict(row) for row in rows], "shallow_snapshots": shallow_snapshots}
+
+def get_ranking_urls(keyword_id, domain: Optional[str] = None, start_date=None, end_date=None) -> List[Dict]:
+    """
+    Lists which URLs ranked for a keyword on each date, optionally only for one domain.
+    """
+    query = '''
+        SELECT date, position, domain, url
+        FROM serp_results
+        WHERE keyword_id = ?
+    '''
+    params = (keyword_id,)
+    if domain:
+        query += ' AND domain = ?'
+        params += (domain,)
+    if start_date:
+        query += ' AND date >= ?'
+        params += (start_date,)
+    if end_date:
+        query += ' AND date <= ?'
+        params += (end_date,)
+    query += ' ORDER BY date DESC, position ASC'
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def get_serp_data_within_date_range(project_id, start_date, end_date, tag_id=None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    query = '''
+        SELECT s.date, s.rank, s.search_volume, p.domain, s.full_data
+        FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        JOIN projects p ON k.project_id = p.id
+        WHERE k.project_id = ? AND s.date BETWEEN ? AND ?
+    '''
+    params = (project_id, start_date, end_date)
+
+    if tag_id:
+        query += ' AND k.id IN (SELECT keyword_id FROM keyword_tags WHERE tag_id = ?)'
+        params += (tag_id,)
+
+    cursor.execute(query, params)
+    data = cursor.fetchall()
+    conn.close()
+
+    return [
+        {
+            'date': parser.parse(row['date']).date().isoformat(),
+            'rank': row['rank'],
+            'search_volume': row['search_volume'],
+            'domain': row['domain'],
+            'full_data': row['full_data']
+        }
+        for row in data
+    ]
+
+def build_rank_data_query(project_id=None, tag_id=None, start_date=None, end_date=None,
+                          keyword_prefix=None, after=None, limit=None):
+    """
+    Builds the /api/rankData query together with its parameters.
+
+    Every SERP row is joined with its keyword, project and the latest GSC row
+    recorded on or before the SERP date. The GSC lookup is a correlated
+    "latest on or before" subquery answered from idx_gsc_data_keyword_id_date,
+    so the whole result set is built without any per-row round trips.
+
+    Rows are ordered newest first on (date, id), which is also the keyset used
+    for pagination: pass the (date, id) of the last row of a page as `after`
+    to get the next one.
+
+    Args:
+        project_id (int, optional): Only return rows of this project.
+        tag_id (int, optional): Only return rows of keywords with this tag.
+        start_date (str, optional): Inclusive lower date bound, 'YYYY-MM-DD'.
+        end_date (str, optional): Inclusive upper date bound, 'YYYY-MM-DD'.
+        keyword_prefix (str, optional): Case-sensitive keyword prefix.
+        after (Tuple[str, int], optional): Keyset (date, id) to continue after.
+        limit (int, optional): Maximum number of rows to return.
+
+    Returns:
+        Tuple[str, tuple]: The SQL statement and its parameters.
+    """
+    query = '''
+        SELECT s.id, s.date, k.keyword, p.domain, s.rank, k.id AS keyword_id,
+               p.id AS project_id, s.search_volume, p.conversion_rate, p.conversion_value,
+               g.date AS gsc_date, g.position AS gsc_position, g.clicks AS gsc_clicks,
+               g.impressions AS gsc_impressions, g.ctr AS gsc_ctr,
+               g.query AS gsc_query, g.page AS gsc_page
+        FROM serp_data s
+        JOIN keywords k ON s.keyword_id = k.id
+        JOIN projects p ON k.project_id = p.id
+        LEFT JOIN gsc_data g ON g.id = (
+            SELECT g2.id
+            FROM gsc_data g2
+            WHERE g2.keyword_id = s.keyword_id AND g2.date <= s.date
+            ORDER BY g2.date DESC, g2.id ASC
+            LIMIT 1
+        )
+        WHERE 1 = 1
+    '''
+    params = ()
+
+    if project_id:
+        query += ' AND k.project_id = ?'
+        params += (project_id,)
+    if tag_id:
+        query += ' AND k.id IN (SELECT keyword_id FROM keyword_tags WHERE tag_id = ?)'
+        params += (tag_id,)
+    if start_date:
+        query += ' AND s.date >= ?'
+        params += (start_date,)
+    if end_date:
+        query += ' AND s.date <= ?'
+        params += (end_date,)
+    if keyword_prefix:
+        # A range instead of LIKE so idx_keywords_project_id_keyword can be used
+        query += ' AND k.keyword >= ? AND k.keyword < ?'
+        params += (keyword_prefix, keyword_prefix + '\U0010ffff')
+    if after:
+        after_date, after_id = after
+        query += ' AND (s.date < ? OR (s.date = ? AND s.id < ?))'
+        params += (after_date, after_date, after_id)
+
+    query += ' ORDER BY s.date DESC, s.id DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params += (limit,)
+
+    return query, params
+
+def get_rank_data_rows(**filters):
+    """
+    Retrieves rank rows, see build_rank_data_query() for the accepted filters.
+
+    Returns:
+        List[sqlite3.Row]: Rank rows; the gsc_* columns are NULL when the
+        keyword has no GSC data up to that date.
+    """
+    query, params = build_rank_data_query(**filters)
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+def iter_query_rows(query, params=(), batch_size=500):
+    """
+    Lazily yields the rows of a query, fetching them `batch_size` at a time.
+
+    Unlike fetchall(), memory use stays bounded by the batch size no matter how
+    many rows match. The connection is closed once the generator is exhausted
+    or closed.
+    """
+    conn = get_db_connection()
+    try:
+        c = conn.cursor()
+        c.execute(query, params)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        conn.close()
+
+def iter_rank_data_rows(**filters):
+    """
+    Streaming counterpart of get_rank_data_rows().
+    """
+    query, params = build_rank_data_query(**filters)
+    return iter_query_rows(query, params)
+
+def estimate_business_impact(rank, search_volume, ctr_by_rank: Optional[np.ndarray], conversion_rate, conversion_value) -> float:
+    """
+    Estimates the business impact of a rank: CTR at that rank * search volume
+    * conversion rate * conversion value.
+
+    Args:
+        rank (int): The rank position (-1 when not ranking).
+        search_volume (int): The keyword's search volume, may be None.
+        ctr_by_rank (np.ndarray, optional): The project's CTR curve as returned
+            by get_ctr_curve_array().
+        conversion_rate (float): The project's conversion rate, may be None.
+        conversion_value (float): The project's conversion value, may be None.
+
+    Returns:
+        float: The estimated business impact, 0.0 when it cannot be estimated.
+    """
+    if search_volume is None:
+        return 0.0
+    avg_ctr = float(ctr_by_rank[rank]) if ctr_by_rank is not None and rank and 1 <= rank <= 100 else 0.0
+    return avg_ctr * search_volume * (conversion_rate or 0.0) * (conversion_value or 0.0)
+
+def refresh_keyword_rank_latest(c, keyword_id):
+    """
+    Recomputes the keyword_rank_latest row of one keyword from serp_data.
+
+    Runs on the caller's cursor and does not commit, so it can share the
+    transaction of the write that triggered it.
+
+    Args:
+        c (sqlite3.Cursor): Cursor to run the queries on.
+        keyword_id (int): The ID of the keyword.
+    """
+    project = c.execute('''
+        SELECT p.id
+        FROM keywords k
+        JOIN projects p ON k.project_id = p.id
+        WHERE k.id = ?
+    ''', (keyword_id,)).fetchone()
+    current = c.execute('''
+        SELECT id, date, rank, search_volume
+        FROM serp_data
+        WHERE keyword_id = ?
+        ORDER BY date DESC, id DESC
+        LIMIT 1
+    ''', (keyword_id,)).fetchone()
+
+    if not project or not current:
+        c.execute("DELETE FROM keyword_rank_latest WHERE keyword_id = ?", (keyword_id,))
+        return
+
+    previous = c.execute('''
+        SELECT date, rank, search_volume
+        FROM serp_data
+        WHERE keyword_id = ? AND date < ?
+        ORDER BY date DESC, id DESC
+        LIMIT 1
+    ''', (keyword_id, current[1])).fetchone()
+
+    previous_date, previous_rank, previous_search_volume = previous if previous else (None, None, None)
+
+    c.execute('''
+        INSERT INTO keyword_rank_latest
+        (keyword_id, project_id, serp_data_id, date, rank, search_volume,
+         previous_date, previous_rank, previous_search_volume)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(keyword_id) DO UPDATE SET
+            project_id = excluded.project_id,
+            serp_data_id = excluded.serp_data_id,
+            date = excluded.date,
+            rank = excluded.rank,
+            search_volume = excluded.search_volume,
+            previous_date = excluded.previous_date,
+            previous_rank = excluded.previous_rank,
+            previous_search_volume = excluded.previous_search_volume
+    ''', (keyword_id, project[0], current[0], current[1], current[2], current[3],
+          previous_date, previous_rank, previous_search_volume))
+
+def rebuild_keyword_rank_latest() -> int:
+    """
+    Rebuilds keyword_rank_latest from scratch for every keyword, e.g. after
+    restoring a backup.
+
+    Returns:
+        int: The number of keywords with rank data.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        keyword_ids = [row[0] for row in c.execute("SELECT id FROM keywords").fetchall()]
+        c.execute("DELETE FROM keyword_rank_latest")
+        for keyword_id in keyword_ids:
+            refresh_keyword_rank_latest(c, keyword_id)
+        conn.commit()
+        count = c.execute("SELECT COUNT(*) FROM keyword_rank_latest").fetchone()[0]
+        logging.info(f"Rebuilt keyword_rank_latest for {count} keywords")
+        return count
+    except sqlite3.Error as e:
+        conn.rollback()
+        logging.error(f"SQLite error in rebuild_keyword_rank_latest: {e}")
+        raise
+    finally:
+        conn.close()
+
+def get_keyword_rank_latest(project_id: Optional[int] = None, tag_id: Optional[int] = None) -> List[Dict]:
+    """
+    Retrieves the current rank, previous rank and their delta for every keyword.
+    Business impact is estimated here from the project's current CTR curve
+    and conversion settings, so it never lags behind changes to either.
+
+    Args:
+        project_id (int, optional): Only return keywords of this project.
+        tag_id (int, optional): Only return keywords with this tag.
+
+    Returns:
+        List[Dict]: One entry per keyword with rank data.
+    """
+    query = '''
+        SELECT l.keyword_id, k.keyword, l.project_id, p.domain, l.serp_data_id, l.date, l.rank,
+               l.search_volume, l.previous_date, l.previous_rank, l.previous_search_volume,
+               p.conversion_rate, p.conversion_value
+        FROM keyword_rank_latest l
+        JOIN keywords k ON l.keyword_id = k.id
+        JOIN projects p ON l.project_id = p.id
+        WHERE 1 = 1
+    '''
+    params = ()
+    if project_id:
+        query += ' AND l.project_id = ?'
+        params += (project_id,)
+    if tag_id:
+        query += ' AND l.keyword_id IN (SELECT keyword_id FROM keyword_tags WHERE tag_id = ?)'
+        params += (tag_id,)
+
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute(query, params)
+    rows = c.fetchall()
+    conn.close()
+
+    result = []
+    for row in rows:
+        entry = dict(row)
+        conversion_rate = entry.pop('conversion_rate')
+        conversion_value = entry.pop('conversion_value')
+        ctr_curve = get_ctr_curve_array(row['project_id'])
+        ranked_now = row['rank'] is not None and row['rank'] > 0
+        ranked_before = row['previous_rank'] is not None and row['previous_rank'] > 0
+        # Positive values mean the keyword moved up
+        entry['rank_change'] = row['previous_rank'] - row['rank'] if ranked_now and ranked_before else None
+        entry['estimated_business_impact'] = estimate_business_impact(
+            row['rank'], row['search_volume'], ctr_curve, conversion_rate, conversion_value)
+        if row['previous_date'] is not None:
+            entry['previous_estimated_business_impact'] = estimate_business_impact(
+                row['previous_rank'], row['previous_search_volume'], ctr_curve, conversion_rate, conversion_value)
+            entry['estimated_business_impact_change'] = (
+                entry['estimated_business_impact'] - entry['previous_estimated_business_impact'])
+        else:
+            entry['previous_estimated_business_impact'] = None
+            entry['estimated_business_impact_change'] = None
+        result.append(entry)
+    return result
+
+def create_gsc_data_table():
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS gsc_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                keyword_id INTEGER,
+                date TEXT NOT NULL,
+                clicks INTEGER,
+                impressions INTEGER,
+                ctr REAL,
+                position REAL,
+                query TEXT,
+                page TEXT,
+                FOREIGN KEY (keyword_id) REFERENCES keywords (id)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS gsc_credentials
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  project_id INTEGER UNIQUE,
+                  credentials TEXT,
+                  FOREIGN KEY (project_id) REFERENCES projects (id))''')
+    conn.commit()
+    conn.close()
+
+def get_gsc_credentials_from_db(project_id):
+    try:
+        conn = sqlite3.connect('seo_rank_tracker.db')
+        c = conn.cursor()
+        c.execute("SELECT credentials FROM gsc_credentials WHERE project_id = ?", (project_id,))
+        result = c.fetchone()
+        conn.close()
+        return result[0] if result else None
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error in get_gsc_credentials_from_db: {e}")
+        raise HTTPException(status_code=500, detail="Database error occurred")
+
+def update_gsc_credentials_in_db(project_id, credentials_json):
+    try:
+        conn = sqlite3.connect('seo_rank_tracker.db')
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO gsc_credentials (project_id, credentials)
+            VALUES (?, ?)
+            ON CONFLICT(project_id) DO UPDATE SET credentials=excluded.credentials
+        """, (project_id, credentials_json))
+        conn.commit()
+        conn.close()
+        logging.info(f"GSC credentials updated for project_id={project_id}")
+    except sqlite3.Error as e:
+        logging.error(f"SQLite error in update_gsc_credentials_in_db: {e}")
+        raise HTTPException(status_code=500, detail="Database error occurred")
+
+# async def backfill_gsc_data(project_id, keyword_id, keyword):
+#     # Get the earliest date we have data for
+#     conn = get_db_connection()
+#     c = conn.cursor()
+#     c.execute("SELECT MIN(date) FROM gsc_data WHERE keyword_id = ?", (keyword_id,))
+#     earliest_date = c.fetchone()[0]
+#     conn.close()
+
+#     if earliest_date:
+#         earliest_date = datetime.strptime(earliest_date, "%Y-%m-%d").date()
+#         end_date = earliest_date - timedelta(days=1)
+#         start_date = end_date - timedelta(days=30)  # Backfill up to 30 days
+
+#         gsc_data = await fetch_gsc_data(project_id, keyword, start_date, end_date)
+#         add_gsc_data(project_id, keyword_id, gsc_data)
+    
+def add_gsc_data_by_keyword_id(keyword_id, date, clicks, impressions, ctr, position, query, page):
+    try:
+        upsert_gsc_data([(keyword_id, date, clicks, impressions, ctr, position, query, page)])
+        logging.info(f"Added GSC data for keyword_id: {keyword_id}, date: {date}")
+    except Exception as e:
+        logging.error(f"Error adding GSC data for keyword_id {keyword_id}: {str(e)}")
+
+def upsert_gsc_data(rows: List[Tuple]) -> int:
+    """
+    Writes GSC rows in one transaction. A row for a keyword, date, query and
+    page that is already stored is updated in place, so overlapping syncs do
+    not create duplicates. Without the unique index, which init_db() creates
+    after removing duplicates, rows are appended and a warning is logged.
+
+    Args:
+        rows (List[Tuple]): (keyword_id, date, clicks, impressions, ctr, position, query, page) tuples.
+
+    Returns:
+        int: The number of rows written.
+    """
+    if not rows:
+        return 0
+    conn = get_db_connection()
+    try:
+        try:
+            conn.executemany('''
+                INSERT INTO gsc_data (keyword_id, date, clicks, impressions, ctr, position, query, page)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (keyword_id, date, query, page) DO UPDATE SET
+                    clicks = excluded.clicks,
+                    impressions = excluded.impressions,
+                    ctr = excluded.ctr,
+                    position = excluded.position
+            ''', rows)
+        except sqlite3.OperationalError as e:
+            if 'ON CONFLICT' not in str(e):
+                raise
+            conn.rollback()
+            logging.warning(f"gsc_data has no unique index, appending {len(rows)} GSC rows that may duplicate "
+                            f"stored ones. Run `python manage.py dedup-gsc-data` to remove duplicates")
+            conn.executemany('''
+                INSERT INTO gsc_data (keyword_id, date, clicks, impressions, ctr, position, query, page)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+def dedup_gsc_data() -> int:
+    """
+    One-off migration: deletes duplicate gsc_data rows, keeping the most
+    recently stored row of each keyword, date, query and page, then creates
+    the unique index that keeps the table free of duplicates.
+
+    The cached CTR curve of each project that lost rows is then recalculated
+    over its original date range, as the duplicates skewed it. A running
+    server picks the new curves up without a restart.
+
+    Returns:
+        int: The number of rows deleted.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute('''
+            CREATE TEMP TABLE gsc_data_duplicates AS
+            SELECT id, keyword_id FROM gsc_data WHERE id NOT IN (
+                SELECT MAX(id) FROM gsc_data GROUP BY keyword_id, date, query, page
+            )
+        ''')
+        curves = c.execute('''
+            SELECT project_id, date_range_start, date_range_end FROM ctr_cache
+            WHERE project_id IN (
+                SELECT k.project_id FROM gsc_data_duplicates d JOIN keywords k ON k.id = d.keyword_id
+            )
+        ''').fetchall()
+        c.execute("DELETE FROM gsc_data WHERE id IN (SELECT id FROM gsc_data_duplicates)")
+        deleted = c.rowcount
+        c.execute("DROP TABLE gsc_data_duplicates")
+        c.execute(GSC_DATA_UNIQUE_INDEX_SQL)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    logging.info(f"Deleted {deleted} duplicate gsc_data rows")
+
+    for curve in curves:
+        gsc_data = fetch_gsc_data_for_domain(curve['project_id'], curve['date_range_start'], curve['date_range_end'])
+        set_ctr_cache(curve['project_id'], compute_avg_ctr_per_position(gsc_data), datetime.now(timezone.utc),
+                      curve['date_range_start'], curve['date_range_end'])
+        logging.info(f"Recalculated the CTR curve of project {curve['project_id']} without duplicate GSC rows")
+    return deleted
+
+def normalize_keyword(keyword: str) -> str:
+    return ' '.join(keyword.lower().split())
+
+def get_cached_volumes(keywords: List[str], country: str = VOLUME_COUNTRY, language: str = VOLUME_LANGUAGE,
+                       max_age_days: Optional[float] = None) -> Dict[str, int]:
+    """
+    Returns the volumes in volume_cache younger than ``max_age_days``
+    (default VOLUME_CACHE_TTL_DAYS), keyed by the keywords as given.
+    """
+    terms = list({normalize_keyword(keyword) for keyword in keywords})
+    if not terms:
+        return {}
+    if max_age_days is None:
+        max_age_days = VOLUME_CACHE_TTL_DAYS
+    fresh_after = (datetime.now(timezone.utc) - timedelta(days=max_age_days)).isoformat()
+    volumes = {}
+    conn = get_db_connection()
+    try:
+        # Chunked to stay under SQLite's bound parameter limit
+        for start in range(0, len(terms), 500):
+            chunk = terms[start:start + 500]
+            for row in conn.execute(f'''
+                SELECT term_normalized, volume FROM volume_cache
+                WHERE country = ? AND language = ? AND fetched_at >= ?
+                  AND term_normalized IN ({','.join('?' * len(chunk))})
+            ''', (country, language, fresh_after, *chunk)):
+                volumes[row['term_normalized']] = row['volume']
+    finally:
+        conn.close()
+    return {keyword: volumes[normalize_keyword(keyword)] for keyword in keywords
+            if normalize_keyword(keyword) in volumes}
+
+def put_cached_volumes(volumes: Dict[str, int], country: str = VOLUME_COUNTRY, language: str = VOLUME_LANGUAGE):
+    """Stores freshly looked-up volumes in volume_cache."""
+    now = datetime.now(timezone.utc).isoformat()
+    conn = get_db_connection()
+    try:
+        conn.executemany('''
+            INSERT INTO volume_cache (term_normalized, country, language, volume, fetched_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (term_normalized, country, language)
+            DO UPDATE SET volume = excluded.volume, fetched_at = excluded.fetched_at
+        ''', [(normalize_keyword(keyword), country, language, volume, now) for keyword, volume in volumes.items()])
+        conn.commit()
+    finally:
+        conn.close()
+
+async def get_search_volume(keyword: str) -> Optional[int]:
+    """
+    Returns the search volume of a keyword from volume_cache, looking it up
+    with Grepwords and caching it when missing or expired.
+
+    Returns:
+        Optional[int]: The volume, or None if the lookup failed. Failed
+        lookups are not cached, so they are retried on the next call.
+    """
+    cached = get_cached_volumes([keyword])
+    if keyword in cached:
+        return cached[keyword]
+    try:
+        volume = await fetch_search_volume(keyword)
+    except Exception as e:
+        logging.error(f"Search volume lookup for '{keyword}' failed: {getattr(e, 'detail', None) or e}")
+        return None
+    put_cached_volumes({keyword: volume})
+    return volume
+
+async def get_search_volumes(keywords: List[str], max_age_days: Optional[float] = None) -> Dict[str, int]:
+    """
+    Bulk version of get_search_volume(): one cache read, then concurrent
+    Grepwords lookups for the misses. ``max_age_days`` overrides the TTL.
+    """
+    volumes = get_cached_volumes(keywords, max_age_days=max_age_days)
+    missing = [keyword for keyword in keywords if keyword not in volumes]
+    if missing:
+        fetched = await fetch_search_volumes(missing)
+        put_cached_volumes(fetched)
+        volumes.update(fetched)
+    return volumes
+
+def get_volume_refresh_candidates(limit: int, min_age_days: float) -> List[Dict]:
+    """
+    Returns up to ``limit`` active keywords whose search volume should be
+    refreshed: never looked up first, then those past VOLUME_CACHE_TTL_DAYS,
+    oldest first, then those older than ``min_age_days`` by business impact.
+    Only the VOLUME_REFRESH_SCORED_SLICE oldest keywords per free slot of the
+    last tier are scored.
+    """
+    now = datetime.now(timezone.utc)
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('''
+            SELECT id, keyword FROM keywords
+            WHERE active = 1 AND (search_volume IS NULL OR last_volume_update IS NULL)
+            ORDER BY id
+            LIMIT ?
+        ''', (limit,)).fetchall()
+        if len(rows) < limit:
+            rows += conn.execute('''
+                SELECT id, keyword FROM keywords
+                WHERE active = 1 AND search_volume IS NOT NULL
+                  AND datetime(last_volume_update) < datetime(?)
+                ORDER BY datetime(last_volume_update), id
+                LIMIT ?
+            ''', ((now - timedelta(days=VOLUME_CACHE_TTL_DAYS)).isoformat(), limit - len(rows))).fetchall()
+        scored = []
+        if len(rows) < limit:
+            scored = conn.execute('''
+                SELECT k.id, k.keyword, k.project_id, r.rank, r.search_volume,
+                       p.conversion_rate, p.conversion_value
+                FROM keywords k
+                LEFT JOIN projects p ON p.id = k.project_id
+                LEFT JOIN keyword_rank_latest r ON r.keyword_id = k.id
+                WHERE k.active = 1 AND k.search_volume IS NOT NULL
+                  AND datetime(k.last_volume_update) >= datetime(?)
+                  AND datetime(k.last_volume_update) < datetime(?)
+                ORDER BY datetime(k.last_volume_update), k.id
+                LIMIT ?
+            ''', ((now - timedelta(days=VOLUME_CACHE_TTL_DAYS)).isoformat(),
+                  (now - timedelta(days=min_age_days)).isoformat(),
+                  (limit - len(rows)) * VOLUME_REFRESH_SCORED_SLICE)).fetchall()
+    finally:
+        conn.close()
+
+    def impact(row):
+        if row['rank'] is None:
+            return 0.0
+        return estimate_business_impact(row['rank'], row['search_volume'], get_ctr_curve_array(row['project_id']),
+                                        row['conversion_rate'], row['conversion_value'])
+
+    # sorted() is stable, so equal impacts keep the oldest-first order
+    rows += sorted(scored, key=impact, reverse=True)[:limit - len(rows)]
+    return [{"id": row['id'], "keyword": row['keyword']} for row in rows]
+
+def set_search_volumes(volumes: List[Tuple[int, int]]):
+    """
+    Stores looked-up search volumes in a single executemany UPDATE.
+
+    Args:
+        volumes (List[Tuple[int, int]]): (keyword_id, search_volume) pairs.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    conn = get_db_connection()
+    try:
+        conn.executemany(
+            "UPDATE keywords SET search_volume = ?, last_volume_update = ? WHERE id = ?",
+            [(volume, now, keyword_id) for keyword_id, volume in volumes]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+PROJECT_UPDATE_COLUMNS = ('name', 'domain', 'branded_terms', 'conversion_rate', 'conversion_value',
+                          'serp_cache_max_age_hours')
+
+def update_project_in_db(project_id, project_data):
+    """
+    Updates the columns present in ``project_data``; columns left out of the
+    request keep their stored value.
+    """
+    columns = [column for column in PROJECT_UPDATE_COLUMNS if column in project_data]
+    if not columns:
+        return get_project_by_id(project_id)
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute(f"""
+            UPDATE projects
+            SET {', '.join(f'{column} = ?' for column in columns)}
+            WHERE id = ?
+        """, [project_data[column] for column in columns] + [project_id])
+        conn.commit()
+        if c.rowcount > 0:
+            return get_project_by_id(project_id)
+        return None
+    finally:
+        conn.close()
+
+def get_project_by_id(project_id):
+    conn = get_db_connection()
+    c = conn.cursor()
+    
+    try:
+        # Get the list of columns in the projects table
+        c.execute("PRAGMA table_info(projects)")
+        columns = [column[1] for column in c.fetchall()]
+        
+        # Construct the SELECT statement based on existing columns
+        select_columns = ["id", "name", "domain"]
+        if "branded_terms" in columns:
+            select_columns.append("branded_terms")
+        if "conversion_rate" in columns:
+            select_columns.append("conversion_rate")
+        if "conversion_value" in columns:
+            select_columns.append("conversion_value")
+        if "user_id" in columns:
+            select_columns.append("user_id")
+        if "serp_cache_max_age_hours" in columns:
+            select_columns.append("serp_cache_max_age_hours")
+        
+        select_statement = f"SELECT {', '.join(select_columns)} FROM projects WHERE id = ?"
+        
+        logging.info(f"Executing SQL: {select_statement} with project_id: {project_id}")
+        c.execute(select_statement, (project_id,))
+        project = c.fetchone()
+        
+        if project:
+            result = {
+                "id": project[0],
+                "name": project[1],
+                "domain": project[2],
+            }
+            column_index = 3  # Start after id, name, and domain
+            if "branded_terms" in columns and column_index < len(project):
                 result["branded_terms"] = project[column_index]
                 column_index += 1
             if "conversion_rate" in columns and column_index < len(project):
@@ -453,6 +1789,9 @@ def get_project_by_id(project_id):
                 column_index += 1
             if "user_id" in columns and column_index < len(project):
                 result["user_id"] = project[column_index]
+                column_index += 1
+            if "serp_cache_max_age_hours" in columns and column_index < len(project):
+                result["serp_cache_max_age_hours"] = project[column_index]
             
             logging.info(f"Retrieved project: {result}")
             return result
@@ -490,6 +1829,62 @@ def get_ctr_cache(project_id: int) -> Optional[Dict]:
         }
     return None
 
+def ctr_curve_to_array(avg_ctr_per_position: Dict) -> np.ndarray:
+    """
+    Converts an avg_ctr_per_position dict into a 101-slot array indexed by rank.
+
+    Slot 0 is unused and ranks missing from the curve are 0.0, so a lookup is
+    just ctr_by_rank[rank] for any rank between 1 and 100.
+    """
+    ctr_by_rank = np.zeros(101)
+    for position, ctr in avg_ctr_per_position.items():
+        position = int(position)
+        if 1 <= position <= 100:
+            ctr_by_rank[position] = float(ctr)
+    return ctr_by_rank
+
+def invalidate_ctr_curve(project_id: int):
+    """
+    Bumps the in-process version stamp of a project's CTR curve, so the next
+    lookup reloads it from ctr_cache.
+    """
+    with ctr_curve_lock:
+        ctr_curve_versions[project_id] += 1
+
+def get_cached_ctr_entry(project_id: int) -> Optional[Dict]:
+    """
+    In-process counterpart of get_ctr_cache().
+
+    The entry additionally holds the curve as a "ctr_by_rank" array. It is only
+    re-read from SQLite after invalidate_ctr_curve() bumped the project's
+    version, which set_ctr_cache() and GSC ingestion do.
+
+    Returns:
+        Optional[Dict]: The cache entry, or None if the project has no CTR cache.
+    """
+    with ctr_curve_lock:
+        version = ctr_curve_versions[project_id]
+        cached = ctr_curve_entries.get(project_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    entry = get_ctr_cache(project_id)
+    if entry:
+        entry["ctr_by_rank"] = ctr_curve_to_array(entry["avg_ctr_per_position"])
+    with ctr_curve_lock:
+        # Only store it if the curve was not invalidated while loading
+        if ctr_curve_versions[project_id] == version:
+            ctr_curve_entries[project_id] = (version, entry)
+    return entry
+
+def get_ctr_curve_array(project_id: int) -> Optional[np.ndarray]:
+    """
+    Returns the project's CTR curve as a 101-slot array indexed by rank, or
+    None if the project has no CTR cache.
+    """
+    entry = get_cached_ctr_entry(project_id)
+    return entry["ctr_by_rank"] if entry else None
+
 def set_ctr_cache(project_id: int, avg_ctr_per_position: Dict, last_updated: datetime, start_date: str, end_date: str):
     conn = get_db_connection()
     c = conn.cursor()
@@ -503,9 +1898,239 @@ def set_ctr_cache(project_id: int, avg_ctr_per_position: Dict, last_updated: dat
         start_date,
         end_date
     ))
-    last_updated.isoformat()
     conn.commit()
     conn.close()
+    invalidate_ctr_curve(project_id)
+
+# From https://www.advancedwebranking.com/free-seo-tools/google-organic-ctr
+# Non-branded CTR curve August 2024 (only from 1-20)
+standard_ctr_curve = {
+    1: 0.2688,  # 26.88%
+    2: 0.1173,  # 11.73%
+    3: 0.0708,  # 7.08%
+    4: 0.0466,  # 4.66%
+    5: 0.0329,  # 3.29%
+    6: 0.0235,  # 2.35%
+    7: 0.0177,  # 1.77%
+    8: 0.0135,  # 1.35%
+    9: 0.0109,  # 1.09%
+    10: 0.0088,  # 0.88%
+    11: 0.0072,  # 0.72%
+    12: 0.007,  # 0.7%
+    13: 0.0066,  # 0.66%
+    14: 0.0063,  # 0.63%
+    15: 0.0066,  # 0.66%
+    16: 0.0068,  # 0.68%
+    17: 0.0075,  # 0.75%
+    18: 0.008,  # 0.8%
+    19: 0.0067,  # 0.67%
+    20: 0.0069,  # 0.69%
+    21: 0.0069,  # 0.69%
+    22: 0.0069,  # 0.69%
+    23: 0.0069,  # 0.69%
+    24: 0.0069,  # 0.69%
+    25: 0.0069,  # 0.69%
+    26: 0.0069,  # 0.69%
+    27: 0.0069,  # 0.69%
+    28: 0.0069,  # 0.69%
+    29: 0.0069,  # 0.69%
+    30: 0.0039,  # 0.39%
+    31: 0.0039,  # 0.39%
+    32: 0.0039,  # 0.39%
+    33: 0.0039,  # 0.39%
+    34: 0.0039,  # 0.39%
+    35: 0.0039,  # 0.39%
+    36: 0.0039,  # 0.39%
+    37: 0.0039,  # 0.39%
+    38: 0.0039,  # 0.39%
+    39: 0.0039,  # 0.39%
+    40: 0.0019,  # 0.19%
+    41: 0.0019,  # 0.19%
+    42: 0.0019,  # 0.19%
+    43: 0.0019,  # 0.19%
+    44: 0.0019,  # 0.19%
+    45: 0.0019,  # 0.19%
+    46: 0.0019,  # 0.19%
+    47: 0.0019,  # 0.19%
+    48: 0.0019,  # 0.19%
+    49: 0.0019,  # 0.19%
+    50: 0.00095,  # 0.095%
+    51: 0.00095,  # 0.095%
+    52: 0.00095,  # 0.095%
+    53: 0.00095,  # 0.095%
+    54: 0.00095,  # 0.095%
+    55: 0.00095,  # 0.095%
+    56: 0.00095,  # 0.095%
+    57: 0.00095,  # 0.095%
+    58: 0.00095,  # 0.095%
+    59: 0.00095,  # 0.095%
+    60: 0.000475,  # 0.0475%
+    61: 0.000475,  # 0.0475%
+    62: 0.000475,  # 0.0475%
+    63: 0.000475,  # 0.0475%
+    64: 0.000475,  # 0.0475%
+    65: 0.000475,  # 0.0475%
+    66: 0.000475,  # 0.0475%
+    67: 0.000475,  # 0.0475%
+    68: 0.000475,  # 0.0475%
+    69: 0.000475,  # 0.0475%
+    70: 0.0002375,  # 0.02375%
+    71: 0.0002375,  # 0.02375%
+    72: 0.0002375,  # 0.02375%
+    73: 0.0002375,  # 0.02375%
+    74: 0.0002375,  # 0.02375%
+    75: 0.0002375,  # 0.02375%
+    76: 0.0002375,  # 0.02375%
+    77: 0.0002375,  # 0.02375%
+    78: 0.0002375,  # 0.02375%
+    79: 0.0002375,  # 0.02375%
+    80: 0.00011875,  # 0.011875%
+    81: 0.00011875,  # 0.011875%
+    82: 0.00011875,  # 0.011875%
+    83: 0.00011875,  # 0.011875%
+    84: 0.00011875,  # 0.011875%
+    85: 0.00011875,  # 0.011875%
+    86: 0.00011875,  # 0.011875%
+    87: 0.00011875,  # 0.011875%
+    88: 0.00011875,  # 0.011875%
+    89: 0.00011875,  # 0.011875%
+    90: 0.000059375,  # 0.0059375%
+    91: 0.000059375,  # 0.0059375%
+    92: 0.000059375,  # 0.0059375%
+    93: 0.000059375,  # 0.0059375%
+    94: 0.000059375,  # 0.0059375%
+    95: 0.000059375,  # 0.0059375%
+    96: 0.000059375,  # 0.0059375%
+    97: 0.000059375,  # 0.0059375%
+    98: 0.000059375,  # 0.0059375%
+    99: 0.000059375,  # 0.0059375%
+    100: 0.000059375,  # 0.0059375%
+}
+
+def extrapolate_ctr(avg_ctr_per_position):
+    positions = np.array([pos for pos, ctr in avg_ctr_per_position.items() if ctr > 0])
+    ctr_values = np.array([ctr for ctr in avg_ctr_per_position.values() if ctr > 0])
+
+    if len(positions) < 2:
+        logging.warning("Not enough data points for extrapolation. Skipping extrapolation.")
+        return
+
+    # Fit a logarithmic model: CTR = a * ln(Position) + b
+    try:
+        params = np.polyfit(np.log(positions), ctr_values, 1)
+        a, b = params
+        # Extrapolate for positions 1 to 100
+        for position in range(1, 101):
+            if position not in avg_ctr_per_position:
+                avg_ctr = a * np.log(position) + b
+                # Ensure CTR is not negative
+                avg_ctr_per_position[position] = max(avg_ctr, 0.0)
+    except Exception as e:
+        logging.error(f"Error in CTR extrapolation: {e}")
+        # Fallback to standard CTR curve or default value
+        pass
+
+def fetch_gsc_data_for_domain(project_id, start_date, end_date):
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.row_factory = sqlite3.Row  # Return rows as dictionaries
+
+    # Fetch the project to get branded terms
+    c.execute('SELECT * FROM projects WHERE id = ?', (project_id,))
+    project_row = c.fetchone()
+    if not project_row:
+        conn.close()
+        raise Exception("Project not found")
+
+    project = dict(project_row)
+
+    # Ensure branded_terms is a list of non-empty strings
+    branded_terms_raw = project.get('branded_terms') or ''
+    branded_terms = [term.strip() for term in branded_terms_raw.split(',') if term.strip()]
+    logging.info(f"Branded Terms: {branded_terms}")
+
+    # Fetch GSC data for the project's keywords
+    c.execute('''
+        SELECT * FROM gsc_data
+        WHERE date BETWEEN ? AND ?
+        AND keyword_id IN (SELECT id FROM keywords WHERE project_id = ?)
+    ''', (start_date, end_date, project_id))
+
+    gsc_data_rows = c.fetchall()
+    conn.close()
+
+    # Exclude queries containing branded terms
+    non_branded_gsc_data = []
+    for row in gsc_data_rows:
+        data = dict(row)
+        query = data.get('query') or ''
+        query_lower = query.lower()
+        logging.info(f"Processing query: {query_lower}")
+        if not any(branded_term.lower() in query_lower for branded_term in branded_terms):
+            non_branded_gsc_data.append(data)
+
+    return non_branded_gsc_data
+
+def compute_avg_ctr_per_position(gsc_data):
+    position_data = {}
+    for data in gsc_data:
+        position = int(float(data['position']))
+        if position > 100 or position < 1:
+            continue
+        position_str = str(position)
+        if position_str not in position_data:
+            position_data[position_str] = {'clicks': 0, 'impressions': 0}
+        position_data[position_str]['clicks'] += data.get('clicks', 0)
+        position_data[position_str]['impressions'] += data.get('impressions', 0)
+
+    avg_ctr_per_position = {}
+    for position_str in position_data:
+        clicks = position_data[position_str]['clicks']
+        impressions = position_data[position_str]['impressions']
+        if impressions > 0:
+            avg_ctr = clicks / impressions
+            avg_ctr_per_position[position_str] = avg_ctr
+        else:
+            pass  # Do not assign zero CTR here
+
+    # Extrapolate missing CTRs
+    extrapolate_ctr(avg_ctr_per_position)
+
+    # Incorporate standard CTR values
+    for position in range(1, 101):
+        position_str = str(position)
+        if position_str not in avg_ctr_per_position or avg_ctr_per_position[position_str] == 0.0:
+            avg_ctr_per_position[position_str] = standard_ctr_curve.get(position, 0.01)
+
+    return avg_ctr_per_position
+
+def calculate_and_cache_avg_ctr_per_position(project_id: int) -> Tuple[Dict, str, str]:
+    # Define fixed date range: last 90 days from yesterday
+    end_date = datetime.now(timezone.utc).date() - timedelta(days=1)  # Exclude today
+    start_date = end_date - timedelta(days=89)  # Total of 90 days
+
+    # Fetch GSC data for the domain
+    gsc_data = fetch_gsc_data_for_domain(project_id, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+    avg_ctr_per_position = compute_avg_ctr_per_position(gsc_data)
+
+    return avg_ctr_per_position, start_date.isoformat(), end_date.isoformat()
+
+GSC_DATA_BY_PROJECT_QUERY = """
+    SELECT k.keyword, s.date, s.clicks, s.impressions, s.ctr, s.position
+    FROM gsc_data s
+    JOIN keywords k ON s.keyword_id = k.id
+    JOIN projects p ON k.project_id = p.id
+    WHERE p.id = ? AND s.date BETWEEN ? AND ?
+"""
+
+GSC_DATA_BY_DOMAIN_QUERY = """
+    SELECT k.keyword, s.date, s.clicks, s.impressions, s.ctr, s.position
+    FROM gsc_data s
+    JOIN keywords k ON s.keyword_id = k.id
+    JOIN projects p ON k.project_id = p.id
+    JOIN gsc_domains gd ON p.id = gd.project_id
+    WHERE gd.id = ? AND s.date BETWEEN ? AND ?
+"""
 
 def get_gsc_data_by_project(project_id: int, start_date: str, end_date: str) -> List[Dict]:
     """
@@ -522,13 +2147,7 @@ def get_gsc_data_by_project(project_id: int, start_date: str, end_date: str) ->
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("""
-            SELECT k.keyword, s.date, s.clicks, s.impressions, s.ctr, s.position
-            FROM gsc_data s
-            JOIN keywords k ON s.keyword_id = k.id
-            JOIN projects p ON k.project_id = p.id
-            WHERE p.id = ? AND s.date BETWEEN ? AND ?
-        """, (project_id, start_date, end_date))
+        c.execute(GSC_DATA_BY_PROJECT_QUERY, (project_id, start_date, end_date))
         data = c.fetchall()
         conn.close()
         return [
@@ -564,14 +2183,7 @@ def get_gsc_data_by_domain(domain_id: int, start_date: str, end_date: str) -> Li
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("""
-            SELECT k.keyword, s.date, s.clicks, s.impressions, s.ctr, s.position
-            FROM gsc_data s
-            JOIN keywords k ON s.keyword_id = k.id
-            JOIN projects p ON k.project_id = p.id
-            JOIN gsc_domains gd ON p.id = gd.project_id
-            WHERE gd.id = ? AND s.date BETWEEN ? AND ?
-        """, (domain_id, start_date, end_date))
+        c.execute(GSC_DATA_BY_DOMAIN_QUERY, (domain_id, start_date, end_date))
         data = c.fetchall()
         conn.close()
         return [
@@ -591,3 +2203,412 @@ def get_gsc_data_by_domain(domain_id: int, start_date: str, end_date: str) -> Li
     except Exception as e:
         logging.error(f"Error in get_gsc_data_by_domain: {e}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred while retrieving GSC data.")
+
+
+def iter_gsc_data_by_project(project_id: int, start_date: str, end_date: str):
+    """
+    Streaming counterpart of get_gsc_data_by_project().
+    """
+    for d in iter_query_rows(GSC_DATA_BY_PROJECT_QUERY, (project_id, start_date, end_date)):
+        yield {
+            "keyword": d["keyword"],
+            "date": d["date"],
+            "clicks": d["clicks"],
+            "impressions": d["impressions"],
+            "ctr": d["ctr"],
+            "position": d["position"]
+        }
+
+def iter_gsc_data_by_domain(domain_id: int, start_date: str, end_date: str):
+    """
+    Streaming counterpart of get_gsc_data_by_domain().
+    """
+    for d in iter_query_rows(GSC_DATA_BY_DOMAIN_QUERY, (domain_id, start_date, end_date)):
+        yield {
+            "keyword": d["keyword"],
+            "date": d["date"],
+            "clicks": d["clicks"],
+            "impressions": d["impressions"],
+            "ctr": d["ctr"],
+            "position": d["position"]
+        }
+
+
+def create_pull_job(kind: str, keyword_ids: List[int], project_id: Optional[int] = None,
+                    tag_id: Optional[int] = None, cache_max_age_hours: Optional[float] = None,
+                    bypass_cache: bool = False) -> int:
+    """
+    Queues a rank pull with one task per keyword.
+
+    Args:
+        kind (str): What to fetch per keyword, e.g. 'project', 'tag' or 'scheduled'.
+        keyword_ids (List[int]): Keywords to pull.
+        project_id (int, optional): Project the pull belongs to.
+        tag_id (int, optional): Tag the keywords were selected by.
+        cache_max_age_hours (float, optional): Overrides the projects' SERP cache max age.
+        bypass_cache (bool): Fetch every SERP from SpaceSERP even if cached.
+
+    Returns:
+        int: The id of the new pull_jobs row.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            INSERT INTO pull_jobs (project_id, tag_id, kind, status, total_tasks, cache_max_age_hours, bypass_cache, created_at)
+            VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)
+        ''', (project_id, tag_id, kind, len(keyword_ids), cache_max_age_hours, int(bypass_cache), now))
+        job_id = c.lastrowid
+        c.executemany('''
+            INSERT INTO pull_tasks (job_id, keyword_id, status, available_at, updated_at)
+            VALUES (?, ?, 'pending', ?, ?)
+        ''', [(job_id, keyword_id, now, now) for keyword_id in keyword_ids])
+        if not keyword_ids:
+            c.execute("UPDATE pull_jobs SET status = 'completed', finished_at = ? WHERE id = ?", (now, job_id))
+        conn.commit()
+        logging.info(f"Queued pull job {job_id} ({kind}) with {len(keyword_ids)} tasks")
+        return job_id
+    finally:
+        conn.close()
+
+PULL_TASK_CLAIM_SQL = '''
+    SELECT t.id, t.job_id, t.keyword_id, t.attempts, j.kind, j.project_id, j.tag_id,
+           j.cache_max_age_hours, j.bypass_cache, k.keyword,
+           p.domain AS project_domain, p.serp_cache_max_age_hours AS project_cache_max_age_hours,
+           r.rank AS last_rank
+    FROM pull_tasks t
+    JOIN pull_jobs j ON j.id = t.job_id
+    LEFT JOIN keywords k ON k.id = t.keyword_id
+    LEFT JOIN projects p ON p.id = k.project_id
+    LEFT JOIN keyword_rank_latest r ON r.keyword_id = t.keyword_id
+    WHERE j.status IN ('pending', 'running')
+      AND ((t.status = 'pending' AND t.available_at <= ?)
+           OR (t.status = 'running' AND t.lease_expires_at <= ?))
+'''
+
+def claim_pull_tasks(limit: int, lease_seconds: float, owner: str) -> List[Dict]:
+    """
+    Leases up to ``limit`` runnable tasks of active jobs to ``owner``, oldest job first,
+    along with every other runnable task for the same normalized keywords.
+
+    A task is runnable when it is pending and due, or when it is running but
+    its lease expired because the worker holding it died or stalled. Claiming
+    a keyword's tasks of every job together lets a keyword tracked in several
+    projects be fetched once, however far apart its tasks are in the queue.
+
+    Returns:
+        List[Dict]: The claimed tasks joined with their job's settings, the
+        keyword text (None if the keyword was deleted), its last rank and its
+        project's domain and SERP cache max age.
+    """
+    now = datetime.now(timezone.utc)
+    now_iso = now.isoformat()
+    lease_expires_at = (now + timedelta(seconds=lease_seconds)).isoformat()
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        # Take the write lock up front so concurrent claimers never lease the same task
+        c.execute("BEGIN IMMEDIATE")
+        rows = c.execute(PULL_TASK_CLAIM_SQL + ' ORDER BY t.job_id, t.id LIMIT ?',
+                         (now_iso, now_iso, limit)).fetchall()
+        tasks = [dict(row) for row in rows]
+        terms = {normalize_keyword(task['keyword']) for task in tasks if task['keyword'] is not None}
+        if terms:
+            claimed = {task['id'] for task in tasks}
+            for row in c.execute(PULL_TASK_CLAIM_SQL + f'''
+                AND lower(trim(k.keyword)) IN ({','.join('?' * len(terms))})
+                ORDER BY t.job_id, t.id
+            ''', (now_iso, now_iso, *terms)).fetchall():
+                if row['id'] not in claimed and normalize_keyword(row['keyword']) in terms:
+                    tasks.append(dict(row))
+        if tasks:
+            c.executemany('''
+                UPDATE pull_tasks
+                SET status = 'running', attempts = attempts + 1, lease_expires_at = ?, lease_owner = ?, updated_at = ?
+                WHERE id = ?
+            ''', [(lease_expires_at, owner, now_iso, task['id']) for task in tasks])
+            c.executemany('''
+                UPDATE pull_jobs SET status = 'running', started_at = COALESCE(started_at, ?)
+                WHERE id = ? AND status = 'pending'
+            ''', [(now_iso, job_id) for job_id in {task['job_id'] for task in tasks}])
+            for task in tasks:
+                task['attempts'] += 1
+        conn.commit()
+        return tasks
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def complete_pull_task(task_id: int, owner: str, status: str = 'done', error: Optional[str] = None) -> bool:
+    """
+    Marks a task leased by ``owner`` as finished. ``status`` is 'done',
+    'skipped' or 'failed'.
+
+    Returns:
+        bool: False if the lease expired and the task was claimed by another
+        worker since, in which case it is left to that worker.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE pull_tasks SET status = ?, last_error = ?, lease_expires_at = NULL, updated_at = ?
+            WHERE id = ? AND status = 'running' AND lease_owner = ?
+        ''', (status, error, datetime.now(timezone.utc).isoformat(), task_id, owner))
+        conn.commit()
+    finally:
+        conn.close()
+    if c.rowcount == 0:
+        logging.warning(f"Pull task {task_id} is no longer leased by {owner}, leaving it to its new owner")
+    return c.rowcount > 0
+
+def retry_pull_task(task_id: int, owner: str, error: str, delay_seconds: float) -> bool:
+    """
+    Puts a failed task leased by ``owner`` back in the queue to be retried
+    after ``delay_seconds``.
+
+    Returns:
+        bool: False if the task is no longer leased by ``owner``.
+    """
+    now = datetime.now(timezone.utc)
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        # Tasks of a job cancelled while they were running are not retried
+        c.execute('''
+            UPDATE pull_tasks
+            SET status = CASE WHEN (SELECT status FROM pull_jobs WHERE id = pull_tasks.job_id) = 'cancelled'
+                              THEN 'cancelled' ELSE 'pending' END,
+                last_error = ?, available_at = ?, lease_expires_at = NULL, lease_owner = NULL, updated_at = ?
+            WHERE id = ? AND status = 'running' AND lease_owner = ?
+        ''', (error, (now + timedelta(seconds=delay_seconds)).isoformat(), now.isoformat(), task_id, owner))
+        conn.commit()
+    finally:
+        conn.close()
+    if c.rowcount == 0:
+        logging.warning(f"Pull task {task_id} is no longer leased by {owner}, leaving it to its new owner")
+    return c.rowcount > 0
+
+def finish_pull_job_if_done(job_id: int) -> bool:
+    """
+    Finishes an active job once none of its tasks are pending or running:
+    'completed' if no task failed, 'failed' if no task succeeded, and
+    'completed_with_errors' otherwise.
+
+    Returns:
+        bool: True if this call finished the job, or if the job was cancelled
+        and none of its tasks are still running, so its results are final.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE pull_jobs
+            SET status = CASE
+                    WHEN NOT EXISTS (SELECT 1 FROM pull_tasks WHERE job_id = pull_jobs.id AND status = 'failed')
+                        THEN 'completed'
+                    WHEN EXISTS (SELECT 1 FROM pull_tasks WHERE job_id = pull_jobs.id AND status = 'done')
+                        THEN 'completed_with_errors'
+                    ELSE 'failed'
+                END,
+                finished_at = ?
+            WHERE id = ? AND status IN ('pending', 'running')
+              AND NOT EXISTS (
+                  SELECT 1 FROM pull_tasks
+                  WHERE job_id = pull_jobs.id AND status IN ('pending', 'running')
+              )
+        ''', (datetime.now(timezone.utc).isoformat(), job_id))
+        conn.commit()
+        if c.rowcount > 0:
+            return True
+        # Tasks already being fetched when the job was cancelled still store their results
+        return c.execute('''
+            SELECT 1 FROM pull_jobs
+            WHERE id = ? AND status = 'cancelled'
+              AND NOT EXISTS (SELECT 1 FROM pull_tasks WHERE job_id = pull_jobs.id AND status = 'running')
+        ''', (job_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def record_pull_job_depth_stats(job_ids: List[int], shallow_fetches: int, escalations: int, latency_saved_ms: float):
+    """
+    Adds the outcome of adaptive-depth SERP fetches to the stats of the jobs they served.
+    """
+    conn = get_db_connection()
+    try:
+        conn.executemany('''
+            UPDATE pull_jobs
+            SET shallow_fetches = shallow_fetches + ?,
+                depth_escalations = depth_escalations + ?,
+                depth_latency_saved_ms = depth_latency_saved_ms + ?
+            WHERE id = ?
+        ''', [(shallow_fetches, escalations, latency_saved_ms, job_id) for job_id in job_ids])
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_pull_job(job_id: int) -> Optional[Dict]:
+    """
+    Returns a pull job with its number of tasks per status, or None.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        job = c.execute("SELECT * FROM pull_jobs WHERE id = ?", (job_id,)).fetchone()
+        if not job:
+            return None
+        job = dict(job)
+        job['tasks'] = {
+            row['status']: row['count'] for row in c.execute(
+                "SELECT status, COUNT(*) AS count FROM pull_tasks WHERE job_id = ? GROUP BY status", (job_id,))
+        }
+        return job
+    finally:
+        conn.close()
+
+def cancel_pull_job(job_id: int) -> bool:
+    """
+    Cancels an active job. Its pending tasks are dropped; tasks already being
+    fetched are allowed to finish. Dead letters re-driven by the job go back
+    to waiting, and those whose task never ran get their redrive back.
+
+    Returns:
+        bool: True if the job was active and is now cancelled.
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE pull_jobs SET status = 'cancelled', finished_at = ?
+            WHERE id = ? AND status IN ('pending', 'running')
+        ''', (now, job_id))
+        cancelled = c.rowcount > 0
+        if cancelled:
+            c.execute('''
+                UPDATE pull_tasks SET status = 'cancelled', updated_at = ?
+                WHERE job_id = ? AND status = 'pending'
+            ''', (now, job_id))
+            c.execute('''
+                UPDATE pull_dead_letters
+                SET status = 'waiting',
+                    redrives = redrives - (SELECT COUNT(*) FROM pull_tasks t
+                                           WHERE t.job_id = pull_dead_letters.redrive_job_id
+                                           AND t.keyword_id = pull_dead_letters.keyword_id
+                                           AND t.status = 'cancelled')
+                WHERE redrive_job_id = ? AND status = 'redriven'
+            ''', (job_id,))
+        conn.commit()
+        return cancelled
+    finally:
+        conn.close()
+
+def add_dead_letter(keyword_id: int, job_id: int, task_id: int, error: str):
+    """
+    Records a keyword whose pull task failed for good, replacing any earlier
+    dead letter for it.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('''
+            INSERT INTO pull_dead_letters (keyword_id, job_id, task_id, error, status, failed_at)
+            VALUES (?, ?, ?, ?, 'waiting', ?)
+            ON CONFLICT (keyword_id) DO UPDATE SET
+                job_id = excluded.job_id, task_id = excluded.task_id, error = excluded.error,
+                status = 'waiting', failed_at = excluded.failed_at
+        ''', (keyword_id, job_id, task_id, error, datetime.now(timezone.utc).isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+
+def resolve_dead_letter(keyword_id: int):
+    """Drops the dead letter of a keyword once it was pulled successfully."""
+    conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM pull_dead_letters WHERE keyword_id = ?", (keyword_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def redrive_dead_letters(max_redrives: int) -> Optional[int]:
+    """
+    Queues a 'redrive' pull job for every waiting dead letter that was
+    re-driven fewer than ``max_redrives`` times. Dead letters of deleted
+    keywords are dropped.
+
+    Returns:
+        Optional[int]: The id of the new job, or None if nothing was waiting.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM pull_dead_letters WHERE keyword_id NOT IN (SELECT id FROM keywords)")
+        keyword_ids = [row[0] for row in conn.execute(
+            "SELECT keyword_id FROM pull_dead_letters WHERE status = 'waiting' AND redrives < ? ORDER BY failed_at",
+            (max_redrives,))]
+        conn.commit()
+    finally:
+        conn.close()
+    if not keyword_ids:
+        return None
+
+    job_id = create_pull_job('redrive', keyword_ids)
+    conn = get_db_connection()
+    try:
+        conn.executemany('''
+            UPDATE pull_dead_letters
+            SET status = 'redriven', redrives = redrives + 1, redriven_at = ?, redrive_job_id = ?
+            WHERE keyword_id = ?
+        ''', [(datetime.now(timezone.utc).isoformat(), job_id, keyword_id) for keyword_id in keyword_ids])
+        conn.commit()
+    finally:
+        conn.close()
+    logging.info(f"Re-driving {len(keyword_ids)} dead-lettered keywords in pull job {job_id}")
+    return job_id
+
+def get_dead_letters(status: Optional[str] = None, limit: int = 100) -> Dict:
+    """
+    Returns the number of dead letters per status and the most recent ones
+    with their keyword, optionally only those with the given status.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        counts = {
+            row['status']: row['count'] for row in c.execute(
+                "SELECT status, COUNT(*) AS count FROM pull_dead_letters GROUP BY status")
+        }
+        items = [dict(row) for row in c.execute('''
+            SELECT d.*, k.keyword, k.project_id
+            FROM pull_dead_letters d
+            LEFT JOIN keywords k ON k.id = d.keyword_id
+            WHERE ? IS NULL OR d.status = ?
+            ORDER BY d.failed_at DESC
+            LIMIT ?
+        ''', (status, status, limit))]
+        return {"counts": counts, "items": items}
+    finally:
+        conn.close()
+
+def release_pull_task_leases(owner: str) -> int:
+    """
+    Returns the running tasks leased by ``owner`` to the queue, so another
+    worker can pick them up without waiting for the leases to expire. Leases
+    of other processes are left alone.
+
+    Returns:
+        int: The number of tasks released.
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            UPDATE pull_tasks SET status = 'pending', lease_expires_at = NULL, lease_owner = NULL, updated_at = ?
+            WHERE status = 'running' AND lease_owner = ?
+        ''', (datetime.now(timezone.utc).isoformat(), owner))
+        conn.commit()
+        return c.rowcount
+    finally:
+        conn.close()
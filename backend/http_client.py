@@ -0,0 +1,48 @@
+import aiohttp
+import logging
+import os
+from typing import Optional
+
+# Application-wide HTTP session shared by every outbound provider call, so
+# connections to SpaceSERP, Grepwords etc. are pooled and kept alive instead
+# of paying a TCP+TLS handshake per keyword.
+http_session: Optional[aiohttp.ClientSession] = None
+
+def create_http_session() -> aiohttp.ClientSession:
+    """
+    Creates the pooled session. Settings are read from the environment when the
+    session is created, so values from .env are honoured.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=int(os.getenv("HTTP_POOL_LIMIT", 100)),
+        limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20)),
+        ttl_dns_cache=int(os.getenv("HTTP_DNS_CACHE_SECONDS", 300)),
+        keepalive_timeout=float(os.getenv("HTTP_KEEPALIVE_SECONDS", 30))
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=float(os.getenv("HTTP_TIMEOUT_SECONDS", 120)),
+        connect=float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", 10))
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+async def start_http_session():
+    get_http_session()
+    logging.info("HTTP client session started")
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        logging.info("HTTP client session closed")
+    http_session = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared session, creating it on first use for callers that run
+    outside the application lifetime (scheduled jobs, scripts).
+    Must be called from within the running event loop.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
@@ -0,0 +1,112 @@
+import argparse
+import logging
+
+from database import (
+    init_db,
+    get_db_connection,
+    rebuild_keyword_rank_latest,
+    compress_serp_full_data,
+    benchmark_serp_full_data_compression,
+    backfill_serp_results,
+    recompute_sov_daily,
+    dedup_gsc_data
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+def rebuild_rank_latest(args):
+    count = rebuild_keyword_rank_latest()
+    print(f"keyword_rank_latest rebuilt for {count} keywords")
+
+def compress_serp_data(args):
+    count = compress_serp_full_data(batch_size=args.batch_size, pause=args.pause)
+    print(f"Compressed {count} serp_data rows")
+    if args.vacuum:
+        conn = get_db_connection()
+        conn.execute("VACUUM")
+        conn.close()
+        print("Database vacuumed")
+
+def benchmark_serp_compression(args):
+    stats = benchmark_serp_full_data_compression(sample_size=args.sample)
+    print(f"Rows sampled:      {stats['rows']}")
+    print(f"Raw size:          {stats['raw_bytes']} bytes")
+    print(f"Compressed size:   {stats['compressed_bytes']} bytes")
+    print(f"Compression ratio: {stats['ratio']:.2f}x")
+    print(f"Encode throughput: {stats['encode_mb_per_s']:.1f} MB/s")
+    print(f"Decode throughput: {stats['decode_mb_per_s']:.1f} MB/s")
+
+def backfill_results(args):
+    count = backfill_serp_results(batch_size=args.batch_size)
+    print(f"Backfilled serp_results for {count} SERP snapshots")
+
+def recompute_sov(args):
+    count = recompute_sov_daily(project_id=args.project_id, start_date=args.start, end_date=args.end)
+    print(f"Recomputed {count} sov_daily aggregates")
+
+def dedup_gsc(args):
+    count = dedup_gsc_data()
+    print(f"Deleted {count} duplicate gsc_data rows")
+    if args.vacuum:
+        conn = get_db_connection()
+        conn.execute("VACUUM")
+        conn.close()
+        print("Database vacuumed")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rankenberry maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "rebuild-rank-latest",
+        help="Rebuild the keyword_rank_latest table from serp_data"
+    ).set_defaults(func=rebuild_rank_latest)
+
+    compress_parser = subparsers.add_parser(
+        "compress-serp-data",
+        help="Compress plain-text serp_data.full_data rows in batches"
+    )
+    compress_parser.add_argument("--batch-size", type=int, default=500)
+    compress_parser.add_argument("--pause", type=float, default=0.0, help="Seconds to sleep between batches")
+    compress_parser.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to return the space to the OS")
+    compress_parser.set_defaults(func=compress_serp_data)
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark-serp-compression",
+        help="Report size and throughput of full_data compression on stored snapshots"
+    )
+    benchmark_parser.add_argument("--sample", type=int, default=200)
+    benchmark_parser.set_defaults(func=benchmark_serp_compression)
+
+    backfill_parser = subparsers.add_parser(
+        "backfill-serp-results",
+        help="Fill serp_results from stored SERP snapshots"
+    )
+    backfill_parser.add_argument("--batch-size", type=int, default=200)
+    backfill_parser.set_defaults(func=backfill_results)
+
+    sov_parser = subparsers.add_parser(
+        "recompute-sov",
+        help="Recompute the sov_daily share of voice aggregates"
+    )
+    sov_parser.add_argument("--project-id", type=int)
+    sov_parser.add_argument("--start", help="Start date in YYYY-MM-DD")
+    sov_parser.add_argument("--end", help="End date in YYYY-MM-DD")
+    sov_parser.set_defaults(func=recompute_sov)
+
+    dedup_parser = subparsers.add_parser(
+        "dedup-gsc-data",
+        help="Delete duplicate gsc_data rows, recalculate affected CTR curves and add the unique key used by GSC upserts"
+    )
+    dedup_parser.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to return the space to the OS")
+    dedup_parser.set_defaults(func=dedup_gsc)
+
+    args = parser.parse_args()
+    init_db()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
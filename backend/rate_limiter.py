@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+# Status codes providers use to tell us we are going too fast. SpaceSERP
+# answers 403 when the concurrency limit of the plan is exceeded.
+THROTTLE_STATUSES = (403, 429)
+
+# Default settings per provider. Each value can be overridden from the
+# environment, e.g. SPACESERP_RATE_PER_SECOND or GREPWORDS_MAX_CONCURRENCY.
+PROVIDER_LIMITS = {
+    'spaceserp': {'rate_per_second': 10, 'burst': 10, 'initial_concurrency': 3, 'max_concurrency': 50},
+    'serpapi': {'rate_per_second': 5, 'burst': 5, 'initial_concurrency': 3, 'max_concurrency': 20},
+    'valueserp': {'rate_per_second': 5, 'burst': 5, 'initial_concurrency': 3, 'max_concurrency': 20},
+    'grepwords': {'rate_per_second': 5, 'burst': 5, 'initial_concurrency': 3, 'max_concurrency': 20},
+    'gsc': {'rate_per_second': 5, 'burst': 5, 'initial_concurrency': 2, 'max_concurrency': 10},
+}
+
+class RateLimitCall:
+    """Handle for one request going through a limiter."""
+
+    def __init__(self):
+        self.throttled_status = None
+        self.retry_after = None
+
+    def throttled(self, status: int, retry_after: Optional[float] = None):
+        """
+        Marks the request as rejected by the provider for going too fast.
+
+        Args:
+            status (int): HTTP status returned by the provider.
+            retry_after (float, optional): Seconds the provider asked us to wait.
+        """
+        self.throttled_status = status
+        self.retry_after = retry_after
+
+class AdaptiveRateLimiter:
+    """
+    Process-wide limiter for one provider. A token bucket caps requests per
+    second, and the number of requests in flight is adapted with AIMD: it grows
+    by one slot per window of successful calls and is halved when the provider
+    throttles us, so we settle just under the provider's real ceiling.
+    """
+
+    def __init__(self, name: str, rate_per_second: float, burst: float, initial_concurrency: int,
+                 max_concurrency: int, min_concurrency: int = 1, decrease_factor: float = 0.5,
+                 throttle_pause: float = 1.0):
+        self.name = name
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(min(max(initial_concurrency, min_concurrency), max_concurrency))
+        self.decrease_factor = decrease_factor
+        self.throttle_pause = throttle_pause
+
+        self.tokens = burst
+        self.tokens_updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease_at = 0.0
+        self.in_flight = 0
+        self.waiters = deque()
+
+        self.requests = 0
+        self.throttles = 0
+        self.errors = 0
+
+    @asynccontextmanager
+    async def limit(self):
+        """
+        Waits for a concurrency slot and a token, then yields a RateLimitCall.
+        Call ``throttled()`` on it when the provider answers 403/429. Any other
+        exception counts as an error and leaves the concurrency unchanged.
+        """
+        await self._acquire_slot()
+        call = RateLimitCall()
+        succeeded = False
+        try:
+            await self._take_token()
+            self.requests += 1
+            yield call
+            succeeded = True
+        except Exception:
+            if call.throttled_status is None:
+                self.errors += 1
+            raise
+        finally:
+            if call.throttled_status is not None:
+                self._on_throttle(call)
+            elif succeeded:
+                self._on_success()
+            self._release_slot()
+
+    def _on_success(self):
+        self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        self._wake_waiters()
+
+    def _on_throttle(self, call: RateLimitCall):
+        self.throttles += 1
+        now = time.monotonic()
+        pause = call.retry_after if call.retry_after is not None else self.throttle_pause
+        self.paused_until = max(self.paused_until, now + pause)
+        # Calls already in flight when the limit was hit will also be rejected;
+        # only back off once per pause window so they don't collapse the limit.
+        if now - self.last_decrease_at >= pause:
+            self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease_factor)
+            self.last_decrease_at = now
+            logging.warning(
+                f"{self.name} throttled with status {call.throttled_status}, "
+                f"concurrency reduced to {int(self.concurrency)}, pausing {pause:.1f}s"
+            )
+
+    async def _acquire_slot(self):
+        while self.in_flight >= int(self.concurrency):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free = int(self.concurrency) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.tokens_updated_at) * self.rate_per_second)
+            self.tokens_updated_at = now
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate_per_second)
+
+    def get_stats(self) -> Dict:
+        return {
+            "provider": self.name,
+            "rate_per_second": self.rate_per_second,
+            "concurrency": int(self.concurrency),
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+            "requests": self.requests,
+            "throttles": self.throttles,
+            "errors": self.errors,
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 2))
+        }
+
+rate_limiters: Dict[str, AdaptiveRateLimiter] = {}
+
+def get_rate_limiter(provider: str) -> AdaptiveRateLimiter:
+    """
+    Returns the shared limiter for a provider, creating it from PROVIDER_LIMITS
+    and the environment on first use.
+
+    Args:
+        provider (str): One of the keys of PROVIDER_LIMITS.
+
+    Returns:
+        AdaptiveRateLimiter: The process-wide limiter for that provider.
+    """
+    if provider not in rate_limiters:
+        settings = dict(PROVIDER_LIMITS[provider])
+        prefix = provider.upper()
+        settings['rate_per_second'] = float(os.getenv(f"{prefix}_RATE_PER_SECOND", settings['rate_per_second']))
+        settings['burst'] = float(os.getenv(f"{prefix}_BURST", settings['burst']))
+        settings['initial_concurrency'] = int(os.getenv(f"{prefix}_INITIAL_CONCURRENCY", settings['initial_concurrency']))
+        settings['max_concurrency'] = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", settings['max_concurrency']))
+        rate_limiters[provider] = AdaptiveRateLimiter(provider, **settings)
+    return rate_limiters[provider]
+
+def get_rate_limiter_stats():
+    return [limiter.get_stats() for limiter in rate_limiters.values()]
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header given in seconds; HTTP dates are ignored."""
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
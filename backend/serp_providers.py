@@ -0,0 +1,326 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Dict, List, Optional
+
+from circuit_breaker import get_circuit_breaker, CircuitOpenError
+from database import extract_domain
+from rate_limiter import get_rate_limiter, parse_retry_after, THROTTLE_STATUSES
+
+# Successful calls needed before a provider's p95 latency is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+
+class SerpProviderError(Exception):
+    """Raised when a provider does not return a usable SERP."""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+class SerpProvider(ABC):
+    """
+    A SERP API. Subclasses build the request for a keyword and normalize the
+    response to the shape add_serp_data() stores: a dict whose
+    ``organic_results`` items have ``position``, ``title``, ``link``,
+    ``domain`` and ``description``. Each provider has its own circuit breaker
+    and tracks its latency, which SerpProviderPool uses for failover and hedging.
+    """
+
+    name = None
+    url = None
+
+    def __init__(self, api_key: Optional[str], latency_window: int = 200):
+        self.api_key = api_key
+        self.breaker = get_circuit_breaker(self.name)
+        self.latencies = deque(maxlen=latency_window)
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @abstractmethod
+    def build_params(self, keyword: str, search_params: Dict, page_size: int) -> Dict:
+        """Returns the query parameters of the request for one SERP."""
+
+    @abstractmethod
+    def normalize(self, response: Dict) -> Dict:
+        """Converts a response to the stored SERP shape, raising SerpProviderError if it has no results."""
+
+    async def fetch(self, session, keyword: str, search_params: Dict, page_size: int, max_retries: int) -> Dict:
+        """
+        Fetches and normalizes one SERP, recording its latency and outcome.
+
+        Raises:
+            CircuitOpenError: The provider's circuit is open.
+            SerpProviderError: The provider failed or answered without results.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit for {self.name} is open")
+        started = time.monotonic()
+        try:
+            response = await fetch_with_retry(
+                session, self.name, self.url, self.build_params(keyword, search_params, page_size), max_retries)
+            serp_data = self.normalize(response)
+        except asyncio.CancelledError:
+            # A hedged call that lost still took at least this long; keeping it
+            # stops the p95 from drifting down to the fast calls only.
+            self.latencies.append(time.monotonic() - started)
+            self.breaker.record_cancelled()
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            self.breaker.record_failure()
+            raise
+        self.latencies.append(time.monotonic() - started)
+        self.successes += 1
+        self.breaker.record_success()
+        serp_data['provider'] = self.name
+        return serp_data
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Returns the latency percentile in seconds, or None without enough samples."""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    def get_stats(self) -> Dict:
+        p50 = self.latency_percentile(50)
+        p95 = self.latency_percentile(95)
+        return {
+            "provider": self.name,
+            "circuit": self.breaker.get_stats(),
+            "successes": self.successes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins
+        }
+
+def normalize_organic_result(item: Dict, position: int) -> Dict:
+    link = item.get('link') or item.get('url') or ''
+    return {
+        "position": item.get('position') or position,
+        "title": item.get('title'),
+        "link": link,
+        "domain": item.get('domain') or extract_domain(link),
+        "description": item.get('description') or item.get('snippet')
+    }
+
+class SpaceSerpProvider(SerpProvider):
+    name = 'spaceserp'
+    url = "https://api.spaceserp.com/google/search"
+
+    def build_params(self, keyword, search_params, page_size):
+        return {
+            "apiKey": self.api_key,
+            "q": keyword,
+            **search_params,
+            "resultFormat": "json",
+            "pageSize": page_size,
+            "pageNumber": 1
+        }
+
+    def normalize(self, response):
+        # SpaceSERP responses already have the stored shape
+        if 'organic_results' not in response:
+            raise SerpProviderError(f"SpaceSERP returned no results: {response.get('error') or response.get('message') or response}")
+        return response
+
+class SerpApiProvider(SerpProvider):
+    name = 'serpapi'
+    url = "https://serpapi.com/search.json"
+
+    def build_params(self, keyword, search_params, page_size):
+        return {
+            "api_key": self.api_key,
+            "engine": "google",
+            "q": keyword,
+            "google_domain": search_params['domain'],
+            "gl": search_params['gl'],
+            "hl": search_params['hl'],
+            "device": search_params['device'],
+            "num": page_size
+        }
+
+    def normalize(self, response):
+        error = response.get('error')
+        if error and "hasn't returned any results" not in error:
+            raise SerpProviderError(f"SerpApi error: {error}")
+        return {
+            "organic_results": [
+                normalize_organic_result(item, position)
+                for position, item in enumerate(response.get('organic_results', []), start=1)
+            ]
+        }
+
+class ValueSerpProvider(SerpProvider):
+    name = 'valueserp'
+    url = "https://api.valueserp.com/search"
+
+    def build_params(self, keyword, search_params, page_size):
+        return {
+            "api_key": self.api_key,
+            "q": keyword,
+            "google_domain": search_params['domain'],
+            "gl": search_params['gl'],
+            "hl": search_params['hl'],
+            "device": search_params['device'],
+            "num": page_size
+        }
+
+    def normalize(self, response):
+        request_info = response.get('request_info', {})
+        if request_info.get('success') is False:
+            raise SerpProviderError(f"ValueSERP error: {request_info.get('message')}")
+        return {
+            "organic_results": [
+                normalize_organic_result(item, position)
+                for position, item in enumerate(response.get('organic_results', []), start=1)
+            ]
+        }
+
+SERP_PROVIDER_CLASSES = {
+    'spaceserp': (SpaceSerpProvider, "SPACESERP_API_KEY"),
+    'serpapi': (SerpApiProvider, "SERPAPI_API_KEY"),
+    'valueserp': (ValueSerpProvider, "VALUESERP_API_KEY"),
+}
+
+async def fetch_with_retry(session, provider: str, url: str, params: Dict, max_retries: int = 5, base_delay: float = 1) -> Dict:
+    limiter = get_rate_limiter(provider)
+    for attempt in range(max_retries):
+        try:
+            async with limiter.limit() as call:
+                async with session.get(url, params=params) as response:
+                    if response.status in THROTTLE_STATUSES:
+                        call.throttled(response.status, parse_retry_after(response.headers.get('Retry-After')))
+                        raise SerpProviderError(f"{provider} concurrency limit reached", response.status)
+                    return await response.json()
+        except SerpProviderError as e:
+            # The limiter pauses and lowers concurrency before the next attempt
+            if e.status not in THROTTLE_STATUSES or attempt == max_retries - 1:
+                raise
+        except Exception as e:
+            if attempt < max_retries - 1:
+                delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
+                await asyncio.sleep(delay)
+            else:
+                raise
+
+class SerpProviderPool:
+    """
+    Fetches SERPs from the configured providers in order of preference.
+    Providers whose circuit is open are skipped, a failed call fails over to the next
+    provider, and with hedging enabled a second provider is started when the
+    first has not answered within its p95 latency; the first result wins.
+    """
+
+    def __init__(self, providers: List[SerpProvider], hedge: bool = False):
+        self.providers = providers
+        self.hedge = hedge
+
+    def available(self) -> List[SerpProvider]:
+        return [provider for provider in self.providers if provider.breaker.available()]
+
+    async def fetch(self, session, keyword: str, search_params: Dict, page_size: int) -> Dict:
+        """
+        Returns the normalized SERP from the first provider that answers.
+
+        Raises:
+            CircuitOpenError: Every provider's circuit is open, so nothing was tried.
+            SerpProviderError: Every provider failed.
+        """
+        candidates = self.available()
+        if not candidates:
+            raise CircuitOpenError("All SERP provider circuits are open")
+        # Retry less when another provider can take over
+        max_retries = 5 if len(candidates) == 1 else 2
+        pending: Dict[asyncio.Future, SerpProvider] = {}
+        errors = []
+        circuits_open = True
+        next_index = 0
+        hedge = None
+        started = time.monotonic()
+
+        def start_next():
+            nonlocal next_index, started
+            provider = candidates[next_index]
+            next_index += 1
+            started = time.monotonic()
+            pending[asyncio.ensure_future(
+                provider.fetch(session, keyword, search_params, page_size, max_retries))] = provider
+            return provider
+
+        try:
+            start_next()
+            while pending:
+                timeout = None
+                if self.hedge and hedge is None and len(pending) == 1 and next_index < len(candidates):
+                    p95 = next(iter(pending.values())).latency_percentile(95)
+                    if p95 is not None:
+                        timeout = max(0.0, p95 - (time.monotonic() - started))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge = start_next()
+                    hedge.hedges += 1
+                    logging.info(f"No SERP for '{keyword}' within the p95 latency, hedging with {hedge.name}")
+                    continue
+                for future in done:
+                    provider = pending.pop(future)
+                    try:
+                        serp_data = future.result()
+                    except Exception as e:
+                        circuits_open = circuits_open and isinstance(e, CircuitOpenError)
+                        errors.append(f"{provider.name}: {e}")
+                        logging.warning(f"SERP provider {provider.name} failed for '{keyword}': {e}")
+                        continue
+                    if provider is hedge:
+                        provider.hedge_wins += 1
+                    return serp_data
+                if not pending and next_index < len(candidates):
+                    logging.info(f"Failing over to SERP provider {candidates[next_index].name} for '{keyword}'")
+                    start_next()
+            if circuits_open:
+                raise CircuitOpenError("All SERP provider circuits are open")
+            raise SerpProviderError(f"All SERP providers failed for '{keyword}': {'; '.join(errors)}")
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def get_stats(self) -> List[Dict]:
+        return [provider.get_stats() for provider in self.providers]
+
+serp_provider_pool: Optional[SerpProviderPool] = None
+
+def get_serp_provider_pool() -> SerpProviderPool:
+    """
+    Returns the process-wide provider pool, created on first use from
+    SERP_PROVIDERS (comma-separated, in order of preference) and
+    SERP_HEDGE_REQUESTS. Providers without an API key are left out.
+    """
+    global serp_provider_pool
+    if serp_provider_pool is None:
+        providers = []
+        for name in os.getenv("SERP_PROVIDERS", "spaceserp,serpapi,valueserp").split(','):
+            name = name.strip().lower()
+            if name not in SERP_PROVIDER_CLASSES:
+                logging.warning(f"Unknown SERP provider '{name}' in SERP_PROVIDERS")
+                continue
+            provider_class, api_key_env = SERP_PROVIDER_CLASSES[name]
+            if os.getenv(api_key_env):
+                providers.append(provider_class(os.getenv(api_key_env)))
+        if not providers:
+            providers.append(SpaceSerpProvider(os.getenv("SPACESERP_API_KEY")))
+        hedge = os.getenv("SERP_HEDGE_REQUESTS", "false").lower() in ("1", "true", "yes")
+        serp_provider_pool = SerpProviderPool(providers, hedge=hedge)
+        logging.info(f"SERP providers: {', '.join(provider.name for provider in providers)}"
+                     f"{' with hedged requests' if hedge else ''}")
+    return serp_provider_pool
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from database import write_serp_batch
+
+class SerpWriter:
+    """
+    Single writer stage for SERP ingestion. Fetch workers submit SERPs, which
+    are buffered and written by write_serp_batch() in one transaction once
+    ``batch_rows`` are waiting or ``flush_interval`` seconds after the first
+    one arrived, so SQLite commits once per batch instead of once per keyword.
+    """
+
+    def __init__(self, batch_rows: int, flush_interval: float):
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.pending: List[Tuple[Tuple[int, Dict, Optional[int], int], asyncio.Future]] = []
+        self.flush_lock = asyncio.Lock()
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+        self.rows_written = 0
+        self.batches_written = 0
+
+    async def submit(self, keyword_id: int, serp_data: Dict, search_volume: Optional[int], depth: int):
+        """
+        Queues one SERP fetched with ``depth`` results and waits until its
+        batch is committed.
+
+        Raises:
+            Exception: Whatever made this SERP's write fail, so the caller can retry.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((keyword_id, serp_data, search_volume, depth), future))
+        if len(self.pending) >= self.batch_rows:
+            asyncio.ensure_future(self.flush())
+        elif self.flush_timer is None:
+            self.flush_timer = loop.call_later(self.flush_interval, lambda: asyncio.ensure_future(self.flush()))
+        # Shielded so a cancelled caller does not lose a row that is already buffered
+        await asyncio.shield(future)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                written = await loop.run_in_executor(None, write_serp_batch, [record for record, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    logging.error(f"Failed to write SERP snapshot for keyword_id {batch[0][0][0]}: {e}")
+                    self.resolve(batch[0][1], e)
+                else:
+                    # The batch was rolled back as a whole; write its records
+                    # one by one so only the bad one fails its caller
+                    logging.warning(f"Failed to write batch of {len(batch)} SERP snapshots, retrying one by one: {e}")
+                    for record, future in batch:
+                        try:
+                            written = await loop.run_in_executor(None, write_serp_batch, [record])
+                        except Exception as record_error:
+                            logging.error(f"Failed to write SERP snapshot for keyword_id {record[0]}: {record_error}")
+                            self.resolve(future, record_error)
+                        else:
+                            self.rows_written += written
+                            self.resolve(future)
+            else:
+                self.rows_written += written
+                self.batches_written += 1
+                for _, future in batch:
+                    self.resolve(future)
+            if self.pending and len(self.pending) < self.batch_rows and self.flush_timer is None:
+                self.flush_timer = asyncio.get_running_loop().call_later(
+                    self.flush_interval, lambda: asyncio.ensure_future(self.flush()))
+
+    @staticmethod
+    def resolve(future: asyncio.Future, error: Optional[Exception] = None):
+        """Completes a submitter's future unless it was already settled."""
+        if future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+serp_writer: Optional[SerpWriter] = None
+
+def get_serp_writer() -> SerpWriter:
+    """
+    Returns the process-wide writer, creating it on first use.
+    Must be called from within the running event loop.
+    """
+    global serp_writer
+    if serp_writer is None:
+        serp_writer = SerpWriter(
+            batch_rows=int(os.getenv("SERP_WRITER_BATCH_ROWS", 25)),
+            flush_interval=float(os.getenv("SERP_WRITER_FLUSH_MS", 250)) / 1000
+        )
+    return serp_writer
+
+async def close_serp_writer():
+    """Flushes whatever is still buffered; called on shutdown."""
+    global serp_writer
+    if serp_writer is not None:
+        await serp_writer.flush()
+        logging.info(f"SERP writer closed after {serp_writer.rows_written} rows in {serp_writer.batches_written} batches")
+    serp_writer = None
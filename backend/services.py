@@ -1,39 +1,101 @@
 import aiohttp
+import asyncio
 import logging
 from fastapi import HTTPException
 import json
 from datetime import datetime, timezone, timedelta
 import os
+from dotenv import load_dotenv
+from typing import Dict, List
+from http_client import get_http_session
+from rate_limiter import get_rate_limiter, parse_retry_after, THROTTLE_STATUSES
+from single_flight import get_single_flight
 # from database import add_gsc_data_by_keyword_id, get_db_connection
 
+load_dotenv()
 GREPWORDS_API_KEY = os.getenv("GREPWORDS_API_KEY")  # Ensure this is set
+# Market every volume is looked up for
+VOLUME_COUNTRY = "us"
+VOLUME_LANGUAGE = "en"
 
-async def fetch_search_volume(keyword: str) -> int:
+async def fetch_search_volume(keyword: str, max_retries: int = 3) -> int:
+    payload = {
+        "term": keyword,
+        "country": VOLUME_COUNTRY,
+        "language": VOLUME_LANGUAGE
+    }
+    # Concurrent lookups of the same term share one Grepwords call
+    return await get_single_flight('grepwords').do(
+        tuple(sorted(payload.items())), lambda: request_search_volume(payload, max_retries))
+
+async def fetch_search_volumes(keywords: List[str], max_retries: int = 3) -> Dict[str, int]:
+    """
+    Looks up the search volume of many keywords at once. The Grepwords lookup
+    endpoint takes a single term, so each distinct keyword is one request; all
+    of them run concurrently and the shared rate limiter sets the pace.
+
+    Args:
+        keywords (List[str]): Keywords to look up; duplicates are fetched once.
+        max_retries (int): Attempts per keyword when throttled.
+
+    Returns:
+        Dict[str, int]: Volume per keyword. Keywords whose lookup raised are
+        left out so they can be retried later.
+    """
+    terms = list(dict.fromkeys(keywords))
+    results = await asyncio.gather(*[fetch_search_volume(term, max_retries) for term in terms], return_exceptions=True)
+    volumes = {}
+    for term, result in zip(terms, results):
+        if isinstance(result, Exception):
+            logging.error(f"Search volume lookup for '{term}' failed: {getattr(result, 'detail', None) or result}")
+        else:
+            volumes[term] = result
+    return volumes
+
+async def request_search_volume(payload: dict, max_retries: int) -> int:
+    """
+    Looks up one term with Grepwords. A successful answer without data means
+    the term has no volume and returns 0.
+
+    Raises:
+        HTTPException: No API key is set, Grepwords still throttled the last
+            attempt, or it answered with an error. Nothing is returned then, so
+            a failed lookup is never mistaken for a volume of 0.
+    """
+    keyword = payload["term"]
+    if not GREPWORDS_API_KEY:
+        raise HTTPException(status_code=500, detail="GREPWORDS_API_KEY is not set")
     url = "https://data.grepwords.com/v1/keywords/lookup"
     headers = {
         "accept": "application/json",
         "api_key": GREPWORDS_API_KEY,
         "Content-Type": "application/json"
     }
-    payload = {
-        "term": keyword,
-        "country": "us",
-        "language": "en"
-    }
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=payload) as response:
-            logging.info(f"Grepwords API request for '{keyword}': URL: {url}, Headers: {headers}, Payload: {payload}")
-            data = await response.json()
-            logging.info(f"Grepwords API response for '{keyword}': {json.dumps(data, indent=2)}")
-            
-            if response.status == 200 and data and 'data' in data:
-                volume = data['data'].get('volume', 0)
-                logging.info(f"Search volume for '{keyword}': {volume}")
-                return volume
-            else:
-                logging.warning(f"No search volume data found for '{keyword}'. Status: {response.status}, Response: {data}")
-                return 0
+    session = get_http_session()
+    limiter = get_rate_limiter('grepwords')
+    for attempt in range(max_retries):
+        async with limiter.limit() as call:
+            async with session.post(url, headers=headers, json=payload) as response:
+                logging.info(f"Grepwords API request for '{keyword}': URL: {url}, Headers: {headers}, Payload: {payload}")
+                if response.status in THROTTLE_STATUSES:
+                    call.throttled(response.status, parse_retry_after(response.headers.get('Retry-After')))
+                    if attempt < max_retries - 1:
+                        # The limiter pauses and lowers concurrency before the retry
+                        continue
+                    raise HTTPException(status_code=429, detail=f"Grepwords throttled the lookup of '{keyword}' after {max_retries} attempts")
+                if response.status != 200:
+                    raise HTTPException(status_code=502, detail=f"Grepwords returned {response.status} for '{keyword}': {await response.text()}")
+                data = await response.json()
+                logging.info(f"Grepwords API response for '{keyword}': {json.dumps(data, indent=2)}")
+                
+                if data and 'data' in data:
+                    volume = data['data'].get('volume', 0)
+                    logging.info(f"Search volume for '{keyword}': {volume}")
+                    return volume
+                else:
+                    logging.warning(f"No search volume data found for '{keyword}'. Response: {data}")
+                    return 0
 
 # async def backfill_gsc_data(project_id, keyword_id, keyword):
 #     # Example implementation
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in flight,
+    later callers with the same key await its result instead of repeating it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs ``call()`` unless a call for ``key`` is already in flight, in
+        which case its result (or exception) is shared.
+
+        Args:
+            key (Hashable): Identifies identical calls, e.g. the request parameters.
+            call (Callable[[], Awaitable[Any]]): Starts the call when none is in flight.
+        """
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            logging.info(f"Coalesced {self.name} call for {key}")
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(call())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # Shielded so one cancelled caller does not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if not future.cancelled():
+            future.exception()  # Retrieved even if every caller was cancelled
+
+    def get_stats(self) -> Dict:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight)
+        }
+
+single_flights: Dict[str, SingleFlight] = {}
+
+def get_single_flight(name: str) -> SingleFlight:
+    """
+    Returns the process-wide single-flight group for a provider or operation.
+    """
+    if name not in single_flights:
+        single_flights[name] = SingleFlight(name)
+    return single_flights[name]
+
+def get_single_flight_stats():
+    return [group.get_stats() for group in single_flights.values()]
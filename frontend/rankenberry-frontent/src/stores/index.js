@@ -8,6 +8,8 @@ export const useMainStore = defineStore('main', {
     projects: [],
     keywords: [],
     rankData: [],
+    rankDataFilters: {},
+    rankDataNextCursor: null,
     tags: [],
     gscDomains: [],
     gscDomain: null,
@@ -75,24 +77,49 @@ export const useMainStore = defineStore('main', {
         throw error
       }
     },
-    async fetchRankData() {
+    // Loads the first page of rank data. Without filters the last ones are
+    // reused, so refreshes after a fetch keep the table's current view.
+    async fetchRankData(filters = this.rankDataFilters) {
       try {
-        const response = await axios.get(`${API_URL}/rankData`);
+        // filters: project_id, tag_id, start_date, end_date, keyword_prefix, limit
+        const response = await axios.get(`${API_URL}/rankData`, { params: filters });
         this.rankData = response.data.data.map(item => ({
           ...item,
           date: item.date ? new Date(item.date).toISOString() : null
         }));
+        this.rankDataFilters = filters;
+        this.rankDataNextCursor = response.data.next_cursor || null;
         console.log('Fetched rank data:', this.rankData);
       } catch (error) {
         console.error('Error fetching rank data:', error);
         throw error;
       }
-    },    
+    },
+    // Appends the next page of rank data, if there is one
+    async fetchMoreRankData() {
+      if (!this.rankDataNextCursor) return [];
+      try {
+        const response = await axios.get(`${API_URL}/rankData`, {
+          params: { ...this.rankDataFilters, cursor: this.rankDataNextCursor }
+        });
+        const page = response.data.data.map(item => ({
+          ...item,
+          date: item.date ? new Date(item.date).toISOString() : null
+        }));
+        this.rankData = [...this.rankData, ...page];
+        this.rankDataNextCursor = response.data.next_cursor || null;
+        return page;
+      } catch (error) {
+        console.error('Error fetching more rank data:', error);
+        throw error;
+      }
+    },
 
     async fetchSerpData(projectId, tagId = null) {
       try {
         const payload = tagId ? { tag_id: tagId } : {};
         const response = await axios.post(`${API_URL}/fetch-serp-data/${projectId}`, payload);
+        await this.waitForJob(response.data.job_id);
         await this.fetchRankData();
         return response.data;
       } catch (error) {
@@ -104,6 +131,7 @@ export const useMainStore = defineStore('main', {
     async fetchSerpDataByTag(tagId) {
       try {
         const response = await axios.post(`${API_URL}/fetch-serp-data-by-tag/${tagId}`)
+        await this.waitForJob(response.data.job_id)
         await this.fetchRankData()
         return response.data
       } catch (error) {
@@ -111,6 +139,34 @@ export const useMainStore = defineStore('main', {
         throw error
       }
     },
+    async fetchJobStatus(jobId) {
+      try {
+        const response = await axios.get(`${API_URL}/jobs/${jobId}`)
+        return response.data
+      } catch (error) {
+        console.error('Error fetching job status:', error)
+        throw error
+      }
+    },
+    async waitForJob(jobId, onProgress = null, interval = 2000) {
+      let job = await this.fetchJobStatus(jobId)
+      while (job.status === 'pending' || job.status === 'running') {
+        if (onProgress) onProgress(job)
+        await new Promise(resolve => setTimeout(resolve, interval))
+        job = await this.fetchJobStatus(jobId)
+      }
+      if (onProgress) onProgress(job)
+      return job
+    },
+    async cancelJob(jobId) {
+      try {
+        const response = await axios.post(`${API_URL}/jobs/${jobId}/cancel`)
+        return response.data
+      } catch (error) {
+        console.error('Error cancelling job:', error)
+        throw error
+      }
+    },
     async fetchFullSerpData(serpDataId) {
       try {
         const response = await axios.get(`${API_URL}/serp-data/${serpDataId}`)